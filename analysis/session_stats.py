@@ -5,20 +5,105 @@
 # Generate a bunch of statistics for each Member and then
 # rank the results across subsets of Members to contextualize
 # the information.
+#
+# The statistics are written to the session's file in data/us/<congress>/stats
+# and then compiled into the store the website reads (see person/stats_store.py):
+#
+# analysis/session_stats.py 2014 [notes]
 
-import sys, json, re
+import sys, json, re, os, tempfile
 
 import us
 import datetime # implicitly used in eval()'ing dates inside major_actions
 
 from person.models import Person, PersonRole, RoleType
 from bill.models import Cosponsor, Bill, BillStatus, RelatedBill, BillType
-from vote.models import Vote, Voter, CongressChamber
+from vote.models import CongressChamber
 from committee.models import CommitteeMemberRole
 
 competitive_seats = None
 
-def get_cohorts(person, role, congress, session, committee_membership):
+class SessionData(object):
+	# The votes, bills, and cosponsorships of a session, loaded with a handful
+	# of grouped queries so that the statistics for all Members can be computed
+	# without querying the database for each Member.
+
+	def __init__(self, people, congress, session, startdate, enddate):
+		self.congress = congress
+		self.startdate = startdate
+		self.enddate = enddate
+
+		# (person id, role type) => number of votes elligible, number of votes missed,
+		# from the chamber-wide voter matrices
+		from vote.matrix import load_voter_matrix
+		self.votes_elligible = { }
+		self.votes_missed = { }
+		for chamber, role_type in ((CongressChamber.house, RoleType.representative), (CongressChamber.senate, RoleType.senator)):
+			matrix = load_voter_matrix(congress, chamber)
+			elligible, missed = matrix.missed_votes(matrix.session_mask(session) if session else None)
+			for person_id, v1, v2 in zip(matrix.person_ids, elligible, missed):
+				self.votes_elligible[(int(person_id), role_type)] = int(v1)
+				self.votes_missed[(int(person_id), role_type)] = int(v2)
+
+		# sponsor id => [bills introduced in the date range], in the default order
+		self.bills_by_sponsor = { }
+		for bill in Bill.objects.filter(congress=congress, introduced_date__gte=startdate, introduced_date__lte=enddate):
+			self.bills_by_sponsor.setdefault(bill.sponsor_id, []).append(bill)
+
+		# Cosponsorships of bills in this Congress that were joined in the date range,
+		# as (bill id, cosponsor id, cosponsor party, sponsor id, sponsor party) tuples,
+		# indexed by bill, cosponsor, and sponsor.
+		self.cosponsors_by_bill = { }
+		self.cosponsored_by_person = { }
+		self.cosponsors_by_sponsor = { }
+		for row in Cosponsor.objects.filter(bill__congress=congress, joined__gte=startdate, joined__lte=enddate)\
+			.order_by("id")\
+			.values_list("bill", "person", "role__party", "bill__sponsor", "bill__sponsor_role__party"):
+			self.cosponsors_by_bill.setdefault(row[0], []).append(row)
+			self.cosponsored_by_person.setdefault(row[1], []).append(row)
+			self.cosponsors_by_sponsor[row[3]] = self.cosponsors_by_sponsor.get(row[3], 0) + 1
+
+		# bill id => [committee codes]
+		self.bill_committees = { }
+		for bill_id, code in Bill.committees.through.objects.filter(bill__congress=congress).values_list("bill", "committee__code"):
+			self.bill_committees.setdefault(bill_id, []).append(code)
+
+		# ids of bills with an identical companion bill introduced in the date range
+		self.bills_with_companion = set(RelatedBill.objects.filter(bill__congress=congress, relation="identical",
+			related_bill__introduced_date__gte=startdate, related_bill__introduced_date__lte=enddate)
+			.values_list("bill", flat=True))
+
+		# person id => [representative and senator roles], for cohorts
+		self.roles_by_person = { }
+		for r in PersonRole.objects.filter(person__in=[person.id for person, role in people], role_type__in=(RoleType.representative, RoleType.senator)):
+			self.roles_by_person.setdefault(r.person_id, []).append(r)
+
+	def was_bill_enacted(self, bill):
+		# Same as Bill.was_enacted_ex restricted to activity in the date range:
+		# the bill or an identical companion bill reached a final status in the range.
+		for d in get_bill_enactment_dates(self.congress).get(bill.id, []):
+			if self.startdate <= d <= self.enddate:
+				return True
+		return False
+
+bill_enactment_dates = { }
+def get_bill_enactment_dates(congress):
+	# Returns a table from bill ids to the dates on which the bill, or an identical
+	# companion bill, reached a final status in BillStatus.final_status_passed_bill.
+	# Loaded once per Congress.
+	if congress not in bill_enactment_dates:
+		dates = { }
+		for bill_id, status_date in Bill.objects.filter(congress=congress, current_status__in=BillStatus.final_status_passed_bill)\
+			.values_list("id", "current_status_date"):
+			dates.setdefault(bill_id, []).append(status_date)
+		for bill_id, status_date in RelatedBill.objects.filter(bill__congress=congress, relation="identical",
+			related_bill__current_status__in=BillStatus.final_status_passed_bill)\
+			.values_list("bill", "related_bill__current_status_date"):
+			dates.setdefault(bill_id, []).append(status_date)
+		bill_enactment_dates[congress] = dates
+	return bill_enactment_dates[congress]
+
+def get_cohorts(person, role, congress, session, committee_membership, data):
 	cohorts = []
 
 	# chamber
@@ -41,7 +126,8 @@ def get_cohorts(person, role, congress, session, committee_membership):
 	prev_congresses_served = set()
 	# use enddate__lte=endate to include the current role itself since for
 	# senators their current role may span previous congresses
-	for r in PersonRole.objects.filter(person=person, role_type=role.role_type, enddate__lte=role.enddate):
+	for r in data.roles_by_person.get(person.id, []):
+		if r.role_type != role.role_type or r.enddate > role.enddate: continue
 		if not min_start_date or r.startdate < min_start_date: min_start_date = r.startdate
 		for c in r.congress_numbers():
 			if c < congress:
@@ -84,13 +170,11 @@ def get_cohorts(person, role, congress, session, committee_membership):
 	return cohorts
 
 
-def get_vote_stats(person, role, stats, votes_this_year):
+def get_vote_stats(person, role, stats, data):
 	# Missed vote % in the chamber that the Member is currently serving in.
 	if role.leadership_title == "Speaker": return
-	votes_elligible = Voter.objects.filter(person=person, vote__in=votes_this_year[role.role_type])
-	votes_missed = votes_elligible.filter(option__key="0")
-	v1 = votes_elligible.count()
-	v2 = votes_missed.count()
+	v1 = data.votes_elligible.get((person.id, role.role_type), 0)
+	v2 = data.votes_missed.get((person.id, role.role_type), 0)
 	stats["missed-votes"] = {
 		"value": 100.0*float(v2)/float(v1) if v1 > 0 else None,
 		"elligible": v1,
@@ -126,26 +210,22 @@ def was_bill_enacted_2013(b, startdate, enddate):
 		
 	return False
 
-def get_sponsor_stats(person, role, stats, congress, startdate, enddate, committee_membership):
+def get_sponsor_stats(person, role, stats, startdate, enddate, committee_membership, data):
 	# How many bills did the Member introduce during this time window?
-	bills = Bill.objects.filter(sponsor=person, congress=congress,
-		introduced_date__gte=startdate, introduced_date__lte=enddate)
+	bills = data.bills_by_sponsor.get(person.id, [])
 	stats["bills-introduced"] = {
-		"value": bills.count(),
+		"value": len(bills),
 	}
 
 	# How many bills were enacted within this time window?
 	#bills_enacted = bills.filter(current_status__in=BillStatus.final_status_passed_bill,
 	#	current_status_date__gte=startdate, current_status_date__lte=enddate)
-	def was_bill_enacted(b, startdate, enddate):
-		return b.was_enacted_ex(restrict_to_activity_in_date_range=(startdate.isoformat(), enddate.isoformat()))
-	bills_enacted = [b for b in bills if was_bill_enacted(b, startdate, enddate)]
+	bills_enacted = [b for b in bills if data.was_bill_enacted(b)]
 	stats["bills-enacted"] = {
 		"value": len(bills_enacted),
 		"bills": make_bill_entries(bills_enacted),
 	}
 
-	bills = list(bills)
 	was_reported = []
 	has_cmte_leaders = []
 	has_cosponsors_both_parties = 0
@@ -166,11 +246,11 @@ def get_sponsor_stats(person, role, stats, congress, startdate, enddate, committ
 				break # make sure not to double-count any bills in case of data errors
 
 		# Check whether any cosponsors are on relevant committees.
-		cosponsors = list(Cosponsor.objects.filter(bill=bill, joined__gte=startdate, joined__lte=enddate).select_related("person", "role"))
+		cosponsors = data.cosponsors_by_bill.get(bill.id, [])
 		x = False
-		for committee in list(bill.committees.all()):
+		for committee_code in data.bill_committees.get(bill.id, []):
 			for cosponsor in cosponsors:
-				if committee_membership.get(cosponsor.person.id, {}).get(committee.code) in (CommitteeMemberRole.ranking_member, CommitteeMemberRole.vice_chairman, CommitteeMemberRole.chairman):
+				if committee_membership.get(cosponsor[1], {}).get(committee_code) in (CommitteeMemberRole.ranking_member, CommitteeMemberRole.vice_chairman, CommitteeMemberRole.chairman):
 					x = True
 		if x: has_cmte_leaders.append(bill)
 
@@ -178,13 +258,13 @@ def get_sponsor_stats(person, role, stats, congress, startdate, enddate, committ
 		co_d = False
 		co_r = False
 		for cosponsor in cosponsors:
-			if cosponsor.role.party == "Democrat": co_d = True
-			if cosponsor.role.party == "Republican": co_r = True
+			if cosponsor[2] == "Democrat": co_d = True
+			if cosponsor[2] == "Republican": co_r = True
 		if co_d and co_r:
 			has_cosponsors_both_parties += 1
 
         # Check if a companion bill was introduced during the time period.
-		if RelatedBill.objects.filter(bill=bill, relation="identical", related_bill__introduced_date__gte=startdate, related_bill__introduced_date__lte=enddate).exists():
+		if bill.id in data.bills_with_companion:
 			has_companion.append(bill)
 
 
@@ -210,27 +290,27 @@ def get_sponsor_stats(person, role, stats, congress, startdate, enddate, committ
 		"bills": make_bill_entries(has_companion),
 	}
 
-def get_cosponsor_stats(person, role, stats, congress, startdate, enddate):
+def get_cosponsor_stats(person, role, stats, data):
 	# Count of cosponsors on the Member's bills with a join date in this session.
-	cosponsors = Cosponsor.objects.filter(bill__sponsor=person, bill__congress=congress, joined__gte=startdate, joined__lte=enddate)
 	stats["cosponsors"] = {
-		"value": cosponsors.count(),
+		"value": data.cosponsors_by_sponsor.get(person.id, 0),
 	}
 
-def get_cosponsored_stats(person, role, stats, congress, startdate, enddate):
+def get_cosponsored_stats(person, role, stats, data):
 	# Count of bills this person cosponsored.
-	cosponsored = Cosponsor.objects.filter(person=person, bill__congress=congress, joined__gte=startdate, joined__lte=enddate)
+	cosponsored = data.cosponsored_by_person.get(person.id, [])
 	stats["cosponsored"] = {
-		"value": cosponsored.count(),
+		"value": len(cosponsored),
 	}
 
-	# Of those bills, how many sponsored by a member of the other party.
-	if role.party in ("Democrat", "Republican") and cosponsored.count() > 10:
-		cosponsored_bi = cosponsored.exclude(bill__sponsor_role__party=role.party)
+	# Of those bills, how many sponsored by a member of the other party
+	# (or whose sponsor's party is unknown).
+	if role.party in ("Democrat", "Republican") and len(cosponsored) > 10:
+		cosponsored_bi = [c for c in cosponsored if c[4] != role.party]
 		stats["cosponsored-other-party"] = {
-			"value": 100.0 * float(cosponsored_bi.count()) / float(cosponsored.count()),
-			"cosponsored": cosponsored.count(),
-			"cosponsored_other_party": cosponsored_bi.count(),
+			"value": 100.0 * float(len(cosponsored_bi)) / float(len(cosponsored)),
+			"cosponsored": len(cosponsored),
+			"cosponsored_other_party": len(cosponsored_bi),
 		}
 
 
@@ -285,7 +365,7 @@ def get_committee_stats(person, role, stats, committee_membership):
 	}
 
 transparency_bills = None
-def get_transparency_stats(person, role, stats, congress, startdate, enddate):
+def get_transparency_stats(person, role, stats, startdate, enddate, data):
 	global transparency_bills
 	if not transparency_bills:
 		transparency_bills = []
@@ -306,9 +386,11 @@ def get_transparency_stats(person, role, stats, congress, startdate, enddate):
 			sponsored.append(bill)
 
 	# did person cosponsor any of these within this session?
+	transparency_bills_by_id = dict((bill.id, bill) for bill in transparency_bills)
 	cosponsored = []
-	for cosp in Cosponsor.objects.filter(person=person, bill__in=transparency_bills, joined__gte=startdate, joined__lte=enddate):
-		cosponsored.append(cosp.bill)
+	for cosp in data.cosponsored_by_person.get(person.id, []):
+		if cosp[0] in transparency_bills_by_id:
+			cosponsored.append(transparency_bills_by_id[cosp[0]])
 
 	stats["transparency-bills"] = {
 		"value": len(sponsored)*3 + len(cosponsored),
@@ -367,14 +449,8 @@ def collect_stats(session):
 	from bill.prognosis import load_committee_membership
 	committee_membership = load_committee_membership(congress)
 
-	# Pre-fetch all of the votes in this session.
-	votes_this_year = Vote.objects.filter(congress=congress)
-	if session:
-		votes_this_year = votes_this_year.filter(session=session)
-	votes_this_year = {
-		RoleType.representative: set(votes_this_year.filter(chamber=CongressChamber.house).values_list("id", flat=True)),
-		RoleType.senator: set(votes_this_year.filter(chamber=CongressChamber.senate).values_list("id", flat=True)),
-	}
+	# Pre-fetch the vote, bill, and cosponsorship data for the session for all Members at once.
+	data = SessionData(people, congress, session, startdate, enddate)
 
 
 	# Generate raw statistics.
@@ -389,17 +465,17 @@ def collect_stats(session):
 			"role_end": role.enddate.isoformat(),
 
 			"stats": { },
-			"cohorts": get_cohorts(person, role, congress, competitive_session, committee_membership),
+			"cohorts": get_cohorts(person, role, congress, competitive_session, committee_membership, data),
 		}
 
 		stats = AllStats[person.id]["stats"]
-		get_vote_stats(person, role, stats, votes_this_year)
-		get_sponsor_stats(person, role, stats, congress, startdate, enddate, committee_membership)
-		get_cosponsor_stats(person, role, stats, congress, startdate, enddate)
-		get_cosponsored_stats(person, role, stats, congress, startdate, enddate)
+		get_vote_stats(person, role, stats, data)
+		get_sponsor_stats(person, role, stats, startdate, enddate, committee_membership, data)
+		get_cosponsor_stats(person, role, stats, data)
+		get_cosponsored_stats(person, role, stats, data)
 		get_sponsorship_analysis_stats(person, role, stats)
 		get_committee_stats(person, role, stats, committee_membership)
-		get_transparency_stats(person, role, stats, congress, startdate, enddate)
+		get_transparency_stats(person, role, stats, startdate, enddate, data)
 
 	return AllStats, congress, is_full_congress_stats
 
@@ -468,5 +544,15 @@ if __name__ == "__main__":
 		},
 		"people": stats,
 	}
-	json.dump(stats, sys.stdout, indent=2, sort_keys=True)
+
+	# Replace the JSON file in one step, then compile the store from it.
+	from person.stats_store import get_session_stats_file, compile_session_stats_store
+	fn = get_session_stats_file(session)[3]
+	if not os.path.exists(os.path.dirname(fn)): os.makedirs(os.path.dirname(fn))
+	fd, temp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=os.path.basename(fn) + ".", suffix=".tmp")
+	with os.fdopen(fd, "w") as f:
+		json.dump(stats, f, indent=2, sort_keys=True)
+	os.chmod(temp_fn, 0644) # mkstemp makes it readable only by us
+	os.rename(temp_fn, fn)
+	compile_session_stats_store(session)
 
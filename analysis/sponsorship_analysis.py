@@ -18,16 +18,18 @@
 
 import sys
 import os
-import glob
-import math
 import numpy
+import scipy.sparse
+import scipy.sparse.linalg
 import scipy.stats
-import lxml.etree as lxml
+
+from django.db.models import Count
 
 from person.models import PersonRole
 from person.types import RoleType
-from bill.models import Bill, Cosponsor
+from bill.models import Bill, BillType, Cosponsor
 from us import get_congress_dates
+from settings import CURRENT_CONGRESS
 
 import matplotlib
 matplotlib.use('Agg')
@@ -43,7 +45,7 @@ matplotlib.rcParams["lines.markersize"] = 3
 
 def onenorm(u):
 	# The one-norm.
-	return sum(abs(u))
+	return numpy.abs(u).sum()
 
 def rescale(u, log=False):
 	# Re-scale the vector to range from 0 to 1, and convert it out of
@@ -91,99 +93,117 @@ def get_people(roles):
 
 	return people, people_list
 
-def attach_other_stats(congressnumber, person_role):
-	# A staffer tells me they're interested in the number of unique/total cosponsors to their
-	# bills in the current Congress. We'll compute that here too. For historical data, compute for
-	# bills up to the end of the Congress.
-	bills = person_role.person.sponsored_bills.filter(congress=congressnumber)
-	cosp = Cosponsor.objects.filter(bill__in=list(bills)).values_list('person', flat=True)
-	person_role.total_cosponsors = len(cosp)
-	person_role.unique_cosponsors = len(set(cosp))
-
-	# ...and the number of other people's bills the member has cosponsored this Congress.
-	person_role.total_cosponsored_bills = Cosponsor.objects.filter(person=person_role.person, bill__congress=congressnumber).count()
-
-	# ...and the number of bills the Member introduced this Congress
-	person_role.total_introduced_bills = Bill.objects.filter(sponsor=person_role.person, congress=congressnumber).count()
-
+def attach_other_stats(congressnumber, person_roles):
+	edges = load_cosponsorship_edges(congressnumber)
+	introduced_bills = dict(
+		(r["sponsor"], r["count"])
+		for r in Bill.objects.filter(congress=congressnumber).values("sponsor").annotate(count=Count("id")))
+
+	for person_role in person_roles:
+		# A staffer tells me they're interested in the number of unique/total cosponsors to their
+		# bills in the current Congress. We'll compute that here too. For historical data, compute for
+		# bills up to the end of the Congress.
+		cosp = edges["cosponsor"][edges["sponsor"] == person_role.person_id]
+		person_role.total_cosponsors = len(cosp)
+		person_role.unique_cosponsors = len(numpy.unique(cosp))
+
+		# ...and the number of other people's bills the member has cosponsored this Congress.
+		person_role.total_cosponsored_bills = int((edges["cosponsor"] == person_role.person_id).sum())
+
+		# ...and the number of bills the Member introduced this Congress
+		person_role.total_introduced_bills = introduced_bills.get(person_role.person_id, 0)
+
+# The edge store: one row per cosponsorship of a bill in a Congress, in
+# columns. Dates are stored as YYYYMMDD integers and sponsor is 0 for bills
+# without a sponsor. For past Congresses, this is saved to disk the first time
+# it is built from the database.
+EDGE_COLUMNS = (("chamber", numpy.int8), ("sponsor", numpy.int32), ("cosponsor", numpy.int32),
+	("joined", numpy.int32), ("introduced", numpy.int32))
+_edge_store = { }
+
+def load_cosponsorship_edges(congressnumber, rebuild=False):
+	if congressnumber in _edge_store and not rebuild:
+		return _edge_store[congressnumber]
+
+	fn = datadir + "/us/" + str(congressnumber) + "/stats/cosponsorship_edges.npz"
+	if os.path.exists(fn) and not rebuild and congressnumber < CURRENT_CONGRESS:
+		f = numpy.load(fn)
+		edges = dict((k, f[k]) for k in f.files)
+	else:
+		edges = build_cosponsorship_edges(congressnumber)
+		if congressnumber < CURRENT_CONGRESS:
+			if not os.path.exists(os.path.dirname(fn)): os.makedirs(os.path.dirname(fn))
+			with open(fn + ".tmp", "wb") as f:
+				numpy.savez_compressed(f, **edges)
+			os.rename(fn + ".tmp", fn)
+
+	_edge_store[congressnumber] = edges
+	return edges
+
+def build_cosponsorship_edges(congressnumber):
+	def date_to_int(d):
+		return d.year*10000 + d.month*100 + d.day
+	chamber_of = dict((bt[0], 0 if BillType.by_value(bt[0]).chamber == "House" else 1) for bt in BillType)
+	rows = Cosponsor.objects.filter(bill__congress=congressnumber)\
+		.values_list("bill__bill_type", "bill__sponsor", "person", "joined", "bill__introduced_date")
+	rows = [(chamber_of[bt], sponsor or 0, cosponsor, date_to_int(joined), date_to_int(introduced))
+		for bt, sponsor, cosponsor, joined, introduced in rows]
+	return dict(
+		(name, numpy.array([r[i] for r in rows], dtype=dtype))
+		for i, (name, dtype) in enumerate(EDGE_COLUMNS))
 
 def build_matrix(congressnumber, starting_congress, house_or_senate, people, people_list, filter_startdate=None, filter_enddate=None):
-	start_date = None
-	end_date = None
-	
-	# Map GovTrack person IDs to rows (or columns) of the matrix.
-	rep_to_row = { }
-	def rownum(id):
-		if not id in rep_to_row:
-			rep_to_row[id] = len(rep_to_row)
-		return rep_to_row[id]
-		
-	# Store a flat (i.e. sparse) list of all cells that have the value 1. Note that
-	# we will get duplicates here! Scan the indicated and the previous congress,
-	# but include only those Members of Congress that served in the indicated
-	# Congress.
-	cells = []
-	for cn in xrange(starting_congress, congressnumber+1):
-		for billfilename in glob.glob(datadir + "/us/" + str(cn) + "/bills/" + house_or_senate + "*.xml"):
-			xml = lxml.parse(billfilename)
-			
-			# get the sponsor
-			spx = xml.xpath("sponsor/@id")
-			if len(spx) == 0: # e.g. debt limit with no sponsor
-				continue
-			if not int(spx[0]) in people_list[house_or_senate]:
-				continue
-			sponsor = rownum(int(spx[0]))
-
-			# loop through the cosponsors
-			has_entry = False
-			for cosponsor_node in xml.xpath("cosponsors/cosponsor"):
-				# get the cosponsor's ID
-				cosponsor_id = int(cosponsor_node.xpath("string(@id)"))
-				if cosponsor_id not in people_list[house_or_senate]: continue
-
-				# if a date filter is specified, only take cosponsors that joined within
-				# the date range (inclusive)
-				if filter_startdate:
-					join_date = cosponsor_node.xpath("string(@joined)")
-					if join_date < filter_startdate or join_date > filter_enddate:
-						continue
-
-				# add an entry to the flat list of sponsor-cosponsor pairs
-				cosponsor = rownum(cosponsor_id)
-				cells.append( (sponsor, cosponsor) )
-				has_entry = True
-
-			# if there was a sponsor/cosponsor pair from this bill, extend the
-			# start_date/end_date range to cover the introduced date of this bill.
-			if has_entry:
-				date = xml.xpath("introduced/@datetime")[0]
-				start_date = min(start_date, date) if start_date else date
-				end_date = max(end_date, date)
-	
-	# In the event a member of congress neither sponsored nor cosponsored
-	# a bill, just give them an empty slot.
-	for person in people_list[house_or_senate]:
-		rownum(person)
-
-	# Get total number of members of congress seen.
+	# Map GovTrack person IDs to rows (or columns) of the matrix. Only those Members
+	# of Congress that served in the indicated Congress are included. In the event
+	# a member of congress neither sponsored nor cosponsored a bill, they just get
+	# an empty slot.
+	members = numpy.array(sorted(people_list[house_or_senate]), dtype=numpy.int32)
+	rep_to_row = dict((int(id), i) for i, id in enumerate(members))
 	nreps = len(rep_to_row)
-	
-	# Turn this into a dense numpy array with cells flagged as 1 if there is such
-	# a transition. Keep adding 1s... Start with the identity matrix because
-	# every rep should be counted as sponsoring his own bills.
-	P = numpy.identity(nreps, numpy.float) # numpy.zeros( (nreps,nreps) )
-	for sponsor, cosponsor in cells:
-		P[sponsor, cosponsor] += 1.0
+
+	# Collect the sponsor-cosponsor pairs of bills in the indicated and the previous
+	# congress. Note that we will get duplicates here!
+	sponsors = []
+	cosponsors = []
+	introduced = []
+	for cn in xrange(starting_congress, congressnumber+1):
+		edges = load_cosponsorship_edges(cn)
+		sel = (edges["chamber"] == (0 if house_or_senate == "h" else 1)) \
+			& numpy.in1d(edges["sponsor"], members) & numpy.in1d(edges["cosponsor"], members)
+
+		# if a date filter is specified, only take cosponsors that joined within
+		# the date range (inclusive)
+		if filter_startdate:
+			sel &= (edges["joined"] >= int(filter_startdate.replace("-", ""))) \
+				& (edges["joined"] <= int(filter_enddate.replace("-", "")))
+
+		sponsors.append(edges["sponsor"][sel])
+		cosponsors.append(edges["cosponsor"][sel])
+		introduced.append(edges["introduced"][sel])
+	sponsors = numpy.searchsorted(members, numpy.concatenate(sponsors))
+	cosponsors = numpy.searchsorted(members, numpy.concatenate(cosponsors))
+	introduced = numpy.concatenate(introduced)
+
+	# The start_date/end_date range covers the introduced dates of the bills that had
+	# a sponsor/cosponsor pair.
+	def int_to_date(d):
+		return "%04d-%02d-%02d" % (d/10000, d/100 % 100, d % 100)
+	start_date = int_to_date(introduced.min()) if len(introduced) else None
+	end_date = int_to_date(introduced.max()) if len(introduced) else None
+
+	# Turn this into a sparse matrix with each cell counting the transitions. Start
+	# with the identity matrix because every rep should be counted as sponsoring his
+	# own bills. Duplicate pairs are summed.
+	P = scipy.sparse.coo_matrix((numpy.ones(len(sponsors)), (sponsors, cosponsors)), shape=(nreps, nreps)).tocsr() \
+		+ scipy.sparse.identity(nreps, format="csr")
 
 	return start_date, end_date, rep_to_row, nreps, P
 
 def smooth_matrix(nreps, P):
 	# Take the square root of each cell to flatten out outliers where one person
-	# cosponsors a lot of other people's bills.
-	for i in xrange(nreps):
-		for j in xrange(nreps):
-			P[i,j] = math.sqrt(P[i,j])
+	# cosponsors a lot of other people's bills. (Empty cells stay zero, so only
+	# the stored values of the sparse matrix need to change.)
+	P.data = numpy.sqrt(P.data)
 
 def build_party_list(rep_to_row, people, nreps):
 	parties = [None for i in xrange(nreps)]
@@ -200,8 +220,9 @@ def ideology_analysis(nreps, parties, P):
 	# In practice it looks like the second dimension works best. Also, this works
 	# best before we normalize columns to sum to one. That is, we want cells
 	# to be 1 when the column person cosponsors a bill of the row person.
-	u, s, vh = numpy.linalg.svd(P)
-	spectrum = vh[1,:]
+	# Only the top two singular vectors are needed.
+	u, s, vh = scipy.sparse.linalg.svds(P, k=2)
+	spectrum = vh[numpy.argsort(s)[0],:]
 	
 	# To make the spectrum left-right, we'll multiply the scores by the sign of
 	# the mean score of the Republicans to put them on the right.
@@ -224,23 +245,27 @@ def leadership_analysis(nreps, P):
 	# have some data. But if they have so little data, we should fudge
 	# it because if they only 'cosponsor' their own bills they will get
 	# leadership scores of 0.5.
-	for col in xrange(nreps):
-		s = sum(P[:,col])
-		if s == 0: raise ValueError()
-		if s < 10: # min number of cosponsorship data per person
-			P[:,col] += (10.0-s)/nreps
-			s = 10
-		P[:,col] = P[:,col] / s
+	#
+	# The fudge adds a constant to every cell of a column, which would make
+	# the matrix dense. Instead, keep the matrix as the sparse part scaled by
+	# the column sums, plus a rank-one part 1 * fudge^T / nreps:
+	# P = S + 1 f^T / nreps, so Px = Sx + (f.x)/nreps.
+	colsums = numpy.asarray(P.sum(axis=0)).ravel()
+	if (colsums == 0).any(): raise ValueError()
+	fudge = numpy.where(colsums < 10, 10.0 - colsums, 0.0) # min number of cosponsorship data per person
+	colsums = numpy.maximum(colsums, 10.0)
+	S = scipy.sparse.csr_matrix(P) * scipy.sparse.diags(1.0 / colsums, 0)
+	f = fudge / colsums
 		
 	# Create a random transition vector.
-	v = numpy.ones( (nreps, 1) ) / float(nreps)
+	v = numpy.ones(nreps) / float(nreps)
 	
 	# This is one minus the weight we give to the random transition probability
 	# added into each column.
 	c = 0.85
 	
 	# Create an initial choice for x, another random transition vector.
-	x = numpy.ones( (nreps, 1) ) / float(nreps)
+	x = numpy.ones(nreps) / float(nreps)
 	
 	# Run the Power Method to compute the principal eigenvector for the matrix,
 	# which is, after all, the PageRank.
@@ -248,7 +273,7 @@ def leadership_analysis(nreps, P):
 	while True:
 		# Compute y = Ax where A is P plus some perturbation with magnitude
 		# 1-c that ensures that A is a valid aperiodic, irreducible Markov transition matrix.
-		y = c * numpy.dot(P, x)
+		y = c * (S.dot(x) + f.dot(x) / nreps)
 		w = onenorm(x) - onenorm(y)
 		y = y + w*v
 		
@@ -410,10 +435,11 @@ def influence_matrix(congressnumber, starting_congress, house_or_senate, people,
 	initial_score = None
 	initial_pctile = None
 	for cosponsor in [None] + list(rep_to_row):
-		P = numpy.array(P_initial) # clone
+		P = P_initial.tolil() # clone
 		if cosponsor != None: # baseline
 			#P[(rep_to_row[sponsor], rep_to_row[cosponsor])] += 1
 			P[(rep_to_row[cosponsor], rep_to_row[sponsor])] += 1
+		P = P.tocsr()
 		smooth_matrix(nreps, P)
 		spectrum = ideology_analysis(nreps, parties, P)
 		score = spectrum[rep_to_row[sponsor]]
@@ -435,8 +461,7 @@ if __name__ == "__main__":
 		sys.exit(0)
 
 	# Auxiliary stats to include in output.
-	for person_role in people.values():
-		attach_other_stats(congressnumber, person_role)
+	attach_other_stats(congressnumber, people.values())
 
 	# Perform analysis totally separately for each chamber.
 	os.system("mkdir -p " + datadir + "/us/" + str(congressnumber) + "/stats/person/sponsorshipanalysis")
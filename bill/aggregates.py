@@ -0,0 +1,147 @@
+# Materialized aggregates over the bill table for the bill docket and
+# statistics pages: counts of bills by Congress and status, month-by-month
+# histograms of introduced and enacted bills, the most recent bills in each
+# status, and the most-tracked bills. They are computed with a few grouped
+# queries, kept in the cache, and refreshed by the bill parser, so the pages
+# don't query the bill table each time they are rendered. Pages never wait for
+# a refresh unless the aggregates are missing from the cache altogether: once
+# they are older than BILL_AGGREGATES_MAX_AGE, the next page view starts a
+# refresh in the background and is shown the old ones.
+
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count
+
+from bill.models import Bill, BillType, BillStatus
+from settings import CURRENT_CONGRESS
+
+import re, threading, time
+
+BILL_AGGREGATES_CACHE_KEY = "bill_aggregates"
+BILL_AGGREGATES_LOCK_KEY = "bill_aggregates_refreshing"
+BILL_AGGREGATES_MAX_AGE = 60*60*6 # also refreshed by the bill parser; tracking counts change without it
+BILL_AGGREGATES_LOCK_TIME = 60*10 # a background refresh that takes longer than this may be started again
+BILL_AGGREGATES_FIRST_CONGRESS = 93
+BILL_AGGREGATES_TOP_BILLS = 6 # most recent bills kept for each status
+BILL_AGGREGATES_TOP_TRACKED = 25
+
+ENACTED_STATUSES = (BillStatus.enacted_signed, BillStatus.enacted_veto_override, BillStatus.enacted_tendayrule)
+
+def get_bill_aggregates():
+    """Returns the bill aggregates (see compute_bill_aggregates) from the cache,
+    computing them only if they aren't there at all. Stale aggregates are
+    returned as they are and refreshed in a background thread."""
+    entry = cache.get(BILL_AGGREGATES_CACHE_KEY)
+    if entry is None or "computed" not in entry: # missing, or cached in the old format
+        return refresh_bill_aggregates()
+    if entry["computed"] < time.time() - BILL_AGGREGATES_MAX_AGE:
+        # Only one process starts a refresh.
+        if cache.add(BILL_AGGREGATES_LOCK_KEY, True, BILL_AGGREGATES_LOCK_TIME):
+            threading.Thread(target=refresh_bill_aggregates_in_background).start()
+    return entry["aggregates"]
+
+def refresh_bill_aggregates():
+    ret = compute_bill_aggregates()
+    cache.set(BILL_AGGREGATES_CACHE_KEY, { "computed": time.time(), "aggregates": ret }, None)
+    return ret
+
+def refresh_bill_aggregates_in_background():
+    try:
+        refresh_bill_aggregates()
+    finally:
+        cache.delete(BILL_AGGREGATES_LOCK_KEY)
+        connection.close() # the thread's own connection
+
+def month_select(field_name):
+    # Extra select clauses for the year and month of a date column, so that
+    # rows can be grouped by month.
+    column = connection.ops.quote_name(field_name)
+    return {
+        "year": connection.ops.date_extract_sql("year", column),
+        "month": connection.ops.date_extract_sql("month", column),
+    }
+
+def compute_bill_aggregates():
+    """Returns a dict with:
+
+    status_counts: { congress: { status: count } }
+    introduced_by_month, enacted_by_month: { (year of the Congress, month): count },
+        where the year of the Congress is 0 or 1 for the first and second year
+        of a two-year Congress (or higher for dates after it ends)
+    top_by_status: { status: [(current_status_date, bill id)] } of the most
+        recent bills in the current Congress with each status
+    top_tracked: [(bill id, number of lists tracking it)] for the current Congress
+    """
+
+    bills = Bill.objects.filter(congress__gte=BILL_AGGREGATES_FIRST_CONGRESS)
+
+    status_counts = { }
+    for congress, status, count in bills\
+        .values_list("congress", "current_status").annotate(count=Count("id")).order_by():
+        status_counts.setdefault(congress, { })[status] = count
+
+    def by_month(bills, date_field):
+        histogram = { }
+        for congress, year, month, count in bills.extra(select=month_select(date_field))\
+            .values_list("congress", "year", "month").annotate(count=Count("id")).order_by():
+            k = (int(year) - congress*2 - 1787, int(month))
+            histogram[k] = histogram.get(k, 0) + count
+        return histogram
+    introduced_by_month = by_month(bills, "introduced_date")
+    enacted_by_month = by_month(bills.filter(current_status__in=ENACTED_STATUSES), "current_status_date")
+
+    top_by_status = { }
+    for bill_id, status, status_date in Bill.objects.filter(congress=CURRENT_CONGRESS)\
+        .values_list("id", "current_status", "current_status_date"):
+        top_by_status.setdefault(status, []).append((status_date, bill_id))
+    for status in top_by_status:
+        top_by_status[status] = sorted(top_by_status[status], reverse=True)[0:BILL_AGGREGATES_TOP_BILLS]
+
+    return {
+        "status_counts": status_counts,
+        "introduced_by_month": introduced_by_month,
+        "enacted_by_month": enacted_by_month,
+        "top_by_status": top_by_status,
+        "top_tracked": compute_top_tracked_bills(),
+    }
+
+def compute_top_tracked_bills():
+    from events.models import Feed
+    top_feeds = Feed.objects\
+        .filter(feedname__startswith='bill:')\
+        .filter(feedname__regex='^bill:[hs][jcr]?%d-' % CURRENT_CONGRESS)\
+        .annotate(count=Count('tracked_in_lists'))\
+        .order_by('-count')\
+        .values_list('feedname', 'count')\
+        [0:BILL_AGGREGATES_TOP_TRACKED]
+
+    # Map the feed names to bill ids with one query rather than a Bill.from_feed per feed.
+    keys = []
+    for feedname, count in top_feeds:
+        m = re.match(r"bill:([a-z]+)(\d+)-(\d+)$", feedname)
+        keys.append(((BillType.by_xml_code(m.group(1)), int(m.group(3))), count))
+    bill_ids = dict(((bill_type, number), id) for id, bill_type, number in
+        Bill.objects.filter(congress=CURRENT_CONGRESS, number__in=set(k[1] for k, count in keys))
+            .values_list("id", "bill_type", "number"))
+    return [(bill_ids[k], count) for k, count in keys if k in bill_ids]
+
+def get_top_bills(aggregates, statuses, limit=BILL_AGGREGATES_TOP_BILLS):
+    # Returns the ids of the most recent bills in the current Congress with any
+    # of the statuses.
+    bills = []
+    for status in statuses:
+        bills.extend(aggregates["top_by_status"].get(status, []))
+    bills.sort(reverse=True)
+    return [bill_id for status_date, bill_id in bills[0:limit]]
+
+def get_activity_by_month(histogram):
+    # Turns a histogram in the aggregates into the form shown on the bill
+    # statistics page: percents of the total and cumulative percents by month
+    # of the Congress.
+    activity = [{ "x": year*12 + (month-1), "count": count, "year": year }
+        for (year, month), count in sorted(histogram.items())]
+    total = sum(m["count"] for m in activity)
+    for i, m in enumerate(activity): m["cumulative_count"] = m["count"]/float(total) + (0.0 if i==0 else activity[i-1]["cumulative_count"])
+    for m in activity: m["count"] = round(m["count"] / float(total) * 100.0, 1)
+    for m in activity: m["cumulative_count"] = round(m["cumulative_count"] * 100.0)
+    return activity
@@ -7,7 +7,7 @@ if __name__ == "__main__":
     sys.path.insert(0, ".env/lib/python2.7/site-packages")
     os.environ["DJANGO_SETTINGS_MODULE"] = 'settings'
 
-import datetime, lxml, os.path, re
+import collections, datetime, lxml, os.path, re, tempfile, threading
 
 bill_gpo_status_codes = {
     "ah": "Amendment",
@@ -178,79 +178,194 @@ def parse_usc_citation(cite):
         
     return { "type": "unknown", "text": cite.text }
 
+BILL_TEXT_MANIFEST_PATH = "data/congress/%d/bills/text-versions-manifest.json"
+BILL_TEXT_MANIFEST_RECHECK_INTERVAL = 300 # seconds
+
 def get_bill_text_versions(bill):
-    from os import listdir
-    d = bill.data_dir_path + "/text-versions"
-    if not os.path.exists(d):
-        return # don't yield anything, no text available
-    for st in listdir(d):
-        fn = bill.data_dir_path + "/text-versions/" + st + "/data.json"
-        if os.path.exists(fn):
-            yield st
+    from bill.models import BillType # has to be here and not module-level to avoid cyclic dependency
+    for st in get_bill_text_version_map(bill.congress, BillType.by_value(bill.bill_type), bill.number):
+        yield st
 
 def get_bill_text_metadata(bill, version):
     from bill.models import BillType # has to be here and not module-level to avoid cyclic dependency
-    import glob, json
 
-    bt = BillType.by_value(bill.bill_type).slug
-    basename = "data/congress/%d/bills/%s/%s%d/text-versions" % (bill.congress, bt, bt, bill.number)
-    
+    versions = get_bill_text_version_map(bill.congress, BillType.by_value(bill.bill_type), bill.number,
+        versions=[version] if version else None)
+
     if version == None:
-        # Cycle through files to find most recent version by date.
+        # Find the most recent version by date.
         dat = None
-        for versionfile in glob.glob(basename + "/*/data.json"):
-            d = json.load(open(versionfile))
+        for d in versions.values():
             if not dat or d["issued_on"] > dat["issued_on"]:
                 dat = d
         if not dat: return None
+    elif version in versions:
+        dat = versions[version]
     else:
-        dat = json.load(open(basename + "/%s/data.json" % version))
+        raise IOError("Bill text version %s is not available." % version)
 
-    # parse date
+    # copy so callers can't modify the cached manifest
+    dat = dict(dat)
 
+    # parse date
     dat["issued_on"] = datetime.date(*(int(d) for d in dat["issued_on"].split("-")))
 
-    # find content files
-        
-    basename += "/" + dat["version_code"]
-
-    bt2 = BillType.by_value(bill.bill_type).xml_code
-    html_fn = "data/congress-bill-text-legacy/%s/%s/%s%d%s.html" % (bill.congress, bt2, bt2, bill.number, dat["version_code"])
+    if dat.get("has_thumbnail"):
+        dat["thumbnail_path"] = bill.get_absolute_url() + "/_text_image"
 
-    if os.path.exists(basename + "/mods.xml"):
-        dat["mods_file"] = basename + "/mods.xml"
+    return dat
 
-    # get a plain text file if one exists
-    if os.path.exists(basename + "/document.txt"):
-        dat["text_file"] = basename + "/document.txt"
-        dat["has_displayable_text"] = True
+def get_bill_text_version_map(congress, bill_type, number, versions=None):
+    # Returns a dict from version codes to text version metadata. Use the
+    # Congress's manifest if one has been built, which avoids touching the
+    # filesystem entirely, otherwise scan the bill's text-versions directory.
+    manifest = load_bill_text_manifest(congress)
+    if manifest is not None:
+        return manifest.get("%s%d" % (bill_type.slug, number), { })
+    return scan_bill_text_versions(congress, bill_type, number, versions=versions)
+
+def scan_bill_text_versions(congress, bill_type, number, versions=None, legacy_files=None):
+    # Read the data.json file of each text version of the bill (or just those
+    # in versions) and see which document formats are available for each.
+    # Returns a dict from version codes to metadata. legacy_files, if given,
+    # is a set of the file names in the bill type's congress-bill-text-legacy
+    # directory, so that we don't have to stat those files one by one.
+    import json
+
+    bt = bill_type.slug
+    bt2 = bill_type.xml_code
+    basename = "data/congress/%d/bills/%s/%s%d/text-versions" % (congress, bt, bt, number)
+
+    if versions is None:
+        try:
+            versions = os.listdir(basename)
+        except OSError:
+            return { } # no text available
+
+    ret = { }
+    for version in versions:
+        try:
+            files = set(os.listdir(basename + "/" + version))
+        except OSError:
+            continue
+        if "data.json" not in files:
+            continue
+        d = json.load(open(basename + "/" + version + "/data.json"))
+
+        # Keep just the fields we use, since the manifest is held in memory.
+        dat = {
+            "issued_on": d["issued_on"],
+            "version_code": d["version_code"],
+            "urls": d.get("urls", { }),
+        }
+
+        # find content files
+
+        fn = basename + "/" + d["version_code"]
+
+        if "mods.xml" in files:
+            dat["mods_file"] = fn + "/mods.xml"
+
+        # get a plain text file if one exists
+        if "document.txt" in files:
+            dat["text_file"] = fn + "/document.txt"
+            dat["has_displayable_text"] = True
+
+            for source in d.get("sources", []):
+                if source["source"] == "statutes":
+                    dat["text_file_source"] = "statutes"
+
+        # get an HTML file if one exists
+        legacy_fn = "%s%d%s" % (bt2, number, d["version_code"])
+        legacy_dir = "data/congress-bill-text-legacy/%s/%s/" % (congress, bt2)
+        if (legacy_fn + ".html" in legacy_files) if legacy_files is not None else os.path.exists(legacy_dir + legacy_fn + ".html"):
+            dat["html_file"] = legacy_dir + legacy_fn + ".html"
+            dat["has_displayable_text"] = True
+
+        # get a PDF file if one exists (get_bill_text_metadata adds the thumbnail_path)
+        if (legacy_fn + ".pdf" in legacy_files) if legacy_files is not None else os.path.exists(legacy_dir + legacy_fn + ".pdf"):
+            dat["pdf_file"] = legacy_dir + legacy_fn + ".pdf"
+            dat["has_thumbnail"] = True
+
+        # get an XML file if one exists
+        if "catoxml.xml" in files:
+            dat["xml_file"] = fn + "/catoxml.xml"
+            dat["has_displayable_text"] = True
+            dat["xml_file_source"] = "cato-deepbills"
+        elif "document.xml" in files:
+            dat["xml_file"] = fn + "/document.xml"
+            dat["has_displayable_text"] = True
+
+        ret[version] = dat
 
-        for source in dat.get("sources", []):
-            if source["source"] == "statutes":
-                dat["text_file_source"] = "statutes"
+    return ret
 
-    # get an HTML file if one exists
-    if os.path.exists(html_fn):
-        dat["html_file"] = html_fn
-        dat["has_displayable_text"] = True
+def build_bill_text_manifest(congress):
+    # Scan the text versions of every bill in a Congress and write them to
+    # the Congress's manifest, which get_bill_text_metadata then uses instead
+    # of the filesystem. Returns the number of bills with text, or None if
+    # we have no bill data for the Congress.
+    from bill.models import BillType # has to be here and not module-level to avoid cyclic dependency
+    import glob, json
 
-    # get a PDF file if one exists
-    pdf_fn = "data/congress-bill-text-legacy/%s/%s/%s%d%s.pdf" % (bill.congress, bt2, bt2, bill.number, dat["version_code"])
-    if os.path.exists(pdf_fn):
-        dat["pdf_file"] = pdf_fn
-        dat["has_thumbnail"] = True
-        dat["thumbnail_path"] = bill.get_absolute_url() + "/_text_image"
+    if not os.path.exists("data/congress/%d/bills" % congress):
+        return None
 
-    # get an XML file if one exists
-    if os.path.exists(basename + "/catoxml.xml"):
-        dat["xml_file"] = basename + "/catoxml.xml"
-        dat["has_displayable_text"] = True
-        dat["xml_file_source"] = "cato-deepbills"
-    elif os.path.exists(basename + "/document.xml"):
-        dat["xml_file"] = basename + "/document.xml"
-        dat["has_displayable_text"] = True
+    manifest = { }
+    legacy_files = { }
+    for d in glob.glob("data/congress/%d/bills/*/*/text-versions" % congress):
+        bt, number = re.search(r"/bills/([a-z]+)/[a-z]+(\d+)/text-versions$", d).groups()
+        bill_type = BillType.by_slug(bt)
+        if bill_type.xml_code not in legacy_files:
+            try:
+                legacy_files[bill_type.xml_code] = set(os.listdir("data/congress-bill-text-legacy/%d/%s" % (congress, bill_type.xml_code)))
+            except OSError:
+                legacy_files[bill_type.xml_code] = set()
+        versions = scan_bill_text_versions(congress, bill_type, int(number), legacy_files=legacy_files[bill_type.xml_code])
+        if versions:
+            manifest["%s%d" % (bt, int(number))] = versions
+
+    # Write atomically so that readers never see a partial file.
+    fn = BILL_TEXT_MANIFEST_PATH % congress
+    fd, temp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.chmod(temp_fn, 0644) # mkstemp makes it readable only by us
+    os.rename(temp_fn, fn)
+
+    _bill_text_manifests.pop(congress, None)
+
+    return len(manifest)
+
+_bill_text_manifests = { } # congress => (time checked, file mtime, manifest or None)
+
+def load_bill_text_manifest(congress):
+    # Returns the Congress's bill text manifest, or None if one hasn't been
+    # built. The manifest is loaded once per process, and we check whether it
+    # has been rebuilt at most once every BILL_TEXT_MANIFEST_RECHECK_INTERVAL
+    # seconds.
+    import json, time
+
+    now = time.time()
+    entry = _bill_text_manifests.get(congress)
+    if entry and now - entry[0] < BILL_TEXT_MANIFEST_RECHECK_INTERVAL:
+        return entry[2]
+
+    fn = BILL_TEXT_MANIFEST_PATH % congress
+    try:
+        mtime = os.path.getmtime(fn)
+    except OSError:
+        mtime = None
+
+    if entry and entry[1] == mtime:
+        manifest = entry[2]
+    elif mtime is None:
+        manifest = None
+    else:
+        manifest = json.load(open(fn))
 
-    return dat
+    _bill_text_manifests[congress] = (now, mtime, manifest)
+    return manifest
         
 def load_bill_text(bill, version, plain_text=False, mods_only=False, with_citations=False):
     # Load bill text info from the Congress project data directory.
@@ -306,10 +421,9 @@ def load_bill_text(bill, version, plain_text=False, mods_only=False, with_citati
         return ret
 
     if "xml_file" in dat and not plain_text:
-        # convert XML on the fly to HTML
-        import lxml.html, congressxml
+        # convert XML to HTML, or get it from the cache
         ret.update({
-            "text_html": lxml.html.tostring(congressxml.convert_xml(dat["xml_file"])),
+            "text_html": get_bill_text_html(dat["xml_file"]),
             "source": dat.get("xml_file_source"),
         })
 
@@ -349,6 +463,69 @@ def load_bill_text(bill, version, plain_text=False, mods_only=False, with_citati
 
     return ret
 
+BILL_TEXT_HTML_CONVERTER_VERSION = 1
+BILL_TEXT_HTML_CACHE_DIR = "data/cache/bill-text-html"
+
+BILL_TEXT_HTML_CHECKSUM_CACHE_SIZE = 5000 # source files whose checksums are remembered in each process
+
+_source_checksums = collections.OrderedDict() # filename => ((size, mtime), checksum), least recently used first
+_source_checksums_lock = threading.Lock()
+
+def bill_text_html_checksum(xml_file):
+    # The cache is content-addressed: the key is a hash of the source XML and
+    # the converter version, so a cached file never goes stale. Hash the file
+    # in chunks so memory use doesn't grow with the size of the bill, and
+    # remember the hash for as long as the file is unchanged on disk.
+    import hashlib
+    st = os.stat(xml_file)
+    stamp = (st.st_size, st.st_mtime)
+    with _source_checksums_lock:
+        entry = _source_checksums.pop(xml_file, None)
+    if entry is None or entry[0] != stamp:
+        h = hashlib.sha1()
+        h.update("congressxml-%d\n" % BILL_TEXT_HTML_CONVERTER_VERSION)
+        with open(xml_file, "rb") as f:
+            while True:
+                chunk = f.read(1024*1024)
+                if not chunk: break
+                h.update(chunk)
+        entry = (stamp, h.hexdigest())
+    with _source_checksums_lock:
+        _source_checksums[xml_file] = entry
+        while len(_source_checksums) > BILL_TEXT_HTML_CHECKSUM_CACHE_SIZE:
+            _source_checksums.popitem(last=False)
+    return entry[1]
+
+def bill_text_html_filename(checksum):
+    return os.path.join(BILL_TEXT_HTML_CACHE_DIR, checksum[0:2], checksum + ".html")
+
+def get_bill_text_html(xml_file, prerender=False):
+    # Returns the HTML rendering of a bill text XML file, converting it with
+    # congressxml and caching the result if it isn't already cached. With
+    # prerender=True, just makes sure the cache is populated and returns
+    # whether a conversion was needed.
+    fn = bill_text_html_filename(bill_text_html_checksum(xml_file))
+    if os.path.exists(fn):
+        if prerender: return False
+        with open(fn, "rb") as f:
+            return f.read()
+
+    import lxml.html, congressxml
+    html = lxml.html.tostring(congressxml.convert_xml(xml_file))
+
+    try:
+        os.makedirs(os.path.dirname(fn))
+    except OSError:
+        pass # already exists, possibly made by another process just now
+    fd, temp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(html)
+    os.chmod(temp_fn, 0644) # mkstemp makes it readable only by us
+    os.rename(temp_fn, fn) # atomically, since other processes and threads may read it
+
+    if prerender: return True
+    return html
+
 def load_citation_info(metadata):
     if "citations" not in metadata: return
 
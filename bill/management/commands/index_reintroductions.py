@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from bill.models import Bill
+
+class Command(BaseCommand):
+	args = '[congress ...]'
+	help = 'Sets the reintroduction keys of bills (in the given Congresses, or all bills), which are normally set as bills are saved.'
+	
+	def handle(self, *args, **options):
+		bills = Bill.objects.all()
+		if args:
+			bills = bills.filter(congress__in=[int(c) for c in args])
+		
+		updated = 0
+		bill_ids = list(bills.values_list("id", flat=True))
+		for i in xrange(0, len(bill_ids), 1000):
+			for bill in Bill.objects.filter(id__in=bill_ids[i:i+1000]):
+				key = bill.get_reintroduction_key()
+				if key != bill.reintroduction_key:
+					Bill.objects.filter(id=bill.id).update(reintroduction_key=key)
+					updated += 1
+		print "Updated %d bills." % updated
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from optparse import make_option
+
+from bill.models import Bill
+
+from website.util import map_chunks_in_pool
+
+import time
+
+class Command(BaseCommand):
+	args = '[congress]'
+	help = 'Converts the XML text of the bills in a Congress (the current Congress by default) to HTML and caches it for the bill text pages.'
+	option_list = BaseCommand.option_list + (
+		make_option('--workers', type='int', default=4,
+			help='The number of processes to convert bill text with.'),
+		)
+
+	def handle(self, *args, **options):
+		congress = int(args[0]) if len(args) > 0 else settings.CURRENT_CONGRESS
+		bill_ids = list(Bill.objects.filter(congress=congress).values_list("id", flat=True))
+
+		t0 = time.time()
+		rendered = sum(map_chunks_in_pool(render_bills, bill_ids, options["workers"], desc="Bills"))
+
+		print "Checked %d bills, converted %d text versions in %d seconds." % (len(bill_ids), rendered, time.time()-t0)
+
+def render_bills(bill_ids):
+	from bill.billtext import get_bill_text_versions, get_bill_text_metadata, get_bill_text_html
+	rendered = 0
+	for bill in Bill.objects.filter(id__in=bill_ids):
+		for version in get_bill_text_versions(bill):
+			dat = get_bill_text_metadata(bill, version)
+			if "xml_file" in dat and get_bill_text_html(dat["xml_file"], prerender=True):
+				rendered += 1
+	return rendered
@@ -14,7 +14,7 @@ from us import get_congress_dates, get_session_from_date
 
 from django.conf import settings
 
-import datetime, os.path, re, urlparse, markdown2
+import datetime, os.path, re, urlparse, markdown2, hashlib
 from lxml import etree
 
 "Enums"
@@ -141,6 +141,8 @@ class Bill(models.Model):
     docs_house_gov_postdate = models.DateTimeField(blank=True, null=True, help_text="The date on which the bill was posted to http://docs.house.gov (which is different from the date it was expected to be debated).")
     senate_floor_schedule_postdate = models.DateTimeField(blank=True, null=True, help_text="The date on which the bill was posted on the Senate Floor Schedule (which is different from the date it was expected to be debated).")
     major_actions = JSONField(default=[]) # serialized list of all major actions (date/datetime, BillStatus, description)
+    major_actions_timeline = JSONField(blank=True, null=True) # major_actions pre-parsed by build_major_actions_timeline
+    reintroduction_key = models.CharField(max_length=40, blank=True, null=True, db_index=True) # see get_reintroduction_key
 
     sliplawpubpriv = models.CharField(max_length=3, choices=[("PUB", "Public"), ("PRI", "Private")], blank=True, null=True, help_text="For enacted laws, whether the law is a public (PUB) or private (PRI) law. Unique with congress and sliplawnum.")
     sliplawnum = models.IntegerField(blank=True, null=True, help_text="For enacted laws, the slip law number (i.e. the law number in P.L. XXX-123). Unique with congress and sliplawpublpriv.")
@@ -164,6 +166,12 @@ class Bill(models.Model):
     def __unicode__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        # Keep the reintroduction key in sync with the sponsor and title,
+        # including titles overridden by hand (lock_title) in the admin.
+        self.reintroduction_key = self.get_reintroduction_key()
+        super(Bill, self).save(*args, **kwargs)
+
     @staticmethod
     def from_congressproject_id(bill_id):
         m = re.match("^([a-z]+)(\d+)-(\d+)$", bill_id)
@@ -490,8 +498,9 @@ class Bill(models.Model):
             E.add("state:" + str(BillStatus.introduced), self.introduced_date, index_feeds + [Bill.ActiveBillsFeed(), Bill.IntroducedBillsFeed()])
             common_feeds = [Bill.ActiveBillsFeed(), Bill.ActiveBillsExceptIntroductionsFeed()]
             enacted_feed = [Bill.EnactedBillsFeed()]
-            for datestr, state, text, srcxml in self.major_actions:
-                date = eval(datestr)
+            for action in self.get_major_actions_timeline():
+                date = parse_timeline_date(action["date"])
+                state = action["status"]
                 if state == BillStatus.introduced:
                     continue # already indexed
                 if state == BillStatus.referred and (date.date() - self.introduced_date).days == 0:
@@ -566,10 +575,10 @@ class Bill(models.Model):
         if status == BillStatus.introduced:
             action_type = "introduced"
         else:
-            for datestr, st, text, srcxml in self.major_actions:
-                if st == status:
-                    date = eval(datestr)
-                    action = text
+            for axn in self.get_major_actions_timeline():
+                if axn["status"] == status:
+                    date = parse_timeline_date(axn["date"])
+                    action = axn["text"]
                     break
             else:
                 raise Exception("Invalid %s event in %s." % (status, str(self)))
@@ -752,27 +761,80 @@ The {{noun}} now has {{cumulative_cosp_count}} cosponsor{{cumulative_cosp_count|
             "context": { "summary": bs },
             }
 
-    def get_major_events(self, top=True):
-        if self.congress < 93: return []
-        ret = []
-        saw_intro = False
+    def build_major_actions_timeline(self):
+        """Pre-parses major_actions into a list of dicts holding the action's date
+        (in ISO format), status, and text, the where/type/how/roll attributes of the
+        action's XML node, and for roll call votes the key and (if the vote has been
+        loaded) id of the vote. Stored in major_actions_timeline by the bill parser
+        so that showing a bill's timeline needs no XML parsing or per-action queries."""
+        from vote.models import Vote, CongressChamber
+        timeline = []
         for datestr, st, text, srcxml in self.major_actions:
             date = eval(datestr)
             srcnode = etree.fromstring(srcxml) if srcxml else None
+            axn = { "date": date.isoformat(), "status": st, "text": text }
+            if srcnode is not None:
+                for attr in ("where", "type", "how", "roll"):
+                    if srcnode.get(attr) is not None:
+                        axn[attr] = srcnode.get(attr)
+                if axn.get("where") in ("h", "s") and axn.get("type") in ("vote", "vote2", "pingpong", "conference") and axn.get("how") == "roll":
+                    session = get_session_from_date(date, congress=self.congress)
+                    if session:
+                        axn["vote_key"] = [session[1], axn["where"], int(axn["roll"])]
+                        try:
+                            axn["vote_id"] = Vote.objects.get(congress=self.congress, session=session[1],
+                                chamber=CongressChamber.senate if axn["where"] == 's' else CongressChamber.house,
+                                number=int(axn["roll"])).id
+                        except Vote.DoesNotExist:
+                            pass # not loaded yet, looked up by key when needed
+            timeline.append(axn)
+        return timeline
+
+    def get_major_actions_timeline(self):
+        if self.major_actions_timeline is None:
+            # Not stored yet for this bill.
+            return self.build_major_actions_timeline()
+        return self.major_actions_timeline
+
+    def get_major_events(self, top=True, votes=None):
+        # votes is a dict of Vote instances, loaded by load_timeline_votes, that
+        # the top-level call shares with the calls for related bills.
+        if self.congress < 93: return []
+
+        related_bills = []
+        if top:
+            got_rb = set()
+            for relation_name, relation_types in (
+              ("Companion Bill", ("identical",)),
+              ("Alternative Bill", ("supersedes", "includes")),
+              ("Rules Change", ("rule","caused-action"))):
+                for rb in self.relatedbills.filter(relation__in=relation_types).select_related("related_bill"):
+                    if rb.related_bill in got_rb: continue
+                    got_rb.add(rb.related_bill)
+                    related_bills.append((relation_name, rb.related_bill))
+        if votes is None:
+            votes = load_timeline_votes([self] + [b for r, b in related_bills])
+
+        ret = []
+        saw_intro = False
+        for axn in self.get_major_actions_timeline():
+            date = parse_timeline_date(axn["date"])
+            st = axn["status"]
+            text = axn["text"]
 
             st_key = BillStatus.by_value(st).key
             explanation = BillStatus.by_value(st).explanation
             if callable(explanation): explanation = explanation(self)
 
             if st == BillStatus.referred: continue # don't care about this
-            if st in (BillStatus.passed_bill, BillStatus.passed_concurrentres) and srcnode is not None and srcnode.get("where") in ("h", "s") and srcnode.get("type") in ("vote2", "pingpong", "conference"):
-                ch = {"h":"House","s":"Senate"}[srcnode.get("where")]
+            if st in (BillStatus.passed_bill, BillStatus.passed_concurrentres) and axn.get("where") in ("h", "s") and axn.get("type") in ("vote2", "pingpong", "conference"):
+                ch = {"h":"House","s":"Senate"}[axn["where"]]
                 # PASSED:BILL only occurs on the second chamber, so indicate both agreed to in text
-                if srcnode.get("type") == "vote2":
+                if axn["type"] == "vote2":
                     st = ("Passed %s" % ch)
-                elif srcnode.get("type") == "pingpong":
+                elif axn["type"] == "pingpong":
                     st = ("%s Agreed to Changes" % ch)
-                elif srcnode.get("type") == "conference":
+                elif axn["type"] == "conference":
                     st = ("Conference Report Agreed to by %s" % ch)
             else:
                 if st == BillStatus.introduced: saw_intro = True
@@ -784,22 +846,16 @@ The {{noun}} now has {{cumulative_cosp_count}} cosponsor{{cumulative_cosp_count|
 
             vote_text = None
             vote_link = None
-            if srcnode and srcnode.get("where") in ("h", "s") and srcnode.get("type") in ("vote", "vote2", "pingpong", "conference"):
-                if srcnode.get("how") == "roll":
-                    try:
-                        from vote.models import Vote, CongressChamber, VoteSource
-                        v = Vote.objects.get(congress=self.congress, session=get_session_from_date(date, congress=self.congress)[1],
-	                        chamber=CongressChamber.senate if srcnode.get("where") == 's' else CongressChamber.house,
-                            number=int(srcnode.get("roll")))
-                        if v.source != VoteSource.keithpoole:
-                            # The numbering of votes does not apply in the voteview data.
-                            vote_link = v.get_absolute_url()
-                    except Vote.DoesNotExist:
-                        # Somehow the vote is missing.
-                        pass
+            if axn.get("where") in ("h", "s") and axn.get("type") in ("vote", "vote2", "pingpong", "conference"):
+                if axn.get("how") == "roll":
+                    from vote.models import VoteSource
+                    v = get_timeline_vote(votes, self.congress, axn)
+                    # Somehow the vote may be missing. The numbering of votes does not apply in the voteview data.
+                    if v is not None and v.source != VoteSource.keithpoole:
+                        vote_link = v.get_absolute_url()
                 else:
-                    if srcnode.get("how") != "(method not recorded)":
-                        vote_text = srcnode.get("how")
+                    if axn.get("how") != "(method not recorded)":
+                        vote_text = axn.get("how")
 
             ret.append({
                 "key": st_key,
@@ -818,20 +874,12 @@ The {{noun}} now has {{cumulative_cosp_count}} cosponsor{{cumulative_cosp_count|
             if self.senate_floor_schedule_postdate: ret.append({ "key": "schedule_senate","label": "On Senate Schedule", "date": self.senate_floor_schedule_postdate, "explanation": "The Senate indicated that this %s would be considered in the days ahead." % self.noun })
 
         # Bring in really-major events on identical bills.
-        if top:
-            got_rb = set()
-            for relation_name, relation_types in (
-              ("Companion Bill", ("identical",)),
-              ("Alternative Bill", ("supersedes", "includes")),
-              ("Rules Change", ("rule","caused-action"))):
-                for rb in self.relatedbills.filter(relation__in=relation_types).select_related("related_bill"):
-                    if rb.related_bill in got_rb: continue
-                    got_rb.add(rb.related_bill)
-                    for e in rb.related_bill.get_major_events(top=False):
-                        if e["key"] in ("introduced", "reported"): continue
-                        e["relation"] = relation_name
-                        e["bill"] = rb.related_bill
-                        ret.append(e)
+        for relation_name, related_bill in related_bills:
+            for e in related_bill.get_major_events(top=False, votes=votes):
+                if e["key"] in ("introduced", "reported"): continue
+                e["relation"] = relation_name
+                e["bill"] = related_bill
+                ret.append(e)
 
         # Sort the entries by date. Stable sort for time-less dates.
         def as_dt(x):
@@ -1002,12 +1050,18 @@ The {{noun}} now has {{cumulative_cosp_count}} cosponsor{{cumulative_cosp_count|
             if self.title_no_number == rb.related_bill.title_no_number
             and rb.related_bill.current_status_date > self.current_status_date]
 
+    def get_reintroduction_key(self):
+        # A hash of the sponsor and the title with anything that looks like a year
+        # removed. Bills in other Congresses with the same key are reintroductions
+        # of this bill. Stored in reintroduction_key when the bill is saved.
+        if self.sponsor_id == None: return None
+        title = re.sub(r"of \d\d\d\d$", "", self.title_no_number)
+        return hashlib.sha1((u"%d|%s" % (self.sponsor_id, title)).encode("utf8")).hexdigest()
+
     def find_reintroductions(self):
-        if self.sponsor == None: return
-        def normalize_title(title): # remove anything that looks like a year
-            return re.sub(r"of \d\d\d\d$", "", title)
-        for reintro in Bill.objects.exclude(congress=self.congress).filter(sponsor=self.sponsor).order_by('congress'):
-            if normalize_title(self.title_no_number) != normalize_title(reintro.title_no_number): continue
+        if self.sponsor_id == None: return
+        key = self.reintroduction_key or self.get_reintroduction_key()
+        for reintro in Bill.objects.exclude(congress=self.congress).filter(reintroduction_key=key).order_by('congress'):
             yield reintro
 
     def was_enacted_ex(self, recurse=True, restrict_to_activity_in_date_range=None):
@@ -1094,6 +1148,51 @@ The {{noun}} now has {{cumulative_cosp_count}} cosponsor{{cumulative_cosp_count|
             if ret["text"]: break
         return ret
 
+def parse_timeline_date(value):
+    # Parses a date or datetime stored in ISO format in a major actions timeline.
+    if "T" not in value:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    if "." in value:
+        return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+    return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+
+def load_timeline_votes(bills):
+    """Loads the Vote instances for the roll call actions in the major actions
+    timelines of the bills in at most two queries, one for votes whose ids were
+    resolved when the timeline was built and one for the rest, including those
+    whose stored id no longer exists (e.g. the vote was deleted and reloaded).
+    Returns a dict for get_timeline_vote."""
+    from vote.models import Vote, CongressChamber
+    from django.db.models import Q
+    ids = { } # vote id => key, or None
+    keys = set()
+    for bill in bills:
+        for axn in bill.get_major_actions_timeline():
+            key = (bill.congress,) + tuple(axn["vote_key"]) if axn.get("vote_key") else None
+            if axn.get("vote_id"):
+                ids[axn["vote_id"]] = key
+            elif key:
+                keys.add(key)
+    votes = Vote.objects.in_bulk(list(ids)) if ids else { }
+    keys |= set(key for vote_id, key in ids.items() if key and vote_id not in votes)
+    if keys:
+        q = Q(id=None)
+        for congress, session, where, number in keys:
+            q |= Q(congress=congress, session=session, number=number,
+                chamber=CongressChamber.senate if where == 's' else CongressChamber.house)
+        for v in Vote.objects.filter(q):
+            votes[(v.congress, v.session, 's' if v.chamber == CongressChamber.senate else 'h', v.number)] = v
+    return votes
+
+def get_timeline_vote(votes, congress, axn):
+    # Returns the Vote for a roll call action from the dict returned by
+    # load_timeline_votes, or None if the vote is missing.
+    if axn.get("vote_id") in votes:
+        return votes[axn["vote_id"]]
+    if axn.get("vote_key"):
+        return votes.get((congress,) + tuple(axn["vote_key"]))
+    return None
+
 class RelatedBill(models.Model):
     bill = models.ForeignKey(Bill, related_name="relatedbills")
     related_bill = models.ForeignKey(Bill, related_name="relatedtobills")
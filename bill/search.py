@@ -124,6 +124,9 @@ def bill_search_manager():
     sm.add_option('terms2', type="select", label="subject 2", choices=sub_terms, visible_if=lambda post:"terms" in post, filter=sub_term_filter)
     sm.add_option('sponsor_party', label="party of sponsor", type="select")
     sm.add_option('bill_type', label="bill or resolution type")
+
+    # Facet counts for congress, sponsor, status, etc. come from memory.
+    sm.use_facet_index()
     
     #sm.add_sort("Popularity", "-total_bets", default=True)
     sm.add_sort("Secret Sauce", "-proscore", default=True)
@@ -5,7 +5,7 @@ from django.http import Http404, HttpResponseRedirect, HttpResponse
 from django.conf import settings
 from django.contrib.humanize.templatetags.humanize import ordinal
 from django.contrib.auth.decorators import login_required
-from django.db.models import Count, F
+from django.db.models import F
 from django.core.cache import cache
 
 from common.decorators import render_to
@@ -13,6 +13,7 @@ from common.pagination import paginate
 
 from bill.models import Bill, BillType, BillStatus, BillTerm, TermType, BillTextComparison, BillSummary
 from bill.search import bill_search_manager, parse_bill_citation
+from bill.aggregates import get_bill_aggregates, get_top_bills, get_activity_by_month
 from bill.title import get_secondary_bill_title
 from committee.util import sort_members
 from person.models import Person
@@ -454,9 +455,6 @@ bill_status_groups = [
         (BillStatus.introduced, BillStatus.referred, BillStatus.reported)), # 3
 ]
 
-def load_bill_status_qs(statuses, congress=CURRENT_CONGRESS):
-    return Bill.objects.filter(congress=congress, current_status__in=statuses)
-
 @anonymous_view
 @render_to('bill/bill_docket.html')
 def bill_docket(request):
@@ -464,16 +462,23 @@ def bill_docket(request):
         # feeds about all legislation that we offer the user to subscribe to
         feeds = [f for f in Feed.get_simple_feeds() if f.category == "federal-bills"]
 
+        # The counts and top bills come from the materialized aggregates. Load
+        # the bills shown on the page in one query.
+        aggregates = get_bill_aggregates()
+        status_counts = aggregates["status_counts"].get(CURRENT_CONGRESS, { })
+        top_bill_ids = [get_top_bills(aggregates, g[4]) for g in bill_status_groups]
+        bills = Bill.objects.in_bulk(sum(top_bill_ids, []) + [bill_id for bill_id, count in aggregates["top_tracked"]])
+
         # info about bills by status
         groups = [
             (   g[0], # title
                 g[1], # text 1
                 g[2], # text 2
                 "/congress/bills/browse?status=" + ",".join(str(s) for s in g[4]) + "&sort=-current_status_date", # link
-               load_bill_status_qs(g[4]).count(), # count in category
-               load_bill_status_qs(g[4]).order_by('-current_status_date')[0:6], # top 6 in this category
+               sum(status_counts.get(s, 0) for s in g[4]), # count in category
+               [bills[bill_id] for bill_id in ids if bill_id in bills], # top 6 in this category
                 )
-            for g in bill_status_groups ]
+            for g, ids in zip(bill_status_groups, top_bill_ids) ]
 
         # legislation coming up
         dhg_bills = Bill.objects.filter(congress=CURRENT_CONGRESS, docs_house_gov_postdate__gt=datetime.datetime.now() - datetime.timedelta(days=10)).filter(docs_house_gov_postdate__gt=F('current_status_date'))
@@ -482,15 +487,7 @@ def bill_docket(request):
         coming_up.sort(key = lambda b : b.docs_house_gov_postdate if (b.docs_house_gov_postdate and (not b.senate_floor_schedule_postdate or b.senate_floor_schedule_postdate < b.docs_house_gov_postdate)) else b.senate_floor_schedule_postdate, reverse=True)
 
         # top tracked bills
-        top_bills = Feed.objects\
-            .filter(feedname__startswith='bill:')\
-            .filter(feedname__regex='^bill:[hs][jcr]?%d-' % CURRENT_CONGRESS)
-        top_bills = top_bills\
-            .annotate(count=Count('tracked_in_lists'))\
-            .order_by('-count')\
-            .values('feedname', 'count')\
-            [0:25]
-        top_bills = [(Bill.from_feed(Feed.from_name(bf["feedname"])), bf["count"]) for bf in top_bills]
+        top_bills = [(bills[bill_id], count) for bill_id, count in aggregates["top_tracked"] if bill_id in bills]
 
         # current congrss years
         start, end = get_congress_dates(CURRENT_CONGRESS)
@@ -501,7 +498,7 @@ def bill_docket(request):
         return {
             "feeds": feeds,
 
-            "total": Bill.objects.filter(congress=CURRENT_CONGRESS).count(),
+            "total": sum(status_counts.values()),
             "current_congress_years": current_congress_years,
             "current_congress": current_congress,
 
@@ -523,10 +520,13 @@ def bill_docket(request):
 @anonymous_view
 @render_to('bill/bill_statistics.html')
 def bill_statistics(request):
+    aggregates = get_bill_aggregates()
+
     # Get the count of bills by status and by Congress.
     counts_by_congress = []
     for c in xrange(93, CURRENT_CONGRESS+1):
-        total = Bill.objects.filter(congress=c).count()
+        status_counts = aggregates["status_counts"].get(c, { })
+        total = sum(status_counts.values())
         if total == 0: continue # during transitions between Congresses
         counts_by_congress.append({
             "congress": c,
@@ -535,7 +535,7 @@ def bill_statistics(request):
             "total": total,
         })
         for g in bill_status_groups:
-            t = load_bill_status_qs(g[4], congress=c).count()
+            t = sum(status_counts.get(s, 0) for s in g[4])
             counts_by_congress[-1]["counts"].append(
                 { "count": t,
                   "percent": "%0.0f" % float(100.0*t/total),
@@ -544,22 +544,8 @@ def bill_statistics(request):
     counts_by_congress.reverse()
 
     # When does activity occur within the session cycle?
-    if settings.DATABASES['default']['ENGINE'] != 'django.db.backends.sqlite3':
-        from django.db import connection
-        def pull_time_stat(field, where, cursor):
-            cursor.execute("SELECT YEAR(%s) - congress*2 - 1787, MONTH(%s), COUNT(*) FROM bill_bill WHERE congress >= 93 AND %s GROUP BY YEAR(%s) - congress*2, MONTH(%s)" % (field, field, where, field, field))
-            activity = [{ "x": r[0]*12 + (r[1]-1), "count": r[2], "year": r[0] } for r in cursor.fetchall()]
-            total = sum(m["count"] for m in activity)
-            for i, m in enumerate(activity): m["cumulative_count"] = m["count"]/float(total) + (0.0 if i==0 else activity[i-1]["cumulative_count"])
-            for m in activity: m["count"] = round(m["count"] / float(total) * 100.0, 1)
-            for m in activity: m["cumulative_count"] = round(m["cumulative_count"] * 100.0)
-            return activity
-        with connection.cursor() as cursor:
-            activity_introduced_by_month = pull_time_stat('introduced_date', "1", cursor)
-            activity_enacted_by_month = pull_time_stat('current_status_date', "current_status IN (%d,%d,%d)" % (int(BillStatus.enacted_signed), int(BillStatus.enacted_veto_override), int(BillStatus.enacted_tendayrule)), cursor)
-    else:
-        activity_introduced_by_month = []
-        activity_enacted_by_month = []
+    activity_introduced_by_month = get_activity_by_month(aggregates["introduced_by_month"])
+    activity_enacted_by_month = get_activity_by_month(aggregates["enacted_by_month"])
 
     return {
         "groups2": bill_status_groups,
@@ -20,6 +20,14 @@ now = datetime.now()
 class Command(BaseCommand):
 	args = 'daily|weekly|testadmin|testcount'
 	help = 'Sends out email updates of events to subscribing users.'
+	option_list = BaseCommand.option_list + (
+		make_option('--pipeline', action='store_true', default=False,
+			help='Load events, subscription lists, and ping/bounce status up front and send from a pool of worker processes.'),
+		make_option('--workers', type='int', default=4,
+			help='The number of worker processes to send email with in --pipeline mode.'),
+		make_option('--watermark',
+			help='In --pipeline mode, a file to record the highest user id processed so far in, so an interrupted run can be resumed.'),
+		)
 	
 	def handle(self, *args, **options):
 		if len(args) != 1 or args[0] not in ('daily', 'weekly', 'testadmin', 'testcount'):
@@ -95,6 +103,10 @@ class Command(BaseCommand):
 		if os.environ.get("START"):
 			users = users.filter(id__gte=int(os.environ["START"]))
 				#, id__lt=169660)
+
+		if options["pipeline"] and args[0] != "testadmin":
+			run_pipeline(users, list_email_freq, back_days, send_mail, mark_lists, options)
+			return
 			
 		total_emails_sent = 0
 		total_events_sent = 0
@@ -142,7 +154,9 @@ class Command(BaseCommand):
 		print total_users_skipped_stale, "users skipped because they are stale"
 		print total_users_skipped_bounced, "users skipped because of a bounced email"
 			
-def send_email_update(user, list_email_freq, send_mail, mark_lists, send_old_events):
+def send_email_update(user, list_email_freq, send_mail, mark_lists, send_old_events, pipeline=None):
+	# pipeline is a PipelineData when called from run_pipeline, in which case the user's
+	# subscription lists, new events, and ping status are taken from it rather than queried.
 	global now
 	
 	# get the email's From: header and return path
@@ -157,7 +171,7 @@ def send_email_update(user, list_email_freq, send_mail, mark_lists, send_old_eve
 	eventslists = []
 	most_recent_event = None
 	eventcount = 0
-	for sublist in user.subscription_lists.all():
+	for sublist in (pipeline.sublists.get(user.id, []) if pipeline else user.subscription_lists.all()):
 		# Get a list of all of the trackers this user has in all lists. We use the
 		# complete list, even in non-email-update-lists, for rendering events.
 		all_trackers |= set(sublist.trackers.all())
@@ -170,7 +184,7 @@ def send_email_update(user, list_email_freq, send_mail, mark_lists, send_old_eve
 		if send_old_events: sublist.last_event_mailed = None
 
 		# Get any new events to email the user about.
-		max_id, events = sublist.get_new_events()
+		max_id, events = pipeline.index.get_new_events(sublist) if pipeline else sublist.get_new_events()
 		if len(events) > 0:
 			eventslists.append( (sublist, events) )
 			eventcount += len(events)
@@ -188,8 +202,12 @@ def send_email_update(user, list_email_freq, send_mail, mark_lists, send_old_eve
 	# email addresses are still valid, for folks that have not logged in recently
 	# and did not successfully recently ping back.
 	emailpingurl = None
+	if pipeline:
+		recently_pinged = pipeline.pings.get(user.id) is not None and pipeline.pings[user.id] > datetime.now() - timedelta(days=60)
+	else:
+		recently_pinged = Ping.objects.filter(user=user, pingtime__gt=datetime.now() - timedelta(days=60)).exists()
 	if user.last_login < datetime.now() - timedelta(days=60) \
-		and not Ping.objects.filter(user=user, pingtime__gt=datetime.now() - timedelta(days=60)).exists():
+		and not recently_pinged:
 		emailpingurl = Ping.get_ping_url(user)
 		
 	# get announcement content
@@ -232,6 +250,104 @@ def send_email_update(user, list_email_freq, send_mail, mark_lists, send_old_eve
 		
 	return eventcount # did sent email
 
+# Pipeline mode.
+#
+# Rather than querying each user's pings, bounces, subscription lists and new events one
+# at a time, load all of that up front (a few queries in total) into module-level data that
+# forked worker processes inherit, then render and send the emails from a process pool.
+
+class PipelineData(object):
+	def __init__(self, users, back_days, list_email_freq):
+		if sys.stdout.isatty(): print "Loading recent events..."
+		self.index = NewEventsIndex(datetime.now() - timedelta(days=back_days))
+
+		if sys.stdout.isatty(): print "Loading subscription lists..."
+		self.sublists = { }
+		sublists = list(SubscriptionList.objects.filter(user__in=users).prefetch_related("trackers"))
+		for sublist in sublists:
+			self.sublists.setdefault(sublist.user_id, []).append(sublist)
+		self.index.fix_last_event_mailed([s for s in sublists if s.email in list_email_freq])
+
+		if sys.stdout.isatty(): print "Loading ping and bounce status..."
+		self.pings = dict(Ping.objects.filter(user__in=users).values_list("user_id", "pingtime"))
+		self.bounced = set(BouncedEmail.objects.filter(user__in=users).values_list("user_id", flat=True))
+
+pipeline_data = None
+
+def pipeline_worker_init():
+	# Each worker must open its own database connection.
+	from django.db import connection
+	connection.close()
+
+def pipeline_send_chunk(args):
+	user_ids, list_email_freq, send_mail, mark_lists = args
+	stats = { "emails": 0, "events": 0, "stale": 0, "bounced": 0 }
+	for user in User.objects.filter(id__in=user_ids).only("id", "email", "last_login").order_by('id'):
+		ping = pipeline_data.pings.get(user.id, False) # False means no Ping record
+		if user.last_login < datetime(2009, 4, 1) and ping is False:
+			# See the same check in handle().
+			stats["stale"] += 1
+			continue
+		elif user.last_login < datetime.now() - timedelta(days=3) \
+			and (not ping or ping < datetime.now() - timedelta(days=20)) \
+			and user.id in pipeline_data.bounced:
+			stats["bounced"] += 1
+			continue
+
+		events_sent = send_email_update(user, list_email_freq, send_mail, mark_lists, False, pipeline=pipeline_data)
+		if events_sent != None:
+			stats["emails"] += 1
+			stats["events"] += events_sent
+
+		from django import db
+		db.reset_queries()
+	return max(user_ids), stats
+
+def run_pipeline(users, list_email_freq, back_days, send_mail, mark_lists, options, chunk_size=100):
+	global pipeline_data
+	import multiprocessing
+	from django.db import connection
+
+	# Resume after the last user processed by an interrupted run.
+	watermark = options.get("watermark")
+	if watermark and os.path.exists(watermark):
+		start_after = int(open(watermark).read())
+		print "Resuming after user", start_after
+		users = users.filter(id__gt=start_after)
+
+	user_ids = list(users.values_list("id", flat=True))
+	pipeline_data = PipelineData(users, back_days, list_email_freq)
+
+	chunks = [(user_ids[i:i+chunk_size], list_email_freq, send_mail, mark_lists) for i in xrange(0, len(user_ids), chunk_size)]
+	connection.close() # don't share the connection with the forked workers
+	pool = multiprocessing.Pool(options["workers"], pipeline_worker_init)
+
+	totals = { "emails": 0, "events": 0, "stale": 0, "bounced": 0 }
+	results = pool.imap(pipeline_send_chunk, chunks) # in order, so the watermark only moves past completed chunks
+	if sys.stdout.isatty():
+		import tqdm
+		results = tqdm.tqdm(results, total=len(chunks), desc="Users")
+	try:
+		for max_user_id, stats in results:
+			for k in totals: totals[k] += stats[k]
+			if watermark and send_mail:
+				with open(watermark, "w") as f:
+					f.write(str(max_user_id))
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+
+	# Finished. The next run starts from the beginning.
+	if watermark and os.path.exists(watermark):
+		os.unlink(watermark)
+
+	print "Sent" if send_mail else "Would send", totals["emails"], "emails and", totals["events"], "events"
+	print totals["stale"], "users skipped because they are stale"
+	print totals["bounced"], "users skipped because of a bounced email"
+
 def load_markdown_content(template_path, utm=""):
 	# Load the Markdown template for the current blast.
 	templ = get_template(template_path)
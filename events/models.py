@@ -7,6 +7,7 @@ from django.contrib.auth.models import User
 
 import re
 import urllib
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
 # In a worst-case scenario, at most how many days back should we send events?
@@ -16,6 +17,7 @@ BACKFILL_DAYS_WEEKLY = 14
 class Feed(models.Model):
     """Each Feed has a code name that can be used to reconstruct information about the feed."""
     feedname = models.CharField(max_length=64, unique=True, db_index=True)
+    timeline_version = models.IntegerField(default=0) # incremented whenever the feed's events change, see get_timelines
     
     def __unicode__(self):
         return self.feedname
@@ -85,31 +87,87 @@ class Feed(models.Model):
                 return ret
             
             else:
-                # pull events by feed. When we query on the 'seq' column, MySQL uses the when-based
-                # index rather than the feed-based index, which causes a big problem if there are
-                # no recent events.
+                # Merge the per-feed timelines, most recent first, stopping as soon as we
+                # have 'count' distinct events.
+                timelines = Feed.get_timelines(feeds, count, cursor)
                 ret = []
                 seen = { }
-                for feed in feeds:
-                    cursor.execute("SELECT source_content_type_id, source_object_id, eventid, `when`, seq FROM events_event WHERE feed_id = %s ORDER BY `when` DESC, source_content_type_id DESC, source_object_id DESC LIMIT %s", [feed.id, count])
-                    
-                    batch = cursor.fetchall()
-                    for b in batch:
-                        key = tuple(b[0:3]) # the unique part for identifying the event
-                        if not key in seen:
-                            v = { "source_content_type": b[0], "source_object_id": b[1], "eventid": b[2], "when": b[3], "seq": b[4], "feeds": set() }
-                            ret.append(v)
-                            seen[key] = v
-                        seen[key]["feeds"].add(source_feed_map.get(feed, feed).feedname)
-
-                ret.sort(key = lambda x : (x["when"], x["source_content_type"], x["source_object_id"], x["seq"]), reverse=True)
-                ret = ret[0:count]
+                for feed, b in merge_timelines([(feed, timelines[feed.id]) for feed in feeds]):
+                    key = tuple(b[0:3]) # the unique part for identifying the event
+                    if not key in seen:
+                        if len(ret) == count: break
+                        v = { "source_content_type": b[0], "source_object_id": b[1], "eventid": b[2], "when": b[3], "seq": b[4], "feeds": set() }
+                        ret.append(v)
+                        seen[key] = v
+                    seen[key]["feeds"].add(source_feed_map.get(feed, feed).feedname)
 
                 # Feed instances aren't hashable without pk's.
                 for r in ret: r["feeds"] = [Feed(feedname=fn) for fn in r["feeds"]]
 
                 return ret
-        
+
+    # The most recent TIMELINE_SIZE events of each feed are cached so that pages showing
+    # the events of many feeds don't have to query each feed. The cache keys include the
+    # feed's timeline_version, which Event.apply_updates increments in the same transaction
+    # that changes the feed's events. Since the version is read from the database, every
+    # process sees the change even if the cache isn't shared between processes, and a
+    # timeline read before a change can only be stored under the old version's key.
+    TIMELINE_SIZE = 100
+    TIMELINE_CACHE_TIME = 60*15
+    TIMELINE_QUERY_BATCH = 50
+
+    @staticmethod
+    def timeline_cache_key(feed_id, version):
+        return "events_feed_timeline_%d_%d" % (feed_id, version)
+
+    @staticmethod
+    def get_timelines(feeds, count, cursor):
+        # Returns a dict from feed id to a list of the feed's most recent events (at least
+        # 'count' of them, if there are that many) as (source_content_type_id, source_object_id,
+        # eventid, when, seq) tuples, most recent first.
+        from django.core.cache import cache
+
+        ret = { }
+        if count <= Feed.TIMELINE_SIZE:
+            # The Feed instances may have been cached, so get the current versions.
+            versions = dict(Feed.objects.filter(id__in=[f.id for f in feeds]).values_list("id", "timeline_version"))
+            cached = cache.get_many([Feed.timeline_cache_key(f.id, versions.get(f.id, 0)) for f in feeds])
+            for f in feeds:
+                if Feed.timeline_cache_key(f.id, versions.get(f.id, 0)) in cached:
+                    ret[f.id] = cached[Feed.timeline_cache_key(f.id, versions.get(f.id, 0))]
+            limit = Feed.TIMELINE_SIZE
+        else:
+            limit = count
+
+        # Pull the events of the remaining feeds, a batch of feeds per query. When we query
+        # on the 'seq' column, MySQL uses the when-based index rather than the feed-based
+        # index, which causes a big problem if there are no recent events.
+        missing = [f.id for f in feeds if f.id not in ret]
+        for i in xrange(0, len(missing), Feed.TIMELINE_QUERY_BATCH):
+            batch = missing[i:i+Feed.TIMELINE_QUERY_BATCH]
+            cursor.execute(" UNION ALL ".join(
+                "SELECT * FROM (SELECT feed_id, source_content_type_id, source_object_id, eventid, `when`, seq FROM events_event WHERE feed_id = %s ORDER BY `when` DESC, source_content_type_id DESC, source_object_id DESC LIMIT %s) AS t" + str(j)
+                for j in xrange(len(batch))),
+                sum([[feed_id, limit] for feed_id in batch], []))
+            timelines = dict((feed_id, []) for feed_id in batch)
+            for row in cursor.fetchall():
+                timelines[row[0]].append(tuple(row[1:]))
+            for tl in timelines.values():
+                tl.sort(key = timeline_sort_key, reverse=True)
+            ret.update(timelines)
+            if limit == Feed.TIMELINE_SIZE:
+                cache.set_many(dict((Feed.timeline_cache_key(feed_id, versions.get(feed_id, 0)), tl) for feed_id, tl in timelines.items()), Feed.TIMELINE_CACHE_TIME)
+
+        return ret
+
+    @staticmethod
+    def invalidate_timelines(feed_ids):
+        # Call within the transaction that changes the events of the feeds.
+        from django.db.models import F
+        feed_ids = sorted(feed_ids)
+        for i in xrange(0, len(feed_ids), Event.BULK_BATCH_SIZE):
+            Feed.objects.filter(id__in=feed_ids[i:i+Event.BULK_BATCH_SIZE]).update(timeline_version=F("timeline_version")+1)
+
     def get_events(self, count):
         return Feed.get_events_for((self,), count)
 
@@ -350,6 +408,10 @@ class Event(models.Model):
         with Event.update(self) as E:
             E.add("eventcode", self.created, feedinstance1)
             E.add("eventcode", self.created, feedinstance2)
+
+    The events are written when the with block exits. To update the events of many source
+    objects at once, wrap the updates in "with Event.batch():" and the writes are batched
+    across the source objects.
                 
     Event.render is optionally passed a keyword argument feeds which is a sequence of
     feed.Feed objects that allow the event's template to be customized depending on which
@@ -388,15 +450,13 @@ class Event(models.Model):
         return self.source.render_event(self.eventid, feeds)
     
     # This is used to update the events for an object and delete any events that are not updated.
+    # The events added are buffered and written when the block exits. If an Event.batch() is
+    # active, they are instead written along with the events of other source objects when the
+    # batch is flushed.
     class update:
         def __init__(self, source):
             self.source = source
-            
-            # get a list of events previously created for this source so that if they
-            # are not updated we can delete them
-            self.existing_events = {}
-            for event in Event.objects.filter(**Event.sourcearg(source)):
-                self.existing_events[event.id] = True
+            self.events = OrderedDict() # (feed_id, eventid) => (feed, when, seq)
             self.seq = { }
 
         def __enter__(self):
@@ -411,26 +471,122 @@ class Event(models.Model):
                 
             # Track the sequence number for this eventid, increment in insertion order.
             if not eventid in self.seq: self.seq[eventid] = len(self.seq)
+
+            # Dates are stored as midnight. Normalize them now so they compare equal
+            # to the stored value and we don't rewrite unchanged events.
+            if not isinstance(when, datetime):
+                when = datetime.combine(when, datetime.min.time())
             
-            # Create the record for this event for this feed, if it does not exist.
-            event, created = Event.objects.get_or_create(
-                feed = feed,
-                eventid = eventid,
-                defaults = {"when": when, "seq": self.seq[eventid]},
-                **Event.sourcearg(self.source)
-                )
-            #print ("[%s] %s event record: %s | %s | %s" % (unicode(self.source)[0:15], "New" if created else "Existing", feed.feedname, repr(self.source), eventid)).encode("utf8")
-            if not created and event.id in self.existing_events:
-                del self.existing_events[event.id] # i.e. don't delete this event on __exit__
-                if event.when != when: # update this if it changed
-                    event.when = when
-                    event.save()
+            # The first add for an event in a feed wins, like get_or_create would.
+            self.events.setdefault((feed.id, eventid), (feed, when, self.seq[eventid]))
             
         def __exit__(self, type, value, traceback):
-            # Clear out any events that were not updated.
-            Event.objects.filter(id__in=self.existing_events).delete()
+            # If generating the events failed, leave the existing events alone rather
+            # than deleting everything that wasn't re-added before the error.
+            if type is not None:
+                return False
+            if Event.batch.current is not None:
+                Event.batch.current.add(self)
+            else:
+                Event.apply_updates([self])
             return False
 
+    # Use "with Event.batch():" around code that updates the events of many source
+    # objects (e.g. a parser run) to diff and write them in bulk.
+    class batch:
+        current = None
+
+        def __init__(self, max_sources=500):
+            self.max_sources = max_sources
+            self.updates = []
+
+        def __enter__(self):
+            if Event.batch.current is not None:
+                raise ValueError("An Event.batch is already active.")
+            Event.batch.current = self
+            return self
+
+        def add(self, update):
+            self.updates.append(update)
+            if len(self.updates) >= self.max_sources:
+                self.flush()
+
+        def flush(self):
+            Event.apply_updates(self.updates)
+            self.updates = []
+
+        def __exit__(self, type, value, traceback):
+            Event.batch.current = None
+            if type is None:
+                self.flush()
+            return False
+
+    BULK_BATCH_SIZE = 500
+
+    @staticmethod
+    def apply_updates(updates):
+        # Diff the events added in each Event.update against the events already stored
+        # for its source object and write the differences with a handful of queries.
+        from django.db import transaction
+
+        if len(updates) == 0: return
+
+        # If a source was updated more than once, the last update replaces the
+        # earlier ones, as it would have if they had been applied one by one.
+        latest = OrderedDict()
+        for u in updates:
+            ct = ContentType.objects.get_for_model(u.source)
+            latest.pop((ct.id, u.source.id), None)
+            latest[(ct.id, u.source.id)] = u
+        updates = latest.values()
+
+        # Get the events previously created for these sources, by content type.
+        sources = { }
+        for ct_id, object_id in latest:
+            sources.setdefault(ct_id, []).append(object_id)
+        existing = { } # (content type id, object id) => { (feed_id, eventid): (id, when) }
+        for ct_id, object_ids in sources.items():
+            for i in xrange(0, len(object_ids), Event.BULK_BATCH_SIZE):
+                for id, object_id, feed_id, eventid, when in Event.objects.filter(source_content_type=ct_id, source_object_id__in=object_ids[i:i+Event.BULK_BATCH_SIZE])\
+                    .values_list("id", "source_object_id", "feed_id", "eventid", "when"):
+                    existing.setdefault((ct_id, object_id), {})[(feed_id, eventid)] = (id, when)
+
+        to_delete = []
+        to_update = { } # when => [ids]
+        to_create = []
+        changed_feeds = set()
+        for u in updates:
+            ct = ContentType.objects.get_for_model(u.source)
+            old = existing.get((ct.id, u.source.id), {})
+            for key, (feed, when, seq) in u.events.items():
+                if key in old:
+                    id, old_when = old[key]
+                    if old_when != when: # update this if it changed
+                        to_update.setdefault(when, []).append(id)
+                        changed_feeds.add(key[0])
+                else:
+                    changed_feeds.add(key[0])
+                    to_create.append(Event(feed=feed, source_content_type=ct, source_object_id=u.source.id,
+                        eventid=key[1], when=when, seq=seq))
+            # Clear out any events that were not updated.
+            for key in old:
+                if key not in u.events:
+                    to_delete.append(old[key][0])
+                    changed_feeds.add(key[0])
+
+        with transaction.atomic():
+            # Delete first so that new rows don't collide with stale ones on the unique indexes.
+            for i in xrange(0, len(to_delete), Event.BULK_BATCH_SIZE):
+                Event.objects.filter(id__in=to_delete[i:i+Event.BULK_BATCH_SIZE]).delete()
+            for when, ids in to_update.items():
+                for i in xrange(0, len(ids), Event.BULK_BATCH_SIZE):
+                    Event.objects.filter(id__in=ids[i:i+Event.BULK_BATCH_SIZE]).update(when=when)
+            # to_create is in the order the events were added, so ids are assigned in that order.
+            Event.objects.bulk_create(to_create, batch_size=Event.BULK_BATCH_SIZE)
+
+            # Invalidate the cached timelines of the feeds whose events changed.
+            Feed.invalidate_timelines(changed_feeds)
+
 class SubscriptionList(models.Model):
     # see send_email_updates.py
     EMAIL_CHOICES = [(0, 'No Email Updates'), (1, 'Daily'), (2, 'Weekly')]
@@ -535,9 +691,18 @@ class SubscriptionList(models.Model):
         # The Django ORM can't handle generating a nice query. It adds joins that ruin indexing.
         from django.db import connection, transaction
         with connection.cursor() as cursor:
-            cursor.execute("SELECT id, source_content_type_id, source_object_id, eventid, `when`, seq, feed_id FROM events_event WHERE id > %s AND `when` > %s AND feed_id IN (" + ",".join(str(f.id) for f in feeds) + ") ORDER BY `when`, source_content_type_id, source_object_id, seq", [self.last_event_mailed if self.last_event_mailed else 0, datetime.now() - timedelta(days=BACKFILL_DAYS_DAILY if self.email == 1 else BACKFILL_DAYS_WEEKLY)])
+            cursor.execute("SELECT id, source_content_type_id, source_object_id, eventid, `when`, seq, feed_id FROM events_event WHERE id > %s AND `when` > %s AND feed_id IN (" + ",".join(str(f.id) for f in feeds) + ") ORDER BY `when`, source_content_type_id, source_object_id, seq", [self.last_event_mailed if self.last_event_mailed else 0, self.get_backfill_date()])
             batch = cursor.fetchall()
         
+        return SubscriptionList.collate_new_events(batch, feeds, source_feed_map)
+
+    def get_backfill_date(self):
+        return datetime.now() - timedelta(days=BACKFILL_DAYS_DAILY if self.email == 1 else BACKFILL_DAYS_WEEKLY)
+
+    @staticmethod
+    def collate_new_events(batch, feeds, source_feed_map):
+        # batch is a list of (id, source_content_type_id, source_object_id, eventid, when, seq, feed_id)
+        # rows in the order (when, source_content_type_id, source_object_id, seq).
         max_id = None
         ret = []
         seen = { } # uniqify because events are duped for each feed they are in, but track which feeds generated the events
@@ -552,26 +717,122 @@ class SubscriptionList(models.Model):
                 v = { "id": b[0], "source_content_type": b[1], "source_object_id": b[2], "eventid": b[3], "when": b[4], "seq": b[5], "feeds": set() }
                 ret.append(v)
                 seen[key] = v
-            v["feeds"].add(feedmap[b[6]])
+            seen[key]["feeds"].add(feedmap[b[6]])
                 
         ret.sort(key = lambda x : (x["when"], x["source_content_type"], x["source_object_id"], x["seq"]))
     
         return max_id, ret
+
+class NewEventsIndex(object):
+    """
+    The recent events of all feeds, loaded in one query, for finding the new
+    events of many subscription lists at once (see send_email_updates). 
+
+        index = NewEventsIndex(datetime.now() - timedelta(days=BACKFILL_DAYS_WEEKLY))
+        index.fix_last_event_mailed(sublists)
+        for sublist in sublists:
+            max_id, events = index.get_new_events(sublist)
+
+    gives the same results as calling sublist.get_new_events() on each list,
+    as long as the lists' backfill dates are not earlier than the index's.
+    """
+
+    def __init__(self, since):
+        from django.db import connection
+        self.since = since
+        self.events_by_feed = { }
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id, source_content_type_id, source_object_id, eventid, `when`, seq, feed_id FROM events_event WHERE `when` > %s", [since])
+            for row in cursor.fetchall():
+                self.events_by_feed.setdefault(row[6], []).append(row)
+        self.includes_cache = { }
+
+    def fix_last_event_mailed(self, sublists, batch_size=500):
+        # The same workaround as in SubscriptionList.get_new_events, in bulk: move
+        # each list's last_event_mailed to the maximum id of the duplicates of
+        # that event across feeds.
+        event_ids = list(set(s.last_event_mailed for s in sublists if s.last_event_mailed))
+        event_keys = { }
+        for i in xrange(0, len(event_ids), batch_size):
+            for id, ct, obj, eventid in Event.objects.filter(id__in=event_ids[i:i+batch_size]).values_list("id", "source_content_type", "source_object_id", "eventid"):
+                event_keys[id] = (ct, obj, eventid)
+        max_ids = { }
+        object_ids = sorted(set(k[1] for k in event_keys.values()))
+        for i in xrange(0, len(object_ids), batch_size):
+            for id, ct, obj, eventid in Event.objects.filter(source_object_id__in=object_ids[i:i+batch_size]).values_list("id", "source_content_type", "source_object_id", "eventid"):
+                key = (ct, obj, eventid)
+                max_ids[key] = max(max_ids.get(key), id)
+        for s in sublists:
+            if s.last_event_mailed in event_keys:
+                s.last_event_mailed = max_ids[event_keys[s.last_event_mailed]]
+
+    def get_new_events(self, sublist):
+        feeds, source_feed_map = expand_feeds(sublist.trackers.all(), self.includes_cache)
+        if len(feeds) == 0: return None, []
+
+        last_event_mailed = sublist.last_event_mailed if sublist.last_event_mailed else 0
+        since = sublist.get_backfill_date()
+        batch = []
+        for f in feeds:
+            for row in self.events_by_feed.get(f.id, []):
+                if row[0] > last_event_mailed and row[4] > since:
+                    batch.append(row)
+        batch.sort(key = lambda row : (row[4], row[1], row[2], row[5]))
+
+        return SubscriptionList.collate_new_events(batch, feeds, source_feed_map)
         
-def expand_feeds(feeds):
+def expand_feeds(feeds, includes_cache=None):
     # Some feeds include the events of other feeds.
-    # Tail-recursively expand the feeds.
+    # Tail-recursively expand the feeds. Pass a dict as includes_cache to
+    # remember each feed's included feeds across calls.
     feeds = [f if isinstance(f, Feed) else Feed.objects.get(feedname=f) for f in feeds]
     map_to_source = { }
     i = 0
     while i < len(feeds):
-        for f in feeds[i].includes_feeds():
+        if includes_cache is None:
+            includes = feeds[i].includes_feeds()
+        else:
+            if feeds[i].feedname not in includes_cache:
+                includes_cache[feeds[i].feedname] = feeds[i].includes_feeds()
+            includes = includes_cache[feeds[i].feedname]
+        for f in includes:
             if f not in feeds: # don't include a feed already included, and don't add a mapping for it in map_to_source
                 map_to_source[f] = feeds[i]
                 feeds.append(f)
         i += 1
     return feeds, map_to_source
 
+def timeline_sort_key(row):
+    # (source_content_type_id, source_object_id, eventid, when, seq) => (when, source_content_type_id, source_object_id, seq)
+    return (row[3], row[0], row[1], row[4])
+
+class _ReverseKey(object):
+    # heapq only makes min-heaps, so wrap keys to pop the most recent event first.
+    __slots__ = ('key',)
+    def __init__(self, key):
+        self.key = key
+    def __lt__(self, other):
+        return self.key > other.key
+
+def merge_timelines(timelines):
+    # k-way merge of (feed, timeline) pairs, where each timeline is sorted most recent
+    # first, yielding (feed, row) pairs most recent first. Events in multiple feeds come
+    # out consecutively. Stop iterating as soon as you have enough.
+    import heapq
+    heap = []
+    for i, (feed, tl) in enumerate(timelines):
+        if len(tl) > 0:
+            heap.append((_ReverseKey(timeline_sort_key(tl[0])), i, 0))
+    heapq.heapify(heap)
+    while heap:
+        key, i, j = heap[0]
+        feed, tl = timelines[i]
+        if j+1 < len(tl):
+            heapq.heapreplace(heap, (_ReverseKey(timeline_sort_key(tl[j+1])), i, j+1))
+        else:
+            heapq.heappop(heap)
+        yield feed, tl[j]
+
 def truncate_words(s, num):
     from django.utils.text import Truncator
     return Truncator(s).words(num, truncate=" ...")
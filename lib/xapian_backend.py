@@ -207,68 +207,12 @@ class XapianSearchBackend(BaseSearchBackend):
         """
         database = self._database(writable=True)
         try:
+            term_generator = self._term_generator(database)
+            weights = index.get_field_weights()
             for obj in iterable:
-                document = xapian.Document()
-
-                term_generator = xapian.TermGenerator()
-                term_generator.set_database(database)
-                term_generator.set_stemmer(xapian.Stem(self.language))
-                if self.include_spelling is True:
-                    term_generator.set_flags(xapian.TermGenerator.FLAG_SPELLING)
-                term_generator.set_document(document)
-
-                document_id = DOCUMENT_ID_TERM_PREFIX + get_identifier(obj)
-                data = index.full_prepare(obj)
-                weights = index.get_field_weights()
-                for field in self.schema:
-                    if field['field_name'] in data.keys():
-                        prefix = DOCUMENT_CUSTOM_TERM_PREFIX + field['field_name'].upper()
-                        value = data[field['field_name']]
-                        try:
-                            weight = int(weights[field['field_name']])
-                        except KeyError:
-                            weight = 1
-                        if field['type'] == 'text':
-                            if field['multi_valued'] == 'false':
-                                term = _marshal_term(value)
-                                term_generator.index_text(term, weight)
-                                term_generator.index_text(term, weight, prefix)
-                                if len(term.split()) == 1:
-                                    document.add_term(term, weight)
-                                    document.add_term(prefix + term, weight)
-                                document.add_value(field['column'], _marshal_value(value))
-                            else:
-                                for term in value:
-                                    term = _marshal_term(term)
-                                    term_generator.index_text(term, weight)
-                                    term_generator.index_text(term, weight, prefix)
-                                    if len(term.split()) == 1:
-                                        document.add_term(term, weight)
-                                        document.add_term(prefix + term, weight)
-                        else:
-                            if field['multi_valued'] == 'false':
-                                term = _marshal_term(value)
-                                if len(term.split()) == 1:
-                                    document.add_term(term, weight)
-                                    document.add_term(prefix + term, weight)
-                                    document.add_value(field['column'], _marshal_value(value))
-                            else:
-                                for term in value:
-                                    term = _marshal_term(term)
-                                    if len(term.split()) == 1:
-                                        document.add_term(term, weight)
-                                        document.add_term(prefix + term, weight)
-
-                document.set_data(pickle.dumps(
-                    (obj._meta.app_label, obj._meta.module_name, obj.pk, data),
-                    pickle.HIGHEST_PROTOCOL
-                ))
-                document.add_term(document_id)
-                document.add_term(
-                    DOCUMENT_CT_TERM_PREFIX + u'%s.%s' %
-                    (obj._meta.app_label, obj._meta.module_name)
-                )
-                database.replace_document(document_id, document)
+                self._add_document(database, term_generator, weights,
+                    obj._meta.app_label, obj._meta.module_name, obj.pk,
+                    get_identifier(obj), index.full_prepare(obj))
 
         except UnicodeDecodeError:
             sys.stderr.write('Chunk failed.\n')
@@ -277,6 +221,172 @@ class XapianSearchBackend(BaseSearchBackend):
         finally:
             database.close()
 
+    def bulk_update(self, index, iterable, batch_size=None, workers=1, callback=None):
+        """
+        Like `update`, but meant for (re)indexing a large number of objects.
+
+        Required arguments:
+            `index` -- The `SearchIndex` to process
+            `iterable` -- A QuerySet or iterable of model instances to index
+
+        Optional arguments:
+            `batch_size` -- Commit to the database after this many documents
+              (default = the connection's `BATCH_SIZE`)
+            `workers` -- The number of processes to prepare documents in with
+              `index.full_prepare` (default = 1, i.e. in this process)
+            `callback` -- Called with the total number of documents written
+              so far after each commit
+
+        The database is opened once and a single `TermGenerator` is used for
+        all of the documents. With more than one worker, the objects are
+        re-loaded by primary key in each worker process and only the prepared
+        data is sent back, since only one process can write to the database.
+
+        Returns the number of documents written.
+        """
+        if not batch_size:
+            batch_size = self.batch_size
+
+        # Start any worker processes before opening the database for writing
+        # so that they don't inherit its file handles.
+        pool = None
+        if workers > 1:
+            pool, prepared = self._prepare_in_pool(index, iterable, batch_size, workers)
+        else:
+            prepared = (
+                (obj._meta.app_label, obj._meta.module_name, obj.pk, get_identifier(obj), index.full_prepare(obj))
+                for obj in iterable)
+
+        count = 0
+        try:
+            database = self._database(writable=True)
+            try:
+                term_generator = self._term_generator(database)
+                weights = index.get_field_weights()
+                for app_label, module_name, pk, identifier, data in prepared:
+                    try:
+                        self._add_document(database, term_generator, weights, app_label, module_name, pk, identifier, data)
+                    except UnicodeDecodeError:
+                        sys.stderr.write('Document %s failed.\n' % identifier)
+                        continue
+                    count += 1
+                    if count % batch_size == 0:
+                        database.commit()
+                        if callback: callback(count)
+                database.commit()
+                if callback and count % batch_size != 0: callback(count)
+            finally:
+                database.close()
+            if pool: pool.close()
+        except:
+            if pool: pool.terminate()
+            raise
+        finally:
+            if pool: pool.join()
+
+        return count
+
+    def _prepare_in_pool(self, index, iterable, batch_size, workers):
+        """
+        Private method that starts a pool of `workers` processes to run
+        `index.full_prepare` over the objects in `iterable`. Returns the pool
+        and an iterator over tuples of (app_label, module_name, pk,
+        identifier, prepared data). The caller must close the pool.
+        """
+        import itertools
+        import multiprocessing
+        from django.db import connection
+
+        model = index.get_model()
+        if hasattr(iterable, 'values_list'):
+            pks = list(iterable.values_list('pk', flat=True))
+        else:
+            pks = [obj.pk for obj in iterable]
+
+        # Smaller chunks than the commit batches keep all of the workers busy.
+        chunk_size = max(1, min(batch_size, len(pks) / (workers * 4)))
+        chunks = [
+            (self.connection_alias, model._meta.app_label, model._meta.module_name, pks[i:i+chunk_size])
+            for i in xrange(0, len(pks), chunk_size)]
+
+        # Don't share our database connection with the child processes.
+        connection.close()
+        pool = multiprocessing.Pool(workers, _init_prepare_worker)
+        return pool, itertools.chain.from_iterable(pool.imap_unordered(_prepare_chunk, chunks))
+
+    def _term_generator(self, database):
+        """
+        Private method that returns a xapian.TermGenerator set up for
+        indexing into `database`. Use one for many documents: `_add_document`
+        gives it each new document in turn.
+        """
+        term_generator = xapian.TermGenerator()
+        term_generator.set_database(database)
+        term_generator.set_stemmer(xapian.Stem(self.language))
+        if self.include_spelling is True:
+            term_generator.set_flags(xapian.TermGenerator.FLAG_SPELLING)
+        return term_generator
+
+    def _add_document(self, database, term_generator, weights, app_label, module_name, pk, identifier, data):
+        """
+        Private method that builds the xapian.Document for an object from its
+        prepared data and adds it to the database, replacing any existing
+        document for the object. See `update` for the document's structure.
+        """
+        document = xapian.Document()
+        term_generator.set_document(document)
+
+        document_id = DOCUMENT_ID_TERM_PREFIX + identifier
+        for field in self.schema:
+            if field['field_name'] in data:
+                prefix = DOCUMENT_CUSTOM_TERM_PREFIX + field['field_name'].upper()
+                value = data[field['field_name']]
+                try:
+                    weight = int(weights[field['field_name']])
+                except KeyError:
+                    weight = 1
+                if field['type'] == 'text':
+                    if field['multi_valued'] == 'false':
+                        term = _marshal_term(value)
+                        term_generator.index_text(term, weight)
+                        term_generator.index_text(term, weight, prefix)
+                        if len(term.split()) == 1:
+                            document.add_term(term, weight)
+                            document.add_term(prefix + term, weight)
+                        document.add_value(field['column'], _marshal_value(value))
+                    else:
+                        for term in value:
+                            term = _marshal_term(term)
+                            term_generator.index_text(term, weight)
+                            term_generator.index_text(term, weight, prefix)
+                            if len(term.split()) == 1:
+                                document.add_term(term, weight)
+                                document.add_term(prefix + term, weight)
+                else:
+                    if field['multi_valued'] == 'false':
+                        term = _marshal_term(value)
+                        if len(term.split()) == 1:
+                            document.add_term(term, weight)
+                            document.add_term(prefix + term, weight)
+                            document.add_value(field['column'], _marshal_value(value))
+                    else:
+                        for term in value:
+                            term = _marshal_term(term)
+                            if len(term.split()) == 1:
+                                document.add_term(term, weight)
+                                document.add_term(prefix + term, weight)
+
+        document.set_data(pickle.dumps(
+            (app_label, module_name, pk, data),
+            pickle.HIGHEST_PROTOCOL
+        ))
+        document.add_term(document_id)
+        document.add_term(
+            DOCUMENT_CT_TERM_PREFIX + u'%s.%s' %
+            (app_label, module_name)
+        )
+        database.replace_document(document_id, document)
+
     def remove(self, obj):
         """
         Remove indexes for `obj` from the database.
@@ -1279,6 +1389,27 @@ class XapianSearchQuery(BaseSearchQuery):
             return xapian.Query(xapian.Query.OP_PHRASE, term_list)
 
 
+def _init_prepare_worker():
+    # Each worker process opens its own database connection.
+    from django.db import connection
+    connection.close()
+
+
+def _prepare_chunk(args):
+    """
+    Runs in a worker process for `XapianSearchBackend.bulk_update`: loads a
+    chunk of objects by primary key and returns their prepared data.
+    """
+    from django.db.models import get_model
+    connection_alias, app_label, module_name, pks = args
+    model = get_model(app_label, module_name)
+    index = connections[connection_alias].get_unified_index().get_index(model)
+    return [
+        (app_label, module_name, obj.pk, get_identifier(obj), index.full_prepare(obj))
+        for obj in index.index_queryset(using=connection_alias).filter(pk__in=pks)
+    ]
+
+
 def _marshal_value(value):
     """
     Private utility method that converts Python values to a string for Xapian values.
@@ -57,6 +57,8 @@ def parse_args():
                       help='Slow down parsing so we don\'t interfere with other processes.')
     parser.add_option('--filter',
                       help='Only process files matching a regex.')
+    parser.add_option('--workers', type='int', default=1,
+                      help='Number of worker processes to parse with (bill parser only).')
     kwargs, args = parser.parse_args()
     if not args:
         parser.print_usage()
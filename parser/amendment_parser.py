@@ -19,6 +19,7 @@ from parser.models import File
 from bill.models import Amendment, AmendmentType, Bill, BillType
 from vote.models import Vote, CongressChamber
 from person.models import Person
+from person.util import enable_role_index
 from settings import CURRENT_CONGRESS
 from us import get_session_from_date
 
@@ -96,6 +97,9 @@ def main(options):
     Process amendments
     """
 
+    # Look up sponsor roles in memory rather than with a query each.
+    enable_role_index()
+
     if options.congress:
         files = glob.glob('data/us/%s/bills.amdt/*.xml' % options.congress)
         log.info('Parsing amendments of only congress#%s' % options.congress)
@@ -111,10 +115,11 @@ def main(options):
 
     amendment_processor = AmendmentProcessor()
     seen_amdt_ids = []
+    file_index = File.objects.preload(os.path.commonprefix(files))
     for fname in files:
         progress.tick()
         
-        if not File.objects.is_changed(fname) and not options.force:
+        if not file_index.is_changed(fname) and not options.force:
             m = re.match(r"data/us/(\d+)/bills.amdt/([sh])(\d+).xml", fname)
             if not m:
                 print "Invalid file name", fname
@@ -167,7 +172,9 @@ def main(options):
         # we may need to update the vote title if the amendment title has changed.
         Vote.objects.filter(related_amendment=amdt).update(missing_data=True)
 
-        File.objects.save_file(fname)
+        file_index.save_file(fname)
+
+    file_index.flush()
         
     # Are any amendments in the database no longer on disk?
     if options.congress and not options.filter:
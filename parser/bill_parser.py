@@ -4,6 +4,9 @@ Parser of:
  * bills located in data/us/*/bills/*.xml
  
 for x in {82..112}; do echo $x; ./parse.py bill --congress=$x -l ERROR --force --disable-events --disable-indexing; done
+
+A full reload can be spread across processes (sharded by congress and bill type):
+./parse.py bill --force --workers=8
 """
 from lxml import etree
 import logging
@@ -20,9 +23,13 @@ from parser.processor import XmlProcessor
 from parser.models import File
 from bill.models import BillTerm, TermType, BillType, Bill, Cosponsor, BillStatus, RelatedBill
 from person.models import Person
+from person.util import enable_role_index
 from bill.title import get_primary_bill_title
-from bill.billtext import get_bill_text_metadata
+from bill.billtext import get_bill_text_metadata, build_bill_text_manifest
+from bill.aggregates import refresh_bill_aggregates
+from smartsearch.facets import invalidate_facet_index
 from committee.models import Committee
+from events.models import Event
 from settings import CURRENT_CONGRESS
 
 log = logging.getLogger('parser.bill_parser')
@@ -180,22 +187,227 @@ class BillProcessor(XmlProcessor):
                 log.error('Could not find term [name: %s]' % name)
         obj.terms = termlist
 
+    # When not None, related bills are collected here as (bill id, related
+    # bills) pairs rather than saved, to be saved with save_related_bills
+    # once all of the bills exist (see process_bill_files_parallel).
+    deferred_related_bills = None
+
     def process_relatedbills(self, obj, node):
-        RelatedBill.objects.filter(bill=obj).delete()
-        for subnode in node.xpath('./relatedbills/bill'):
-            try:
-                related_bill = Bill.objects.get(congress=subnode.get("session"), bill_type=BillType.by_xml_code(subnode.get("type")), number=int(subnode.get("number")))
-            except Bill.DoesNotExist:
-                continue
-            RelatedBill.objects.create(bill=obj, related_bill=related_bill, relation=subnode.get("relation"))
+        related = [(subnode.get("session"), subnode.get("type"), subnode.get("number"), subnode.get("relation"))
+            for subnode in node.xpath('./relatedbills/bill')]
+        if self.deferred_related_bills is not None:
+            self.deferred_related_bills.append((obj.id, related))
+        else:
+            save_related_bills(obj.id, related)
+
+def save_related_bills(bill_id, related):
+    # related is a list of (congress, bill type XML code, number, relation)
+    # tuples. Related bills that aren't in the database are skipped.
+    RelatedBill.objects.filter(bill=bill_id).delete()
+    for congress, bill_type, number, relation in related:
+        try:
+            related_bill = Bill.objects.get(congress=congress, bill_type=BillType.by_xml_code(bill_type), number=int(number))
+        except Bill.DoesNotExist:
+            continue
+        RelatedBill.objects.create(bill_id=bill_id, related_bill=related_bill, relation=relation)
                     
 
 
+def process_bill_file(fname, options, bill_processor, reindex, file_index):
+    """
+    Process a single bill XML file. reindex is called with each bill that
+    should be (re)indexed, or is None if indexing is disabled. file_index
+    is a parser.models.FileIndex (or File.objects) for change detection.
+    Returns the ids of the bills represented by the file.
+    """
+
+    seen_bill_ids = []
+
+    # With indexing or events enabled, if the bill metadata file hasn't changed check
+    # the bill's latest text file for changes so we can create a text-is-available
+    # event and so we can index the bill's text.
+    if (not options.congress or options.congress>42) and (not options.disable_indexing and not options.disable_events) and not file_index.is_changed(fname) and not options.force:
+        m = re.search(r"/(\d+)/bills/([a-z]+)(\d+)\.xml$", fname)
+
+        try:
+            b = Bill.objects.get(congress=m.group(1), bill_type=BillType.by_xml_code(m.group(2)), number=m.group(3))
+            seen_bill_ids.append(b.id)
+            
+            # Update the index/events for any bill with recently changed text
+            textfile = get_bill_text_metadata(b, None)
+            if not textfile:
+                if b.congress >= 103 and b.introduced_date < (datetime.now()-timedelta(days=14)).date():
+                    print "No bill text?", fname, b.introduced_date
+                return seen_bill_ids
+            textfile = textfile["text_file"]
+            if os.path.exists(textfile) and file_index.is_changed(textfile):
+                reindex(b) # index the full text
+                b.create_events() # events for new bill text documents
+                file_index.save_file(textfile)
+                
+            return seen_bill_ids
+        except Bill.DoesNotExist:
+            print "Unchanged metadata file but bill doesn't exist:", fname
+            pass # just parse as normal
+        
+    if options.slow:
+        time.sleep(1)
+        
+    tree = etree.parse(fname)
+    for node in tree.xpath('/bill'):
+        try:
+            bill = bill_processor.process(Bill(), node)
+        except:
+            print fname
+            raise
+       
+        seen_bill_ids.append(bill.id) # don't delete me later
+        
+        if bill.congress >= 93:
+            bill.source = "thomas-congproj"
+        elif bill.congress >= 82:
+            bill.source = "statutesatlarge"
+            if bill.current_status == BillStatus.enacted_signed: bill.current_status = BillStatus.enacted_unknown
+        elif bill.congress <= 42:
+            bill.source = "americanmemory"
+        else:
+            raise ValueError()
+
+        # So far this is just for American Memory bills.
+        if node.xpath("string(source/@url)"):
+            bill.source_link = unicode(node.xpath("string(source/@url)"))
+        else:
+            bill.source_link = None
+
+        actions = []
+        for axn in tree.xpath("actions/*[@state]"):
+            actions.append( (
+            	repr(bill_processor.parse_datetime(axn.xpath("string(@datetime)"))),
+            	BillStatus.by_xml_code(axn.xpath("string(@state)")),
+            	axn.xpath("string(text)"),
+                etree.tostring(axn),
+            	) )
+            
+        bill.sliplawpubpriv = None
+        bill.sliplawnum = None
+        for axn in tree.xpath("actions/enacted"):
+            bill.sliplawpubpriv = "PUB" if axn.get("type") == "public" else "PRI"
+            bill.sliplawnum = int(axn.get("number").split("-")[1])
+                
+        bill.major_actions = actions
+        bill.major_actions_timeline = bill.build_major_actions_timeline()
+        try:
+            bill.save()
+        except:
+            print bill
+            raise
+        if reindex: reindex(bill)
+        
+        if not options.disable_events:
+            bill.create_events()
+            
+    file_index.save_file(fname)
+
+    return seen_bill_ids
+
+# Parallel processing.
+#
+# With --workers=N, the bill files are sharded by congress and bill type and each
+# shard is processed in a child process. The workers write the bill rows and events
+# themselves (the database handles concurrent writers) but the search index only
+# allows a single writer, so the workers only report which bills need indexing and
+# the parent process funnels those through the index backend in batches.
+#
+# Related bills are looked up by number when they are saved, so a worker would
+# skip any related bill in a shard that hasn't been processed yet. Instead the
+# workers report each bill's related bills and the parent saves them once all
+# of the shards are done.
+
+INDEX_BATCH_SIZE = 250
+
+def shard_bill_files(files):
+    shards = { }
+    for fname in files:
+        m = re.search(r"/(\d+)/bills/([a-z]+)\d+\.xml$", fname)
+        key = (int(m.group(1)), m.group(2)) if m else (None, None)
+        shards.setdefault(key, []).append(fname)
+    # Process the largest shards first so the pool isn't left waiting on a big one at the end.
+    return sorted(shards.values(), key = lambda s : -len(s))
+
+def init_bill_worker():
+    # Don't share the parent's database connection with the child process.
+    from django.db import connection
+    connection.close()
+
+def process_bill_shard(args):
+    files, options = args
+    bill_processor = BillProcessor()
+    bill_processor.deferred_related_bills = []
+    seen_bill_ids = []
+    index_bill_ids = []
+    with File.objects.preload(os.path.commonprefix(files)) as file_index, Event.batch():
+        for fname in files:
+            seen_bill_ids.extend(process_bill_file(fname, options, bill_processor, lambda b : index_bill_ids.append(b.id), file_index))
+    return len(files), seen_bill_ids, index_bill_ids, bill_processor.deferred_related_bills
+
+def process_bill_files_parallel(files, options, workers, bill_index):
+    import multiprocessing
+    from django.db import connection
+
+    shards = shard_bill_files(files)
+    log.info('Processing bills in %d shards with %d workers' % (len(shards), workers))
+
+    # The workers are forked and must open their own database connections.
+    connection.close()
+    pool = multiprocessing.Pool(workers, init_bill_worker)
+
+    progress = Progress(total=len(files), name='files', step=100)
+    seen_bill_ids = []
+    index_queue = []
+    related_bills = []
+    try:
+        for file_count, shard_seen_ids, shard_index_ids, shard_related_bills in pool.imap_unordered(process_bill_shard, [(shard, options) for shard in shards]):
+            for i in xrange(file_count): progress.tick()
+            seen_bill_ids.extend(shard_seen_ids)
+            related_bills.extend(shard_related_bills)
+            if bill_index:
+                index_queue.extend(shard_index_ids)
+                while len(index_queue) >= INDEX_BATCH_SIZE:
+                    index_bills(bill_index, index_queue[:INDEX_BATCH_SIZE])
+                    del index_queue[:INDEX_BATCH_SIZE]
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    if bill_index and index_queue:
+        index_bills(bill_index, index_queue)
+
+    # Now that every shard's bills exist, save the related bills.
+    log.info('Saving related bills of %d bills' % len(related_bills))
+    for bill_id, related in related_bills:
+        save_related_bills(bill_id, related)
+
+    return seen_bill_ids
+
+def index_bills(bill_index, bill_ids):
+    bills = bill_index.index_queryset(using="bill").filter(id__in=bill_ids)
+    backend = bill_index._get_backend("bill")
+    if hasattr(backend, "bulk_update"):
+        backend.bulk_update(bill_index, bills) # Xapian: one database open and commit
+    else:
+        backend.update(bill_index, bills)
+
 def main(options):
     """
     Process bill terms and bills
     """
 
+    # Look up sponsor and cosponsor roles in memory rather than with a query each.
+    enable_role_index()
+
     # Terms
 
     term_processor = TermProcessor()
@@ -299,103 +511,45 @@ def main(options):
         files = [f for f in files if re.match(options.filter, f)]
         
     log.info('Processing bills: %d files' % len(files))
-    total = len(files)
-    progress = Progress(total=total, name='files', step=100)
 
-    bill_processor = BillProcessor()
-    seen_bill_ids = []
-    for fname in files:
-        progress.tick()
-        
-        # With indexing or events enabled, if the bill metadata file hasn't changed check
-        # the bill's latest text file for changes so we can create a text-is-available
-        # event and so we can index the bill's text.
-        if (not options.congress or options.congress>42) and (bill_index and not options.disable_events) and not File.objects.is_changed(fname) and not options.force:
-            m = re.search(r"/(\d+)/bills/([a-z]+)(\d+)\.xml$", fname)
+    # Refresh the bill text manifests, which record the available text versions
+    # of each bill, before checking the bills for new text.
+    for congress in sorted(set(int(re.search(r"data/(?:us|congress)/(\d+)/", f).group(1)) for f in files)):
+        n = build_bill_text_manifest(congress)
+        if n is not None:
+            log.info('Bill text manifest for congress#%d: %d bills with text' % (congress, n))
 
-            try:
-                b = Bill.objects.get(congress=m.group(1), bill_type=BillType.by_xml_code(m.group(2)), number=m.group(3))
-                seen_bill_ids.append(b.id)
-                
-                # Update the index/events for any bill with recently changed text
-                textfile = get_bill_text_metadata(b, None)
-                if not textfile:
-                    if b.congress >= 103 and b.introduced_date < (datetime.now()-timedelta(days=14)).date():
-                        print "No bill text?", fname, b.introduced_date
-                    continue
-                textfile = textfile["text_file"]
-                if os.path.exists(textfile) and File.objects.is_changed(textfile):
-                    bill_index.update_object(b, using="bill") # index the full text
-                    b.create_events() # events for new bill text documents
-                    File.objects.save_file(textfile)
-                    
-                continue
-            except Bill.DoesNotExist:
-                print "Unchanged metadata file but bill doesn't exist:", fname
-                pass # just parse as normal
-            
-        if options.slow:
-            time.sleep(1)
-            
-        tree = etree.parse(fname)
-        for node in tree.xpath('/bill'):
-            try:
-                bill = bill_processor.process(Bill(), node)
-            except:
-                print fname
-                raise
-           
-            seen_bill_ids.append(bill.id) # don't delete me later
-            
-            if bill.congress >= 93:
-                bill.source = "thomas-congproj"
-            elif bill.congress >= 82:
-                bill.source = "statutesatlarge"
-                if bill.current_status == BillStatus.enacted_signed: bill.current_status = BillStatus.enacted_unknown
-            elif bill.congress <= 42:
-                bill.source = "americanmemory"
-            else:
-                raise ValueError()
+    workers = int(getattr(options, "workers", None) or 1)
+    if workers > 1:
+        seen_bill_ids = process_bill_files_parallel(files, options, workers, bill_index)
+    else:
+        seen_bill_ids = []
+        progress = Progress(total=len(files), name='files', step=100)
+        bill_processor = BillProcessor()
+        # Index bills in batches rather than opening the index for each bill.
+        index_queue = []
+        def reindex(b):
+            index_queue.append(b.id)
+            if len(index_queue) >= INDEX_BATCH_SIZE:
+                index_bills(bill_index, index_queue)
+                del index_queue[:]
+        with File.objects.preload(os.path.commonprefix(files)) as file_index, Event.batch():
+            for fname in files:
+                progress.tick()
+                seen_bill_ids.extend(process_bill_file(fname, options, bill_processor, reindex if bill_index else None, file_index))
+        if index_queue:
+            index_bills(bill_index, index_queue)
 
-            # So far this is just for American Memory bills.
-            if node.xpath("string(source/@url)"):
-                bill.source_link = unicode(node.xpath("string(source/@url)"))
-            else:
-                bill.source_link = None
-
-            actions = []
-            for axn in tree.xpath("actions/*[@state]"):
-                actions.append( (
-                	repr(bill_processor.parse_datetime(axn.xpath("string(@datetime)"))),
-                	BillStatus.by_xml_code(axn.xpath("string(@state)")),
-                	axn.xpath("string(text)"),
-                    etree.tostring(axn),
-                	) )
-                
-            bill.sliplawpubpriv = None
-            bill.sliplawnum = None
-            for axn in tree.xpath("actions/enacted"):
-                bill.sliplawpubpriv = "PUB" if axn.get("type") == "public" else "PRI"
-                bill.sliplawnum = int(axn.get("number").split("-")[1])
-                    
-            bill.major_actions = actions
-            try:
-                bill.save()
-            except:
-                print bill
-                raise
-            if bill_index: bill_index.update_object(bill, using="bill")
-            
-            if not options.disable_events:
-                bill.create_events()
-                
-        File.objects.save_file(fname)
-        
     # delete bill objects that are no longer represented on disk.... this is too dangerous.
     if options.congress and not options.filter:
         # this doesn't work because seen_bill_ids is too big for sqlite!
         for b in Bill.objects.filter(congress=options.congress).exclude(id__in = seen_bill_ids):
             print "Bill is no longer on disk: ", b.id, b
+
+    # Refresh the counts shown on the bill docket and statistics pages, and
+    # have the bill search's in-memory facet counts reload.
+    refresh_bill_aggregates()
+    invalidate_facet_index(Bill)
         
     # The rest is for current only...
     
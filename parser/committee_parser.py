@@ -14,6 +14,7 @@ from parser.models import File
 from committee.models import (Committee, CommitteeType, CommitteeMember,
                               CommitteeMemberRole, CommitteeMeeting)
 from person.models import Person
+from person.profile import invalidate_person_profiles
 from bill.models import Bill, BillType
 
 import json, re
@@ -161,6 +162,9 @@ def main(options):
             progress.tick()
 
         File.objects.save_file(MEMBERS_FILE)
+
+        # Rebuild the cached member profile pages with the new assignments.
+        invalidate_person_profiles()
         
     log.info('Processing committee schedule')
     loaded_meetings = set()
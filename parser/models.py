@@ -3,9 +3,11 @@ Internal info about statuses
 of previus parsings.
 """
 import binascii
+import os
+from datetime import datetime
 from StringIO import StringIO
 
-from django.db import models
+from django.db import models, transaction
 
 def crc(fname, content=None):
     """
@@ -23,6 +25,16 @@ def crc(fname, content=None):
     fobj.close()
     return "%08x" % value
 
+def file_stat(fname):
+    """
+    Return the size and modification time (to the second) of the file,
+    which we use to skip computing checksums of files that haven't been
+    touched since we last saw them.
+    """
+
+    st = os.stat(fname)
+    return st.st_size, datetime.fromtimestamp(int(st.st_mtime))
+
 
 class FileManager(models.Manager):
     def is_changed(self, path, content=None):
@@ -33,13 +45,13 @@ class FileManager(models.Manager):
         is stored in DB.
         """
         
-        checksum = crc(path, content)
         try:
             fobj = File.objects.get(path=path)
         except File.DoesNotExist:
             return True
-        else:
-            return str(fobj.checksum) != checksum
+        if content is None and fobj.size is not None and (fobj.size, fobj.mtime) == file_stat(path):
+            return False
+        return str(fobj.checksum) != crc(path, content)
 
     def save_file(self, path, content=None):
         """
@@ -52,8 +64,114 @@ class FileManager(models.Manager):
         except File.DoesNotExist:
             fobj = File(path=path)
         fobj.checksum = checksum
+        fobj.size, fobj.mtime = file_stat(path) if content is None else (None, None)
         fobj.save()
 
+    def preload(self, prefix):
+        """
+        Load the checksums of all files whose paths start with prefix in
+        one query. Returns a FileIndex which has the same is_changed and
+        save_file methods as this manager, but which saves checksums in
+        bulk when it is flushed (or used as a context manager and exited).
+        """
+
+        return FileIndex(prefix)
+
+
+class FileIndex(object):
+    """
+    In-memory view of the stored checksums for a part of the data
+    directory, for parsers that check many files in one run.
+
+        with File.objects.preload("data/us/113/rolls/") as files:
+            for fname in ...:
+                if not files.is_changed(fname): continue
+                ...
+                files.save_file(fname)
+    """
+
+    FLUSH_BATCH_SIZE = 500
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.records = { }
+        for path, checksum, size, mtime in File.objects.filter(path__startswith=prefix).values_list("path", "checksum", "size", "mtime"):
+            self.records[path] = (str(checksum), size, mtime)
+        self.computed = { } # path => (checksum, size, mtime) computed during this run
+        self.pending = { } # path => (checksum, size, mtime) not yet written to the database
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        # If the run failed, don't record the files as processed: whatever
+        # was derived from them (e.g. events buffered in an Event.batch)
+        # may not have been written.
+        if type is None:
+            self.flush()
+        return False
+
+    def _compute(self, path, stat):
+        if path in self.computed and self.computed[path][1:] == stat:
+            return self.computed[path][0]
+        checksum = crc(path)
+        self.computed[path] = (checksum,) + stat
+        return checksum
+
+    def is_changed(self, path, content=None):
+        if not path.startswith(self.prefix):
+            return File.objects.is_changed(path, content)
+
+        if path not in self.records:
+            return True
+        checksum, size, mtime = self.records[path]
+
+        if content is not None:
+            return checksum != crc(path, content)
+
+        # If the file hasn't been touched, don't bother reading it.
+        stat = file_stat(path)
+        if size is not None and (size, mtime) == stat:
+            return False
+
+        new_checksum = self._compute(path, stat)
+        if new_checksum == checksum:
+            # Touched but not changed. Remember the new size and mtime
+            # so that next time we can skip reading the file.
+            self.records[path] = self.pending[path] = (checksum,) + stat
+            return False
+        return True
+
+    def save_file(self, path, content=None):
+        if not path.startswith(self.prefix):
+            File.objects.save_file(path, content)
+            return
+
+        if content is not None:
+            rec = (crc(path, content), None, None)
+        else:
+            stat = file_stat(path)
+            rec = (self._compute(path, stat),) + stat
+        self.records[path] = self.pending[path] = rec
+
+    def flush(self):
+        """
+        Write the checksums saved since the last flush to the database.
+        """
+
+        if not self.pending:
+            return
+        paths = sorted(self.pending)
+        now = datetime.now()
+        with transaction.atomic():
+            for i in xrange(0, len(paths), self.FLUSH_BATCH_SIZE):
+                batch = paths[i:i+self.FLUSH_BATCH_SIZE]
+                File.objects.filter(path__in=batch).delete()
+                File.objects.bulk_create([
+                    File(path=path, checksum=self.pending[path][0], size=self.pending[path][1], mtime=self.pending[path][2], processed=now)
+                    for path in batch])
+        self.pending = { }
+
 
 class File(models.Model):
     """
@@ -62,6 +180,8 @@ class File(models.Model):
 
     path = models.CharField(max_length=100, db_index=True)
     checksum = models.CharField(max_length=8)
+    size = models.IntegerField(blank=True, null=True)
+    mtime = models.DateTimeField(blank=True, null=True)
     processed = models.DateTimeField(auto_now=True)
 
     def __unicode__(self):
@@ -14,6 +14,7 @@ from parser.progress import Progress
 from parser.processor import YamlProcessor, yaml_load
 from parser.models import File
 from person.models import Person, PersonRole, Gender, RoleType, SenatorClass, SenatorRank
+from person.profile import invalidate_person_profiles
 from us import get_congress_dates
 
 from settings import CURRENT_CONGRESS, CONGRESS_LEGISLATORS_PATH
@@ -331,6 +332,9 @@ def main(options):
             f = BASE_PATH + p + ".yaml"
             File.objects.save_file(f)
 
+    # Rebuild the cached member profile pages with the new roles.
+    invalidate_person_profiles()
+
 
 if __name__ == '__main__':
     main()
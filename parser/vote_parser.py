@@ -4,6 +4,7 @@ Parser of roll call votes
 from lxml import etree
 import glob
 import re
+import os.path
 import logging
 
 from parser.progress import Progress
@@ -11,7 +12,7 @@ from parser.processor import XmlProcessor
 from person.models import Person, PersonRole
 from person.types import RoleType
 from parser.models import File
-from person.util import load_roles_at_date
+from person.util import load_roles_at_date, enable_role_index
 from bill.models import Bill, BillType, Amendment, AmendmentType
 from vote.models import (Vote, VoteOption, VoteSource, Voter,
                          CongressChamber, VoteCategory, VoterType)
@@ -111,6 +112,9 @@ def main(options):
     Parse rolls.
     """
     
+    # Look up voters' roles in memory rather than with a query per vote.
+    enable_role_index()
+
     # Setup XML processors
     vote_processor = VoteProcessor()
     option_processor = VoteOptionProcessor()
@@ -138,16 +142,22 @@ def main(options):
     progress = Progress(total=total, name='files', step=10)
 
     def log_delete_qs(qs):
-        if qs.count() == 0: return
+        # Returns whether any records were deleted.
+        if qs.count() == 0: return False
         print "Deleting obsoleted records: ", qs
         #if qs.count() > 3:
         #    print "Delete skipped..."
         #    return
         qs.delete()
+        return True
 
     seen_obj_ids = set()
+    updated_chambers = set()
     had_error = False
 
+    # Load the checksums of the roll files in one go. They're written back in bulk below.
+    file_index = File.objects.preload(os.path.commonprefix(files))
+
     for fname in files:
         progress.tick()
 
@@ -158,7 +168,7 @@ def main(options):
         except Vote.DoesNotExist:
             existing_vote = None
         
-        if not File.objects.is_changed(fname) and not options.force and existing_vote != None and not existing_vote.missing_data:
+        if not file_index.is_changed(fname) and not options.force and existing_vote != None and not existing_vote.missing_data:
             seen_obj_ids.add(existing_vote.id)
             continue
             
@@ -318,19 +328,33 @@ def main(options):
 
                 # pre-calculate totals
                 vote.calculate_totals()
+                updated_chambers.add((vote.congress, vote.chamber))
 
                 if not options.disable_events:
                     vote.create_event()
                     
-            File.objects.save_file(fname)
+            file_index.save_file(fname)
 
         except Exception, ex:
             log.error('Error in processing %s' % fname, exc_info=ex)
             had_error = True
+
+    file_index.flush()
         
     # delete vote objects that are no longer represented on disk
     if options.congress and not options.filter and not had_error:
-        log_delete_qs(Vote.objects.filter(congress=options.congress).exclude(id__in = seen_obj_ids))
+        obsolete_votes = Vote.objects.filter(congress=options.congress).exclude(id__in = seen_obj_ids)
+        obsolete_chambers = set(obsolete_votes.values_list("congress", "chamber").distinct())
+        if log_delete_qs(obsolete_votes):
+            updated_chambers |= obsolete_chambers
+
+    # Rebuild the voter matrices of the chambers with new, changed or deleted
+    # roll calls, since re-parsed votes update Voter rows in place, and count
+    # those roll calls into the member-vs-member agreement indexes. Chambers
+    # with no changes are left alone.
+    from vote.matrix import update_agreement_index
+    for congress, chamber in sorted(updated_chambers):
+        update_agreement_index(congress, chamber, rebuild_matrix=True)
 
 if __name__ == '__main__':
     main()
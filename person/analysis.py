@@ -13,6 +13,31 @@ def load_data(person):
         #"influence": load_influence_analysis(person),
     }
     
+def get_data_files(person):
+    # The files that load_data reads for the person, so that cached copies
+    # of its results can be checked for changes.
+    files = []
+    role = person.get_most_recent_congress_role(excl_trivial=True)
+    if role and role.most_recent_congress_number():
+        fname = get_sponsorship_analysis_file(role.most_recent_congress_number(), role.role_type)
+        if fname: files.extend([fname, fname.replace(".txt", "_meta.txt")])
+    role = person.get_most_recent_congress_role()
+    if role and role.most_recent_congress_number():
+        files.append(get_votes_analysis_file(role.most_recent_congress_number(), person))
+    return files
+
+def get_sponsorship_analysis_file(congressnumber, role_type):
+    fname = 'data/us/%d/stats/sponsorshipanalysis' % congressnumber
+    if role_type == RoleType.senator:
+        return fname + "_s.txt"
+    elif role_type == RoleType.representative:
+        return fname + "_h.txt"
+    else:
+        return None
+
+def get_votes_analysis_file(congressnumber, person):
+    return 'data/us/%d/stats/person/missedvotes/%d.csv' % (congressnumber, person.pk)
+
 def load_sponsorship_analysis(person):
     role = person.get_most_recent_congress_role(excl_trivial=True)
     if not role: return None
@@ -25,12 +50,10 @@ def load_sponsorship_analysis(person):
 def load_sponsorship_analysis2(congressnumber, role_type, person):
     data = { "congress": congressnumber, "current": congressnumber == CURRENT_CONGRESS }
     
-    fname = 'data/us/%d/stats/sponsorshipanalysis' % congressnumber
+    fname = get_sponsorship_analysis_file(congressnumber, role_type)
     if role_type == RoleType.senator:
-        fname += "_s.txt"
         data["chamber"] = "Senate"
     elif role_type == RoleType.representative:
-        fname += "_h.txt"
         data["chamber"] = "House of Representatives"
     else:
         return None
@@ -84,7 +107,7 @@ def load_votes_analysis(person):
     congressnumber = role.most_recent_congress_number()
     if not congressnumber: return None
     
-    fn = 'data/us/%d/stats/person/missedvotes/%d.csv' % (congressnumber, person.pk)
+    fn = get_votes_analysis_file(congressnumber, person)
     if not os.path.exists(fn): return None
     
     lifetime_rec = None
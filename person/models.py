@@ -4,7 +4,7 @@ from django.template.defaultfilters import slugify
 from django.conf import settings
 from django.core.cache import cache
 
-import datetime, json, os.path
+import datetime, os.path
 from dateutil.relativedelta import relativedelta
 
 from common import enum
@@ -177,6 +177,9 @@ class Person(models.Model):
         # A person may have two roles on the same date, such as when simultaneously
         # resigning from the House to take office in the Senate. In that case, return the
         # most recent role.
+        import person.util
+        if person.util._role_index_enabled:
+            return person.util.get_role_index().role_at(self.id, when)
         try:
             return self.roles.filter(startdate__lte=when, enddate__gte=when).order_by("-startdate")[0]
         except IndexError:
@@ -283,32 +286,19 @@ class Person(models.Model):
 
     @staticmethod
     def load_session_stats(session):
-      # Which Congress is it?
-        for congress, s, sd, ed in get_all_sessions():
-            if s == session: break # leaves "congress" variable set
-        else:
-            raise ValueError("Invalid session: %s" % session)
-
-        fn = "data/us/%d/stats/session-%s.json" % (congress, session)
-        try:
-            datafile = json.load(open(fn))
-            datafile["meta"]["congress"] = congress # save where we got this from
-            datafile["meta"]["session"] = session # save where we got this from
-            datafile["meta"]["startdate"] = sd
-            datafile["meta"]["enddate"] = ed
-        except IOError:
-            raise ValueError("No statistics are available for session %s." % session)
-
-        return datafile
+        """Returns the SessionStatsStore with the statistics for a session.
+        Raises ValueError if there are none."""
+        from person.stats_store import load_session_stats_store
+        return load_session_stats_store(session)
 
     def get_session_stats(self, session):
         datafile = Person.load_session_stats(session)
   
-        if str(self.id) not in datafile["people"]:
+        if not datafile.has_person(self.id):
             raise ValueError("No statistics available for person %d in session %s." % (self.id, session))
 
-        stats = datafile["people"][str(self.id)]
-        stats["meta"] = datafile["meta"] # copy this over
+        stats = datafile.person(self.id)
+        stats["meta"] = dict(datafile.meta) # copy this over
         return stats
 
     def get_feed(self, feed_type="p"):
@@ -0,0 +1,49 @@
+# Cached snapshots of the information shown on member profile pages. Each
+# snapshot records the data files it was built from and is rebuilt when any
+# of them changes. Snapshots are also dropped all at once, by bumping a
+# version number, when the person and committee parsers reload roles and
+# committee assignments. The version number starts from the current time
+# whenever it's missing from the cache (e.g. evicted), so it never goes back
+# to a number that older snapshots may still be cached under.
+
+from django.core.cache import cache
+
+import os.path, time
+
+PERSON_PROFILE_VERSION_KEY = "person_profile_version"
+PERSON_PROFILE_MAX_AGE = 60*60*24 # photos and other files not tracked below are picked up at least this often
+
+def get_person_profile_version():
+    version = cache.get(PERSON_PROFILE_VERSION_KEY)
+    if version is None:
+        cache.add(PERSON_PROFILE_VERSION_KEY, int(time.time()), None)
+        version = cache.get(PERSON_PROFILE_VERSION_KEY, int(time.time()))
+    return version
+
+def invalidate_person_profiles():
+    """Drops all of the cached profile snapshots. Called by the parsers
+    after they change roles or committee assignments."""
+    try:
+        cache.incr(PERSON_PROFILE_VERSION_KEY)
+    except ValueError:
+        # The counter is missing. Starting over from the current time puts
+        # it past any version an existing snapshot was cached under.
+        cache.set(PERSON_PROFILE_VERSION_KEY, int(time.time()), None)
+
+def get_files_stamp(files):
+    # The modification times of the files, or None for those that don't exist.
+    return [(fn, os.path.getmtime(fn) if os.path.exists(fn) else None) for fn in files]
+
+def get_person_profile(key, build_func):
+    """Returns the profile snapshot for the person identified by key (a
+    person ID or bioguide ID as given in the URL), calling build_func to
+    make it if the cached one is missing or stale. build_func returns a
+    tuple of the profile information and a list of the data files it read.
+    """
+    ck = "person_profile_%s_%d" % (key, get_person_profile_version())
+    snapshot = cache.get(ck)
+    if snapshot is None or snapshot["files"] != get_files_stamp(fn for fn, mtime in snapshot["files"]):
+        info, files = build_func()
+        snapshot = { "info": info, "files": get_files_stamp(files) }
+        cache.set(ck, snapshot, PERSON_PROFILE_MAX_AGE)
+    return snapshot["info"]
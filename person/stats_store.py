@@ -0,0 +1,255 @@
+# Compiled session statistics.
+#
+# analysis/session_stats.py writes the statistics for a session as one large
+# JSON file, data/us/<congress>/stats/session-<session>.json. Rather than
+# parsing all of it whenever one person's report card is shown, the file is
+# compiled into a store next to it:
+#
+#   session-<session>.store.dat holds each person's statistics as a separate
+#   JSON record. It is memory-mapped, so looking up a person parses just
+#   their record.
+#
+#   session-<session>.store.npz is the index: the offset of each person's
+#   record and, for each statistic and cohort, the people in the cohort
+#   ordered by rank along with their values, ranks and percentiles, which
+#   is what the leaderboards and CSV exports need. It also names the records
+#   file, which gets a new name each time the store is compiled so that an
+#   index is never read with another compilation's records.
+#
+# analysis/session_stats.py compiles the store right after it writes the JSON
+# file (see compile_session_stats_store, which can also be run by hand for
+# an existing JSON file). The web processes only open stores, never compile
+# them, and keep the most recently used ones open, reopening one when it's
+# replaced. Compiling holds a lock on session-<session>.store.lock so that
+# only one process at a time compiles a session, and files are written under
+# temporary names and renamed into place so that no process reads a partly
+# written file.
+
+import collections, fcntl, glob, json, mmap, os, tempfile, threading
+
+import numpy
+
+from us import get_all_sessions
+
+SESSION_STATS_STORE_CACHE_SIZE = 4 # sessions kept open in each process
+
+RankingEntry = collections.namedtuple("RankingEntry",
+    ["person_id", "role_id", "value", "rank_ascending", "rank_descending", "rank_ties", "percentile", "N"])
+
+class SessionStatsStore(object):
+    def __init__(self, meta, index, records):
+        self.meta = meta
+        self.records = records # the memory-mapped records file
+        self.offsets = index["offsets"].tolist() # record i is records[offsets[i]:offsets[i+1]]
+        self.rows = dict((pid, i) for i, pid in enumerate(index["person_ids"].tolist())) # person id => record index
+        self.role_ids = index["role_ids"]
+        self.cohorts = dict(zip(index["cohort_keys"].tolist(), index["cohort_sizes"].tolist())) # cohort key => number of people
+
+        # Rankings, concatenated. Ranking i covers rows rank_starts[i] up to
+        # rank_starts[i+1] of the rank_* arrays.
+        self.rankings = dict(((stat, cohort), i) for i, (stat, cohort)
+            in enumerate(zip(index["rank_stats"].tolist(), index["rank_cohorts"].tolist())))
+        self.rank_starts = index["rank_starts"]
+        self.rank_value_is_int = index["rank_value_is_int"]
+        self.rank_N = index["rank_N"]
+        self.rank_person_ids = index["rank_person_ids"]
+        self.rank_values = index["rank_values"]
+        self.rank_ascending = index["rank_ascending"]
+        self.rank_descending = index["rank_descending"]
+        self.rank_ties = index["rank_ties"]
+        self.rank_percentiles = index["rank_percentiles"]
+
+    def people(self):
+        return list(self.rows)
+
+    def has_person(self, person_id):
+        return person_id in self.rows
+
+    def person(self, person_id):
+        """Returns a new dict of the person's statistics, as in the JSON file.
+        Raises KeyError if the person has no statistics in the session."""
+        i = self.rows[person_id]
+        return json.loads(self.records[self.offsets[i]:self.offsets[i+1]])
+
+    def ranking_keys(self):
+        """Returns the (statistic, cohort key) pairs that have rankings."""
+        return list(self.rankings)
+
+    def ranking(self, stat, cohort):
+        """Returns a list of RankingEntry tuples for the people in the cohort
+        with a value for the statistic, from the highest value to the lowest,
+        or an empty list if the statistic isn't ranked within the cohort."""
+        if (stat, cohort) not in self.rankings:
+            return []
+        i = self.rankings[(stat, cohort)]
+        s = slice(self.rank_starts[i], self.rank_starts[i+1])
+        values = self.rank_values[s].tolist()
+        if self.rank_value_is_int[i]:
+            values = [int(v) for v in values]
+        person_ids = self.rank_person_ids[s].tolist()
+        return [RankingEntry(*row) for row in zip(
+            person_ids,
+            [int(self.role_ids[self.rows[pid]]) for pid in person_ids],
+            values,
+            self.rank_ascending[s].tolist(),
+            self.rank_descending[s].tolist(),
+            self.rank_ties[s].tolist(),
+            self.rank_percentiles[s].tolist(),
+            [int(self.rank_N[i])] * len(person_ids))]
+
+def get_session_stats_file(session):
+    """Returns the Congress, start and end dates, and statistics file of a session."""
+    for congress, s, sd, ed in get_all_sessions():
+        if s == session:
+            return congress, sd, ed, "data/us/%d/stats/session-%s.json" % (congress, session)
+    raise ValueError("Invalid session: %s" % session)
+
+_stores = collections.OrderedDict() # session => (stamp, store), least recently used first
+_stores_lock = threading.Lock()
+
+def load_session_stats_store(session):
+    """
+    Returns the SessionStatsStore for the session, as last compiled by
+    compile_session_stats_store. Raises ValueError if there are no compiled
+    statistics for the session or they can't be read.
+    """
+
+    congress, sd, ed, fn = get_session_stats_file(session)
+    index_fn = store_filename(fn) + ".npz"
+
+    with _stores_lock:
+        for attempt in (1, 2):
+            try:
+                st = os.stat(index_fn)
+            except OSError:
+                raise ValueError("No statistics are available for session %s." % session)
+            stamp = (st.st_mtime, st.st_size, st.st_ino)
+
+            entry = _stores.pop(session, None)
+            if entry is not None and entry[0] == stamp:
+                break
+            try:
+                store = open_store(fn)
+            except (IOError, OSError, KeyError) as e:
+                # e.g. not readable, or compiled in an older format
+                raise ValueError("Statistics for session %s could not be read: %s" % (session, e))
+            if store is not None:
+                store.meta["congress"] = congress # save where we got this from
+                store.meta["session"] = session # save where we got this from
+                store.meta["startdate"] = sd
+                store.meta["enddate"] = ed
+                entry = (stamp, store)
+                break
+            # The store was replaced while we were opening it. Try the new one.
+        else:
+            raise ValueError("Statistics for session %s are being replaced." % session)
+
+        _stores[session] = entry
+        while len(_stores) > SESSION_STATS_STORE_CACHE_SIZE:
+            _stores.popitem(last=False)
+        return entry[1]
+
+def store_filename(fn):
+    return fn.replace(".json", ".store")
+
+def open_store(fn):
+    # Returns the compiled store for the JSON file, or None if its records
+    # file was removed because the store was replaced by a new compilation
+    # while it was being opened.
+    index = numpy.load(store_filename(fn) + ".npz")
+    try:
+        records_fn = os.path.join(os.path.dirname(fn), str(index["records_file"]))
+        try:
+            f = open(records_fn, "rb")
+        except IOError:
+            if os.path.exists(records_fn): raise
+            return None
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                records = "" # mmap can't map an empty file
+            else:
+                records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return SessionStatsStore(json.loads(index["meta"].tolist()), index, records)
+    finally:
+        index.close()
+
+def compile_session_stats_store(session):
+    """Compiles the store for the session from its JSON file, replacing any
+    earlier compilation. Called by analysis/session_stats.py after it writes
+    the JSON file."""
+    congress, sd, ed, fn = get_session_stats_file(session)
+    with open(store_filename(fn) + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        compile_store(fn)
+
+def compile_store(fn):
+    # Compiles the store for the JSON file. Call with the lock held.
+    with open(fn) as f:
+        st = os.fstat(f.fileno())
+        stamp = (st.st_mtime, st.st_size)
+        datafile = json.load(f)
+    person_ids = sorted(int(pid) for pid in datafile["people"])
+
+    # Write each person's record and note where it starts.
+    offsets = [0]
+    role_ids = []
+    cohorts = { }
+    rankings = { } # (stat, cohort key) => [(rank_descending, person id, value, context)]
+    fd, records_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=os.path.basename(store_filename(fn)) + ".", suffix=".dat")
+    with os.fdopen(fd, "wb") as f:
+        for pid in person_ids:
+            person = datafile["people"][str(pid)]
+            record = json.dumps(person, separators=(',', ':'))
+            f.write(record)
+            offsets.append(offsets[-1] + len(record))
+            role_ids.append(int(person["role_id"]))
+            for c in person["cohorts"]:
+                cohorts[c["key"]] = cohorts.get(c["key"], 0) + 1
+            for stat, statinfo in person["stats"].items():
+                for cohort, context in statinfo.get("context", {}).items():
+                    rankings.setdefault((stat, cohort), []).append((context["rank_descending"], pid, statinfo["value"], context))
+    os.chmod(records_fn, 0644) # mkstemp makes it readable only by us
+
+    rank_keys = sorted(rankings)
+    rank_starts = [0]
+    rank_rows = []
+    for k in rank_keys:
+        rank_rows.extend(sorted(rankings[k]))
+        rank_starts.append(len(rank_rows))
+
+    fd, index_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=os.path.basename(store_filename(fn)) + ".", suffix=".npz.tmp")
+    with os.fdopen(fd, "wb") as f:
+        numpy.savez(f,
+            stamp=numpy.array(stamp, dtype=numpy.float64),
+            meta=numpy.array(json.dumps(datafile["meta"])),
+            records_file=numpy.array(os.path.basename(records_fn)),
+            person_ids=numpy.array(person_ids, dtype=numpy.int32),
+            offsets=numpy.array(offsets, dtype=numpy.int64),
+            role_ids=numpy.array(role_ids, dtype=numpy.int32),
+            cohort_keys=numpy.array(sorted(cohorts), dtype=str),
+            cohort_sizes=numpy.array([cohorts[c] for c in sorted(cohorts)], dtype=numpy.int32),
+            rank_stats=numpy.array([k[0] for k in rank_keys], dtype=str),
+            rank_cohorts=numpy.array([k[1] for k in rank_keys], dtype=str),
+            rank_starts=numpy.array(rank_starts, dtype=numpy.int32),
+            rank_value_is_int=numpy.array([
+                all(isinstance(r[2], (int, long)) for r in rankings[k])
+                for k in rank_keys], dtype=bool),
+            rank_N=numpy.array([rankings[k][0][3]["N"] for k in rank_keys], dtype=numpy.int32),
+            rank_person_ids=numpy.array([r[1] for r in rank_rows], dtype=numpy.int32),
+            rank_values=numpy.array([r[2] for r in rank_rows], dtype=numpy.float64),
+            rank_ascending=numpy.array([r[3]["rank_ascending"] for r in rank_rows], dtype=numpy.int32),
+            rank_descending=numpy.array([r[3]["rank_descending"] for r in rank_rows], dtype=numpy.int32),
+            rank_ties=numpy.array([r[3]["rank_ties"] for r in rank_rows], dtype=numpy.int32),
+            rank_percentiles=numpy.array([r[3]["percentile"] for r in rank_rows], dtype=numpy.int32),
+            )
+
+    os.chmod(index_fn, 0644)
+
+    # Replace the index in one step for any other process reading it. Then
+    # remove the records files of earlier compilations. A process that opened
+    # the old index just before this will find its records file gone and
+    # open the new index instead.
+    os.rename(index_fn, store_filename(fn) + ".npz")
+    for old_fn in glob.glob(store_filename(fn) + ".*.dat") + [store_filename(fn) + ".dat"]:
+        if old_fn != records_fn and os.path.exists(old_fn):
+            os.unlink(old_fn)
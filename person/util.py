@@ -1,4 +1,5 @@
-from datetime import datetime
+import bisect
+from datetime import date, datetime
 
 from committee.util import sort_members
 from committee.models import CommitteeMemberRole
@@ -32,9 +33,16 @@ def load_roles_at_date(persons, when=datetime.now()):
     """
     Find out representative/senator role of each person at given date.
 
-    This method is optimized for bulk operation.
+    This method is optimized for bulk operation. If the in-memory role
+    index has been enabled (see enable_role_index), the database is not
+    queried at all.
     """
 
+    if _role_index_enabled:
+        for person, role in zip(persons, get_role_index().roles_at(persons, when, role_types=(RoleType.representative, RoleType.senator))):
+            person.role = role
+        return None
+
     roles = PersonRole.objects.filter(startdate__lte=when, enddate__gte=when, role_type__in=(RoleType.representative, RoleType.senator), person__in=persons)
     roles_by_person = {}
     for role in roles:
@@ -42,3 +50,95 @@ def load_roles_at_date(persons, when=datetime.now()):
     for person in persons:
         person.role = roles_by_person.get(person.id)
     return None 
+
+
+class RoleIndex(object):
+    """
+    All PersonRole records held in memory, indexed for answering "what role
+    did this person have on this date" without querying the database.
+
+    For each person, the roles are kept sorted by start date along with the
+    running maximum of their end dates, so a lookup is a bisection on the
+    start dates followed by a short backwards scan that stops once no
+    earlier role can still be in effect.
+    """
+
+    def __init__(self):
+        self.roles = { } # person id => [roles sorted by startdate]
+        self.starts = { } # person id => [startdate]
+        self.max_ends = { } # person id => [max enddate of roles up to this index]
+        for role in PersonRole.objects.order_by('person', 'startdate', 'id'):
+            self.roles.setdefault(role.person_id, []).append(role)
+        for person_id, roles in self.roles.items():
+            self.starts[person_id] = [r.startdate for r in roles]
+            max_ends = []
+            for r in roles:
+                max_ends.append(max(max_ends[-1], r.enddate) if max_ends else r.enddate)
+            self.max_ends[person_id] = max_ends
+
+    def role_at(self, person_id, when, role_types=None):
+        """
+        Returns the role of the person on the date, or None. Like
+        Person.get_role_at_date, if two roles overlap the date the one that
+        started most recently is returned. role_types optionally restricts
+        the roles considered to a sequence of RoleType values.
+        """
+
+        if isinstance(when, datetime):
+            when = when.date()
+        if person_id not in self.roles:
+            return None
+        roles, max_ends = self.roles[person_id], self.max_ends[person_id]
+        i = bisect.bisect_right(self.starts[person_id], when) - 1
+        while i >= 0 and max_ends[i] >= when:
+            if roles[i].enddate >= when and (role_types is None or roles[i].role_type in role_types):
+                return roles[i]
+            i -= 1
+        return None
+
+    def roles_at(self, persons, dates, role_types=None):
+        """
+        Bulk lookup. persons is a sequence of Person instances or ids and
+        dates is either a single date/datetime or a sequence of them
+        parallel to persons. Returns a list of roles (or None) parallel
+        to persons.
+        """
+
+        if isinstance(dates, (date, datetime)):
+            dates = [dates] * len(persons)
+        return [
+            self.role_at(p if isinstance(p, (int, long)) else p.id, d, role_types=role_types)
+            for p, d in zip(persons, dates)]
+
+_role_index = None
+_role_index_enabled = False
+
+def get_role_index():
+    """
+    Returns the process-wide RoleIndex, loading it if it hasn't been loaded
+    since the roles last changed.
+    """
+
+    global _role_index
+    if _role_index is None:
+        _role_index = RoleIndex()
+    return _role_index
+
+def enable_role_index():
+    """
+    Make load_roles_at_date and Person.get_role_at_date answer from the
+    in-memory role index. Meant for batch jobs that look up many roles;
+    the index is reloaded whenever roles are saved or deleted in this
+    process, but changes made by other processes are not seen.
+    """
+
+    global _role_index_enabled
+    _role_index_enabled = True
+
+def invalidate_role_index(**kwargs):
+    global _role_index
+    _role_index = None
+
+from django.db.models.signals import post_save, post_delete
+post_save.connect(invalidate_role_index, sender=PersonRole)
+post_delete.connect(invalidate_role_index, sender=PersonRole)
@@ -15,12 +15,14 @@ from common.pagination import paginate
 
 import json, cPickle, base64, re
 
-from us import statelist, statenames, stateapportionment, state_abbr_from_name, stateabbrs, get_congress_dates
+from us import statelist, statenames, stateapportionment, state_abbr_from_name, stateabbrs, get_congress_dates, get_all_sessions
 
 from person.models import Person, PersonRole
 from person import analysis
 from person.types import RoleType
 from person.util import get_committee_assignments
+from person.profile import get_person_profile
+from person.stats_store import get_session_stats_file
 
 from events.models import Feed
 
@@ -58,6 +60,7 @@ def person_details(request, pk):
     
         # analysis
         analysis_data = analysis.load_data(person)
+        data_files = analysis.get_data_files(person)
         try:
             has_session_stats = person.get_session_stats('2014')
         except:
@@ -72,6 +75,10 @@ def person_details(request, pk):
                     has_session_stats = role.get_most_recent_session_stats()
                 except:
                     pass
+        data_files.append(get_session_stats_file('2014')[3])
+        if role:
+            congresses = role.congress_numbers() or []
+            data_files.extend(get_session_stats_file(s)[3] for c, s, sd, ed in get_all_sessions() if c in congresses)
         
         links = []
         if role.current:
@@ -81,6 +88,11 @@ def person_details(request, pk):
         if person.pvsid: links.append(("VoteSmart", "http://votesmart.org/candidate/" + person.pvsid, "fa fa-th-list"))
         if person.bioguideid: links.append(("Bioguide", "http://bioguide.congress.gov/scripts/biodisplay.pl?index=" + person.bioguideid, "fa fa-user"))
         if person.cspanid: links.append(("C-SPAN", "http://www.c-spanvideo.org/person/" + str(person.cspanid), "fa fa-youtube-play"))
+
+        cities = None
+        if role and role.district:
+            cities = get_district_cities("%s-%02d" % (role.state.lower(), role.district))
+            data_files.append(DISTRICT_CITIES_FILE)
     
         return {'person': person,
                 'role': role,
@@ -90,23 +102,21 @@ def person_details(request, pk):
                 'photo_credit': photo_credit,
                 'links': links,
                 'analysis_data': analysis_data,
-                'recent_bills': person.sponsored_bills.all().order_by('-introduced_date')[0:7],
                 'committeeassignments': get_committee_assignments(person),
                 'feed': person.get_feed(),
-                'cities': get_district_cities("%s-%02d" % (role.state.lower(), role.district)) if role and role.district else None,
+                'cities': cities,
                 'has_session_stats': has_session_stats,
-                }
+                }, data_files
 
-    #ck = "person_details_%s" % pk
-    #ret = cache.get(ck)
-    #if not ret:
-    #    ret = build_info()
-    #    cache.set(ck, ret, 600)
-    ret = build_info()
+    ret = get_person_profile(pk, build_info)
 
     # redirect to canonical URL
     if request.path != ret["person"].get_absolute_url():
         return redirect(ret["person"].get_absolute_url(), permanent=True)
+
+    # Not part of the snapshot since the bill parser adds bills all the time.
+    ret = dict(ret)
+    ret['recent_bills'] = list(ret["person"].sponsored_bills.all().order_by('-introduced_date')[0:7])
            
     return ret
 
@@ -310,32 +320,35 @@ def get_district_bounds_query(state, district):
                 
         return (center_lat, center_long, center_zoom)
 
+DISTRICT_CITIES_FILE = "data/misc/cd-intersection-data.json"
+_district_cities = None # (file modification time, { district id: description })
+
 def get_district_cities(district_id):
-    district_info = cache.get("district_cities_%s" % district_id)
-    if district_info:
-        if district_info == "NONE": district_info = None
-        return district_info
-    
+    # The descriptions of all districts are made when the file is first
+    # needed in this process, and again only if it changes.
+    global _district_cities
     # When debugging locally, this file may not exist.
-    if os.path.exists("data/misc/cd-intersection-data.json"):
-        district_info = json.load(open("data/misc/cd-intersection-data.json")).get(district_id)
-    else:
-        district_info = None
-    if district_info:
+    mtime = os.path.getmtime(DISTRICT_CITIES_FILE) if os.path.exists(DISTRICT_CITIES_FILE) else None
+    if _district_cities is None or _district_cities[0] != mtime:
+        _district_cities = (mtime, load_district_cities() if mtime is not None else { })
+    return _district_cities[1].get(district_id)
+
+def load_district_cities():
+    ret = { }
+    for district_id, district_info in json.load(open(DISTRICT_CITIES_FILE)).items():
+        if not district_info: continue
         locations_1 = [c["name"] for c in sorted(district_info, key=lambda c:-c["pct_of_district"]) if c["pct_of_locality"] > .98][0:8]
         locations_2 = [c["name"] for c in sorted(district_info, key=lambda c:-c["pct_of_locality"]) if c["pct_of_locality"] <= .98][0:8]
-        district_info = ", ".join(locations_1)
+        description = ", ".join(locations_1)
         if len(locations_2) > 2:
             if len(locations_1) > 0:
-                district_info += " and parts of "
+                description += " and parts of "
                 locations_2 = locations_2[0:5]
             else:
-                district_info += "Parts of "
-            district_info += ", ".join(locations_2)
-    
-    cache.set("district_cities_%s" % district_id, district_info if district_info != None else "NONE")
-    
-    return district_info
+                description += "Parts of "
+            description += ", ".join(locations_2)
+        ret[district_id] = description
+    return ret
     
 @anonymous_view
 @render_to('person/overview.html')
@@ -432,12 +445,12 @@ class sitemap_districts(django.contrib.sitemaps.Sitemap):
     def location(self, item):
         return "/congress/members/" + item[0] + ("/"+str(item[1]) if item[1] else "")
 
-def session_stats_period(session, stats):
-    if not stats['meta']['is_full_congress_stats']:
+def session_stats_period(session, meta):
+    if not meta['is_full_congress_stats']:
         return session
     else:
         from django.contrib.humanize.templatetags.humanize import ordinal
-        return "the %s Congress" % ordinal(stats['meta']['congress'])
+        return "the %s Congress" % ordinal(meta['congress'])
         
 @anonymous_view
 @render_to('person/person_session_stats.html')
@@ -480,7 +493,7 @@ def person_session_stats(request, pk, session):
 
     return {
         "publishdate": dateutil.parser.parse(stats["meta"]["as-of"]),
-        "period": session_stats_period(session, stats),
+        "period": session_stats_period(session, stats["meta"]),
         "congress_dates": (period_min, period_max),
         "person": person,
         "photo": person.get_photo()[0],
@@ -511,58 +524,54 @@ def person_session_stats_overview(request, session, cohort, specific_stat):
         raise Http404()
 
     # Get all of the cohorts in the data.
-    cohorts = { }
-    cohort_keys = set()
-    for person in stats["people"].values():
-        for c in person["cohorts"]:
-            c = c["key"]
-            cohorts[c] = cohorts.get(c, 0) + 1
-            cohort_keys.add(c)
-    cohorts = [ (-v, k, get_cohort_name(k, True), v) for k,v in cohorts.items() if "delegation" not in k and v > 10]
+    cohorts = [ (-v, k, get_cohort_name(k, True), v) for k,v in stats.cohorts.items() if "delegation" not in k and v > 10]
     cohorts = sorted(cohorts)
 
-    # Gather data.
+    # Gather data from the rankings of each statistic within each cohort.
     metrics = { }
-    for pid, person in stats["people"].items():
-        try:
-            personobj = Person.objects.get(id=int(pid))
-        except:
-            # debugging
-            continue
-
-        for stat, statinfo in person["stats"].items():
-            if specific_stat is not None and stat != specific_stat: continue
-
-            for cohort_key, context in statinfo.get("context", {}).items():
-                # filter by cohort, if we're doing that
-                if cohort is not None and cohort != cohort_key: continue
-                if cohort is None and cohort_key not in ("house", "senate"): continue
-
-                # create an entry for this statistic
-                metrics.setdefault(stat, {
-                    "key": stat,
-                    "title": stat_titles[stat]["title"],
-                    "icon": stat_titles[stat]["icon"],
-                    "contexts": { }
-                })
-                metrics[stat]["title"] = metrics[stat]["title"].replace("{{other_chamber}}", "Other Chamber")
-                metrics[stat]["contexts"].setdefault(cohort_key, {
-                    "key": cohort_key,
-                    "title": get_cohort_name(cohort_key, True),
-                    "N": context["N"],
-                    "people": ([], []),
-                    })
-
-                # if this person ranks #1, #2, #3, fill him in
-                c = metrics[stat]["contexts"][cohort_key]["people"]
-                if specific_stat is not None:
-                    c[0].append( (context["rank_descending"], statinfo["value"], personobj) )
-                elif context["rank_ties"] <= 3:
-                    if context["rank_ascending"] < 3 and stat in ("ideology", "leadership", "bills-with-cosponsors-both-parties", "cosponsored-other-party", "missed-votes"):
-                        c[1].append( (context["rank_descending"], statinfo["value"], personobj) )
-                    elif context["rank_descending"] < 3:
-                        c[0].append( (context["rank_descending"], statinfo["value"], personobj) )
-
+    for stat, cohort_key in stats.ranking_keys():
+        if specific_stat is not None and stat != specific_stat: continue
+
+        # filter by cohort, if we're doing that
+        if cohort is not None and cohort != cohort_key: continue
+        if cohort is None and cohort_key not in ("house", "senate"): continue
+
+        ranking = stats.ranking(stat, cohort_key)
+
+        # create an entry for this statistic
+        metrics.setdefault(stat, {
+            "key": stat,
+            "title": stat_titles[stat]["title"],
+            "icon": stat_titles[stat]["icon"],
+            "contexts": { }
+        })
+        metrics[stat]["title"] = metrics[stat]["title"].replace("{{other_chamber}}", "Other Chamber")
+        metrics[stat]["contexts"][cohort_key] = {
+            "key": cohort_key,
+            "title": get_cohort_name(cohort_key, True),
+            "N": ranking[0].N,
+            "people": ([], []),
+            }
+
+        # if this person ranks #1, #2, #3, fill him in
+        c = metrics[stat]["contexts"][cohort_key]["people"]
+        for entry in ranking:
+            if specific_stat is not None:
+                c[0].append(entry)
+            elif entry.rank_ties <= 3:
+                if entry.rank_ascending < 3 and stat in ("ideology", "leadership", "bills-with-cosponsors-both-parties", "cosponsored-other-party", "missed-votes"):
+                    c[1].append(entry)
+                elif entry.rank_descending < 3:
+                    c[0].append(entry)
+
+    # Load the people shown all at once.
+    people = Person.objects.in_bulk(set(entry.person_id
+        for m in metrics.values() for context in m["contexts"].values() for entries in context["people"] for entry in entries))
+    for m in metrics.values():
+        for context in m["contexts"].values():
+            context["people"] = tuple(
+                [(entry.rank_descending, entry.value, people[entry.person_id]) for entry in entries if entry.person_id in people] # missing people happen when debugging
+                for entries in context["people"])
 
     metrics = sorted(metrics.values(), key = lambda m : m["title"])
 
@@ -572,22 +581,18 @@ def person_session_stats_overview(request, session, cohort, specific_stat):
             c["people"][0].sort()
             c["people"][1].sort()
 
-    #from person.views_sessionstats import clean_person_stats
-    #for pid, personstats in stats["people"].items():
-    #    clean_person_stats(personstats)
-
     import dateutil.parser
     return {
         "session": session,
-        "period": session_stats_period(session, stats),
-        "meta": stats["meta"],
+        "period": session_stats_period(session, stats.meta),
+        "meta": stats.meta,
         "metrics": metrics,
         "cohorts": cohorts,
         "cohort": cohort,
         "cohort_title": cohort_title,
         "specific_stat": specific_stat,
         "specific_stat_title": stat_titles[specific_stat]["title"].replace("{{other_chamber}}", "Other Chamber") if specific_stat else None,
-        "publishdate": dateutil.parser.parse(stats["meta"]["as-of"]),
+        "publishdate": dateutil.parser.parse(stats.meta["as-of"]),
     }
 
 @anonymous_view
@@ -600,18 +605,15 @@ def person_session_stats_export(request, session, cohort, statistic):
 
     # collect data
     rows = []
-    for person_id, person_stats in stats["people"].items():
-        if cohort not in [c["key"] for c in person_stats["cohorts"]]: continue
-        if statistic not in person_stats["stats"]: continue
-        if "context" not in person_stats["stats"][statistic]: continue
+    for entry in stats.ranking(statistic, cohort):
         rows.append([
-            person_stats["stats"][statistic]["context"][cohort]["rank_ascending"],
-            person_stats["stats"][statistic]["context"][cohort]["rank_descending"],
-            person_stats["stats"][statistic]["context"][cohort]["percentile"],
-            person_stats["stats"][statistic]["value"],
-            int(person_id),
+            entry.rank_ascending,
+            entry.rank_descending,
+            entry.percentile,
+            entry.value,
+            entry.person_id,
 			"", # bioguide ID
-            int(person_stats["role_id"]),
+            entry.role_id,
             "", # state
             "", # district
             ])
@@ -0,0 +1,100 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from optparse import make_option
+
+from predictionmarket.models import Market, Outcome, Trade, TradingAccount, Position
+
+import random, time
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Measures trade throughput with simulated concurrent traders. Creates and then deletes its own users and markets, so run it against a local database.'
+	option_list = BaseCommand.option_list + (
+		make_option('--markets', default='1,2,4,8',
+			help='Comma-separated numbers of markets to spread the trades over, one run each.'),
+		make_option('--traders', type='int', default=8,
+			help='The number of concurrent trader processes.'),
+		make_option('--trades', type='int', default=200,
+			help='The number of trades each trader places per run.'),
+		make_option('--force', action='store_true', default=False,
+			help='Run even if DEBUG is off.'),
+		)
+
+	def handle(self, *args, **options):
+		import multiprocessing
+		from django.db import connection
+
+		if not settings.DEBUG and not options["force"]:
+			raise CommandError("This creates and deletes test data. Run it against a local database with DEBUG on, or pass --force.")
+
+		users = [User.objects.create(username="benchmark-trader-%d-%d" % (i, random.randint(0, 10**9)))
+			for i in xrange(options["traders"])]
+		accounts = [TradingAccount.objects.create(user=u, balance=1e9) for u in users]
+		markets = []
+		try:
+			for num_markets in [int(n) for n in options["markets"].split(",")]:
+				run_markets = [make_market(users[0], "Benchmark market %d" % i) for i in xrange(num_markets)]
+				markets.extend(run_markets)
+				outcome_ids = list(Outcome.objects.filter(market__in=run_markets).values_list("id", flat=True))
+
+				# Each forked worker opens its own database connection.
+				connection.close()
+				pool = multiprocessing.Pool(options["traders"], worker_init)
+				try:
+					t0 = time.time()
+					errors = sum(pool.map(run_trader, [(a.id, outcome_ids, options["trades"], i) for i, a in enumerate(accounts)]))
+					elapsed = time.time() - t0
+					pool.close()
+				except:
+					pool.terminate()
+					raise
+				finally:
+					pool.join()
+
+				trades = Trade.objects.filter(outcome__market__in=run_markets).count()
+				print "%d markets, %d traders: %d trades in %.1f seconds, %.1f trades/sec, %d errors" % (
+					num_markets, options["traders"], trades, elapsed, trades/elapsed, errors)
+		finally:
+			Position.objects.filter(account__in=accounts).delete()
+			Trade.objects.filter(account__in=accounts).delete()
+			Outcome.objects.filter(market__in=markets).delete()
+			Market.objects.filter(id__in=[m.id for m in markets]).delete()
+			TradingAccount.objects.filter(id__in=[a.id for a in accounts]).delete()
+			User.objects.filter(id__in=[u.id for u in users]).delete()
+
+def make_market(owner, name):
+	m = Market()
+	m.owner_object = owner
+	m.owner_key = "benchmark"
+	m.name = name
+	m.volatility = 200.0
+	m.save()
+	for k, v in ((0, "No"), (1, "Yes")):
+		Outcome.objects.create(market=m, owner_key=k, name=v)
+	return m
+
+def worker_init():
+	from django.db import connection
+	connection.close()
+
+def run_trader(args):
+	# Buys shares of random outcomes, selling them back half of the time.
+	account_id, outcome_ids, num_trades, seed = args
+	rand = random.Random(seed)
+	account = TradingAccount.objects.get(id=account_id)
+	outcomes = dict((o.id, o) for o in Outcome.objects.filter(id__in=outcome_ids))
+	held = { }
+	errors = 0
+	for i in xrange(num_trades):
+		outcome = outcomes[rand.choice(outcome_ids)]
+		shares = rand.randint(1, 10)
+		if held.get(outcome.id, 0) >= shares and rand.random() < .5:
+			shares = -shares
+		try:
+			Trade.place(account, outcome, shares)
+			held[outcome.id] = held.get(outcome.id, 0) + shares
+		except Exception:
+			errors += 1
+	return errors
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from predictionmarket.models import Trade, Position
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Rebuilds the position table by replaying all trades. Run once after creating the table.'
+	
+	def handle(self, *args, **options):
+		positions = { }
+		for trade in Trade.objects.order_by('created', 'id'):
+			key = (trade.account_id, trade.outcome_id)
+			if key not in positions:
+				positions[key] = Position(account_id=trade.account_id, outcome_id=trade.outcome_id)
+			positions[key].add_trade(trade)
+		
+		Position.objects.all().delete()
+		Position.objects.bulk_create(positions.values(), batch_size=1000)
+		print "Rebuilt %d positions." % len(positions)
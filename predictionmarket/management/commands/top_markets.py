@@ -15,9 +15,11 @@ class Command(BaseCommand):
 	def handle(self, *args, **options):
 		bank = TradingAccount.get(User.objects.get(id=settings.PREDICTIONMARKET_BANK_UID))
 		
-		for market in Market.objects.order_by('-tradecount')[0:10]:
+		markets = list(Market.objects.order_by('-tradecount')[0:10])
+		bank_positions = bank.positions(outcome__market__in=markets)
+		for market in markets:
 			print market
 			for outcome, price in market.prices().items():
-				bank_shares = bank.positions(outcome=outcome).get(outcome, { "shares": 0 })["shares"]
+				bank_shares = bank_positions.get(outcome, { "shares": 0 })["shares"]
 				print round(price*100, 1), outcome, "@", outcome.volume-bank_shares, "outstanding shares"
 			print
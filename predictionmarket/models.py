@@ -1,4 +1,5 @@
-from django.db import models, connection
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
@@ -32,21 +33,27 @@ class TradingAccount(models.Model):
 	def positions(self, **filters):
 		"""Returns a dict from Outcomes to a dict containing shares held of each outcome,
 		the principle invested, and current unrealized profit/loss (i.e. if sold now)."""
-		def tuple_add(a, b):
-			return (a[0]+b[0], a[1]+b[1])
+		# Positions are kept up to date as trades are placed (see Position), so
+		# there is no need to replay the account's trades. The sale values are
+		# computed a market at a time.
+		holdings = list(Position.objects.filter(account=self, **filters).exclude(shares=0)
+			.select_related("outcome", "outcome__market"))
+		outcomes = { }
+		for outcome in Outcome.objects.filter(market__in=set(h.outcome.market_id for h in holdings)):
+			outcomes.setdefault(outcome.market_id, []).append(outcome)
+		markets = { }
+		for h in holdings:
+			markets.setdefault(h.outcome.market, { })[h.outcome] = h
 		p = { }
-		for trade in Trade.objects.filter(account=self, **filters).select_related("outcome", "outcome__market").order_by('created'):
-			p[trade.outcome] = tuple_add(p.get(trade.outcome, (0, 0)), (trade.shares, -trade.value))
-			if p[trade.outcome][0] == 0: del p[trade.outcome] # clear when we hit zero so we don't carry forward *realized* profits/losses
-		p2 = { }
-		for outcome in p:
-			if p[outcome][0] != 0:
-				p2[outcome] = {
-					"shares": p[outcome][0],
-					"principle": -p[outcome][1],
-					"profitloss": -(outcome.market.transaction_cost({ outcome: -p[outcome][0] }) + p[outcome][1])
+		for market, market_holdings in markets.items():
+			sale_values = market.sale_values(dict((outcome, h.shares) for outcome, h in market_holdings.items()), outcomes=outcomes[market.id])
+			for outcome, h in market_holdings.items():
+				p[outcome] = {
+					"shares": h.shares,
+					"principle": -h.cost,
+					"profitloss": sale_values[outcome] - h.cost,
 				}
-		return p2
+		return p
 
 	def position_in_market(self, market):
 		"""Returns a tuple of total number of shares held by this account in an outcome,
@@ -143,15 +150,31 @@ class Market(models.Model):
 		next_shares = dict((outcome, outcome.volume+shares.get(outcome, 0)) for outcome in outcomes)
 		return self.cost_function(next_shares, outcomes) - self.cost_function(current_shares, outcomes)
 		
+	def sale_values(self, holdings, outcomes=None):
+		"""Returns a dict from Outcome instances to the amount received by selling the
+		number of shares of the outcome given in holdings, a dict from Outcome instances
+		to shares, with each sale considered on its own. This is the same as
+		-transaction_cost({ outcome: -shares }) for each outcome, but the terms of the
+		cost function are computed once for the whole market."""
+		if not outcomes: outcomes = list(self.outcomes.all()) # let the caller cache the objects
+		volumes = dict((outcome, outcome.volume) for outcome in outcomes)
+		terms = dict((outcome, exp(volumes[outcome] / self.volatility)) for outcome in outcomes)
+		total = sum(terms.values())
+		ret = { }
+		for outcome, shares in holdings.items():
+			after = total - terms[outcome] + exp((volumes[outcome] - shares) / self.volatility)
+			ret[outcome] = -self.volatility * (log(after) - log(total))
+		return ret
+		
 	def close_market(self):
-		# Any fields that are used during a trade should be modified synchronously.
-		cursor = connection.cursor()
-		cursor.execute("LOCK TABLES %s WRITE" % Market._meta.db_table)
-		try:
-			self.isopen = False
-			self.save()
-		finally:
-			cursor.execute("UNLOCK TABLES")
+		# Trades check isopen while holding the market's row lock, so taking the
+		# same lock here makes sure no trade slips in after the market closes.
+		# Only isopen is written: this instance's volume and tradecount may be
+		# stale, since trades update those in the database with F() expressions.
+		with transaction.atomic():
+			Market.objects.select_for_update().get(id=self.id)
+			Market.objects.filter(id=self.id).update(isopen=False)
+		self.isopen = False
 		
 class Outcome(models.Model):
 	market = models.ForeignKey(Market, related_name="outcomes")
@@ -172,39 +195,30 @@ class Outcome(models.Model):
 		outcome volumes or tradecounts, since they are no longer relevant."""
 		
 		# This method forces everyone to sell remaining shares at a price we set.
-		# The difficultly with this function is that the only way to know how many
-		# shares to sell for an account is to compute the account's position, which
-		# requires summing across all trades.
+		# The market's row lock keeps this from interleaving with anything else
+		# in the market. Account balances are updated in place since the accounts
+		# may be trading in other markets at the same time.
 
-		cursor = connection.cursor()
-		cursor.execute("LOCK TABLES %s WRITE, %s WRITE, %s WRITE, %s WRITE" % (Trade._meta.db_table, Outcome._meta.db_table, Market._meta.db_table, TradingAccount._meta.db_table))
-		try:
-			if self.market.isopen: raise ValueError("Market is open!")
+		with transaction.atomic():
+			market = Market.objects.select_for_update().get(id=self.market_id)
+			if market.isopen: raise ValueError("Market is open!")
 			
-			# Compute the outstanding shares for each account.
-			account_positions = { }
-			for trade in self.trades.all():
-				account_positions[trade.account.id] = account_positions.get(trade.account.id, 0) + trade.shares
-				
-			for account, shares in account_positions.items():
-				if shares == 0: continue
-				
-				account = TradingAccount.objects.get(id=account)
+			# The outstanding shares for each account are in the position table.
+			account_positions = list(Position.objects.filter(outcome=self).exclude(shares=0).values_list("account", "shares"))
 				
+			for account, shares in account_positions:
 				# Record the transaction.
 				trade = Trade()
-				trade.account = account
+				trade.account_id = account
 				trade.outcome = self
 				trade.shares = -shares
 				trade.value = price*shares
 				trade.liquidation = True
 				trade.save()
+				Position.record(trade)
 				
 				# Update the account balance.
-				account.balance += price*shares
-				account.save()
-		finally:
-			cursor.execute("UNLOCK TABLES")
+				TradingAccount.objects.filter(id=account).update(balance=F("balance") + price*shares)
 		
 class Trade(models.Model):
 	account = models.ForeignKey(TradingAccount, related_name="trades")
@@ -226,22 +240,22 @@ class Trade(models.Model):
 		shares = int(shares)
 		if shares == 0: raise ValueException("shares must not be zero")
 		
-		# Trades must be synchronized because each trade affects the price of
-		# future trades. We must lock every table we touch during the transaction.
-		cursor = connection.cursor()
-		cursor.execute("LOCK TABLES %s WRITE, %s WRITE, %s WRITE, %s WRITE" % (Trade._meta.db_table, Outcome._meta.db_table, Market._meta.db_table, TradingAccount._meta.db_table))
-		try:
-			outcomes = list(outcome.market.outcomes.all())
+		# Trades in a market must be serialized because each trade affects the price
+		# of future trades in the market. Rather than locking whole tables, lock the
+		# market's row, which every trade, liquidation, and closing of the market
+		# takes first, so trades in different markets proceed in parallel. The
+		# account's row is locked next to check and debit its balance.
+		with transaction.atomic():
+			market = Market.objects.select_for_update().get(id=outcome.market_id)
+			if not market.isopen: raise ValueError("Market is closed.")
 			
 			# Refresh objects now that the lock is held.
-			account = TradingAccount.objects.get(id=account.id)
-			outcome = Outcome.objects.get(id=outcome.id)
-			market = Market.objects.get(id=outcome.market.id)
-			
-			if not market.isopen: raise ValueError("Market is closed.")
+			outcomes = list(market.outcomes.all())
+			outcome = [o for o in outcomes if o.id == outcome.id][0]
+			account = TradingAccount.objects.select_for_update().get(id=account.id)
 			
 			# What will this cost?
-			value = outcome.market.transaction_cost({ outcome: shares }, outcomes=outcomes)
+			value = market.transaction_cost({ outcome: shares }, outcomes=outcomes)
 			
 			if shares > 0:
 				# If a buy, check that the account has enough money for this.
@@ -252,9 +266,9 @@ class Trade(models.Model):
 				# shares doesn't hurt the cost function, it does make an outcome's volume difficult to
 				# interpret (0 might mean an equal amount of buying and selling) and makes a market's
 				# volume completely nonsensical.
-				pos = Trade.objects.filter(account=account, outcome=outcome).aggregate(shares=models.Sum("shares"))
-				if pos["shares"] == None or pos["shares"] < shares:
-					raise ValueError("Account does not have sufficient shares: %d needed." % shares)
+				pos = Position.objects.filter(account=account, outcome=outcome).values_list("shares", flat=True)
+				if len(pos) == 0 or pos[0] < -shares:
+					raise ValueError("Account does not have sufficient shares: %d needed." % -shares)
 		
 			# Record the transaction.
 			trade = Trade()
@@ -264,22 +278,43 @@ class Trade(models.Model):
 			trade.value = -value
 			trade.liquidation = False
 			trade.save()
+			Position.record(trade)
 			
 			# Update the account balance.
-			account.balance -= value
-			account.save()
+			TradingAccount.objects.filter(id=account.id).update(balance=F("balance") - value)
 			
 			# Update the outcome and market volumes and total trades count.
-			outcome.volume += shares
-			outcome.tradecount += 1
-			outcome.save()
-			
-			market.volume += shares
-			market.tradecount += 1
-			market.save()
-		finally:
-			cursor.execute("UNLOCK TABLES")
+			Outcome.objects.filter(id=outcome.id).update(volume=F("volume") + shares, tradecount=F("tradecount") + 1)
+			Market.objects.filter(id=market.id).update(volume=F("volume") + shares, tradecount=F("tradecount") + 1)
 			
 		return trade
-		
 
+class Position(models.Model):
+	"""The shares an account holds of an outcome and what it paid for them, kept up
+	to date as trades are placed so that an account's positions are known without
+	replaying its trades. The cost is reset when the shares held return to zero so
+	that realized profits/losses are not carried forward."""
+	account = models.ForeignKey(TradingAccount, related_name="positions_held")
+	outcome = models.ForeignKey(Outcome, related_name="positions")
+	shares = models.IntegerField(default=0) # shares currently held
+	cost = models.FloatField(default=0.0) # net amount paid for the shares currently held
+
+	class Meta:
+		unique_together = (('account', 'outcome'),)
+
+	def __unicode__(self):
+		return u"%s: %d of %s" % (unicode(self.account), self.shares, unicode(self.outcome))
+
+	def add_trade(self, trade):
+		self.shares += trade.shares
+		self.cost -= trade.value
+		if self.shares == 0: self.cost = 0.0
+
+	@staticmethod
+	def record(trade):
+		"""Updates the account's position in the outcome for a trade that was just
+		saved. Must be called in the same transaction as the trade, while holding
+		the market's row lock."""
+		pos, isnew = Position.objects.get_or_create(account=trade.account, outcome=trade.outcome)
+		pos.add_trade(trade)
+		pos.save()
@@ -0,0 +1,72 @@
+from django.test import TestCase
+from django.core.management import call_command
+from django.contrib.auth.models import User
+
+from predictionmarket.models import Market, Outcome, Trade, TradingAccount, Position
+
+class PositionTests(TestCase):
+	def setUp(self):
+		self.users = [User.objects.create(username="trader%d" % i) for i in xrange(2)]
+		self.accounts = [TradingAccount.objects.create(user=u, balance=1e6) for u in self.users]
+		self.market = Market()
+		self.market.owner_object = self.users[0]
+		self.market.owner_key = "test"
+		self.market.name = "Test market"
+		self.market.volatility = 20.0
+		self.market.save()
+		self.no = Outcome.objects.create(market=self.market, owner_key="0", name="No")
+		self.yes = Outcome.objects.create(market=self.market, owner_key="1", name="Yes")
+
+		a, b = self.accounts
+		for account, outcome, shares in (
+			(a, self.yes, 10), (a, self.no, 5), (b, self.no, 7), (a, self.yes, -4),
+			(b, self.yes, 3), (a, self.yes, -6), # a is back to zero shares of yes
+			(a, self.yes, 8), (b, self.no, -2), (b, self.no, -5), # and b of no
+			(b, self.no, 4)):
+			Trade.place(account, outcome, shares)
+
+	def replay_positions(self, account):
+		# How TradingAccount.positions used to compute positions, by replaying
+		# the account's trades.
+		p = { }
+		for trade in Trade.objects.filter(account=account).select_related("outcome", "outcome__market").order_by('created', 'id'):
+			shares, cost = p.get(trade.outcome, (0, 0))
+			p[trade.outcome] = (shares + trade.shares, cost - trade.value)
+			if p[trade.outcome][0] == 0: del p[trade.outcome]
+		ret = { }
+		for outcome, (shares, cost) in p.items():
+			ret[outcome] = {
+				"shares": shares,
+				"principle": -cost,
+				"profitloss": -(outcome.market.transaction_cost({ outcome: -shares }) + cost),
+			}
+		return ret
+
+	def test_positions_match_replay(self):
+		for account in self.accounts:
+			positions = account.positions()
+			expected = self.replay_positions(account)
+			self.assertEqual(sorted(o.id for o in positions), sorted(o.id for o in expected))
+			for outcome in expected:
+				self.assertEqual(positions[outcome]["shares"], expected[outcome]["shares"])
+				self.assertAlmostEqual(positions[outcome]["principle"], expected[outcome]["principle"])
+				self.assertAlmostEqual(positions[outcome]["profitloss"], expected[outcome]["profitloss"])
+
+	def test_sale_values_match_transaction_cost(self):
+		market = Market.objects.get(id=self.market.id)
+		outcomes = list(market.outcomes.all())
+		holdings = dict((o, s) for o, s in zip(outcomes, (9, 4)))
+		sale_values = market.sale_values(holdings)
+		for outcome, shares in holdings.items():
+			self.assertAlmostEqual(sale_values[outcome], -market.transaction_cost({ outcome: -shares }, outcomes=outcomes))
+
+	def test_rebuild_positions(self):
+		def rows():
+			return sorted(Position.objects.values_list("account", "outcome", "shares", "cost"))
+		incremental = rows()
+		call_command("rebuild_positions")
+		rebuilt = rows()
+		self.assertEqual(len(rebuilt), len(incremental))
+		for r1, r2 in zip(incremental, rebuilt):
+			self.assertEqual(r1[0:3], r2[0:3])
+			self.assertAlmostEqual(r1[3], r2[3])
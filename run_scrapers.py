@@ -128,7 +128,7 @@ if "text" in sys.argv:
 	# Scrape with legacy scraper to get PDFs (only a local cache for creating thumbnails),
 	# HTML (only used in bill text comparisons).
 	os.system("cd ../scripts/gather; perl fetchbilltext.pl FULLTEXT %d" % CONGRESS)
-	do_bill_parse = True # don't know if we got any new files
+	do_bill_parse = True # don't know if we got any new files, and the bill parser rebuilds the bill text manifest
 	
 if "bills" in sys.argv:
 	# Scrape.
@@ -157,6 +157,9 @@ if do_bill_parse:
 	# Load into db.
 	os.system("./parse.py --congress=%d -l %s bill" % (CONGRESS, log_level))
 
+	# Convert any new bill text to HTML ahead of the first page view.
+	os.system("./manage.py prerender_bill_text %d" % CONGRESS)
+
 	# bills and state bills are indexed as they are parsed, but to
 	# freshen the index... Because bills index full text and so
 	# indexing each time is substantial, set the TIMEOUT and
@@ -196,6 +199,7 @@ if "votes" in sys.argv:
 	# Load into db.
 	if did_any_file_change or True: # amendments can mark votes as missing data
 		os.system("./parse.py vote --congress=%d -l %s" % (CONGRESS, log_level))
+		os.system("./manage.py prerender_vote_thumbnails %d" % CONGRESS)
 
 	# Update change tracker.
 	os.system("/home/govtrack/update-votes-servo")
@@ -0,0 +1,186 @@
+"""
+In-memory facet counts for SearchManager.
+
+A FacetIndex holds, for some of a model's fields, a FacetColumn with the
+values of every object: parallel NumPy arrays of row numbers (one row per
+object) and value codes, with an entry for each object and value, so a
+many-to-many field has an entry per related object. When a search filters
+only on those fields, the facet counts for every field --- each computed
+with the filters on all of the other fields --- come from masking and
+counting these arrays rather than a search backend query per field.
+
+Columns are loaded from the database the first time a search needs them.
+Processes reload their index when the model's FacetIndexVersion row changes,
+which parsers bump with invalidate_facet_index after they reload the data.
+Since the version is in the database, this works whether or not the Django
+cache is shared between processes.
+"""
+
+from django.db.models import F, ManyToManyField
+
+import numpy
+
+import threading, time
+
+FACET_INDEX_MAX_AGE = 60*60*6 # reload at least this often, to pick up changes made outside of the parsers
+FACET_INDEX_CHECK_INTERVAL = 60 # seconds between checks of the version in the database
+
+class FacetColumn(object):
+    def __init__(self, rows, codes, values):
+        self.rows = rows # int32 array of row numbers, sorted
+        self.codes = codes # int32 array of value codes, parallel to rows
+        self.values = values # code => field value
+        self.codes_by_value = dict((v, i) for i, v in enumerate(values))
+
+    def row_mask(self, values, num_rows):
+        # Returns a boolean array over the rows of the objects with any of the values.
+        codes = [self.codes_by_value[v] for v in values if v in self.codes_by_value]
+        mask = numpy.zeros(num_rows, dtype=bool)
+        if codes:
+            mask[self.rows[numpy.in1d(self.codes, codes)]] = True
+        return mask
+
+    def counts(self, row_mask=None):
+        # Returns a list of (value, count) pairs for the values of the rows
+        # in the mask (or of all rows), omitting values with no rows.
+        if not self.values: return []
+        codes = self.codes if row_mask is None else self.codes[row_mask[self.rows]]
+        counts = numpy.bincount(codes, minlength=len(self.values))
+        return [(self.values[i], int(counts[i])) for i in numpy.flatnonzero(counts)]
+
+class FacetIndex(object):
+    def __init__(self, model, field_names, version):
+        self.model = model
+        self.field_names = field_names
+        self.version = version
+        self.loaded = self.checked = time.time()
+        self.pks = None # sorted int array, the primary key of each row
+        self.columns = { } # field name => FacetColumn
+        self.totals = { } # field name => counts over all rows
+        self.lock = threading.Lock() # held while loading columns
+
+    def is_stale(self):
+        now = time.time()
+        if now - self.loaded > FACET_INDEX_MAX_AGE:
+            return True
+        if now - self.checked < FACET_INDEX_CHECK_INTERVAL:
+            return False
+        self.checked = now
+        return get_version(self.model) != self.version
+
+    def column(self, field_name):
+        col = self.columns.get(field_name)
+        if col is None:
+            with self.lock:
+                if self.pks is None:
+                    self.pks = numpy.array(sorted(self.model.objects.values_list("pk", flat=True)), dtype=numpy.int64)
+                col = self.columns.get(field_name)
+                if col is None:
+                    col = self.load_column(field_name)
+                    self.columns[field_name] = col
+        return col
+
+    def load_column(self, field_name):
+        field = self.model._meta.get_field(field_name)
+        if isinstance(field, ManyToManyField):
+            pairs = field.rel.through.objects.values_list(field.m2m_field_name(), field.m2m_reverse_field_name())
+        else:
+            pairs = self.model.objects.exclude(**{ field_name + "__isnull": True }).values_list("pk", field_name)
+        pairs = list(pairs)
+
+        values = sorted(set(v for pk, v in pairs))
+        codes_by_value = dict((v, i) for i, v in enumerate(values))
+        pks = numpy.array([pk for pk, v in pairs], dtype=numpy.int64)
+        codes = numpy.array([codes_by_value[v] for pk, v in pairs], dtype=numpy.int64)
+
+        # Map primary keys to rows, dropping objects created since the rows
+        # were loaded, and sort by row, dropping duplicate pairs.
+        rows = numpy.searchsorted(self.pks, pks)
+        found = rows < len(self.pks)
+        found[found] = self.pks[rows[found]] == pks[found]
+        entries = numpy.unique(rows[found] * max(len(values), 1) + codes[found])
+        return FacetColumn(
+            (entries // max(len(values), 1)).astype(numpy.int32),
+            (entries % max(len(values), 1)).astype(numpy.int32),
+            values)
+
+    def parse_value(self, field_name, value):
+        # Convert a value from a query string to the field's type, the way
+        # SearchManager.queryset does. Returns None for invalid values.
+        if value in ("true", "on"): return True
+        if value == "false": return False
+        field = self.model._meta.get_field(field_name)
+        try:
+            if field.rel:
+                return int(value)
+            return field.to_python(value)
+        except Exception:
+            return None
+
+    def facet_counts(self, restrictions, facet_fields, global_restrictions=[]):
+        # restrictions is a list of (field name, values) pairs, each limiting
+        # the objects to those with any of the values for the field. Returns
+        # a dict from each field in facet_fields to a list of (value, count)
+        # pairs, counted over the objects matching the restrictions on the
+        # *other* fields. global_restrictions are like restrictions but are
+        # applied to all of the facets.
+        def make_mask(field_name, values):
+            col = self.column(field_name)
+            return col.row_mask([self.parse_value(field_name, v) for v in values], len(self.pks))
+        masks = [(field_name, make_mask(field_name, values)) for field_name, values in restrictions]
+        universe = None
+        for field_name, values in global_restrictions:
+            mask = make_mask(field_name, values)
+            universe = mask if universe is None else (universe & mask)
+
+        ret = { }
+        matches = { } # indexes of the masks applied => rows matched
+        for field_name in facet_fields:
+            col = self.column(field_name)
+            applied = tuple(i for i, (f, m) in enumerate(masks) if f != field_name)
+            if not applied and universe is None:
+                if field_name not in self.totals:
+                    self.totals[field_name] = col.counts()
+                ret[field_name] = self.totals[field_name]
+                continue
+
+            if applied not in matches:
+                base = universe
+                for i in applied:
+                    base = masks[i][1] if base is None else (base & masks[i][1])
+                matches[applied] = base
+            ret[field_name] = col.counts(matches[applied])
+        return ret
+
+_facet_indexes = { }
+_facet_indexes_lock = threading.Lock()
+
+def get_facet_counts(model, field_names, restrictions, facet_fields, global_restrictions=[]):
+    """
+    Returns facet counts from the process's FacetIndex over the fields of the
+    model, making a new one if the model's data has changed. See
+    FacetIndex.facet_counts.
+    """
+    key = (model, tuple(sorted(field_names)))
+    with _facet_indexes_lock:
+        index = _facet_indexes.get(key)
+        if index is None or index.is_stale():
+            index = FacetIndex(model, key[1], get_version(model))
+            _facet_indexes[key] = index
+    return index.facet_counts(restrictions, facet_fields, global_restrictions)
+
+def get_version(model):
+    from smartsearch.models import FacetIndexVersion
+    try:
+        return FacetIndexVersion.objects.get(model=model.__name__).version
+    except FacetIndexVersion.DoesNotExist:
+        return 0
+
+def invalidate_facet_index(model):
+    """
+    Makes the facet indexes of the model in all processes reload. Call after
+    changing the model's data in bulk, e.g. at the end of a parser run.
+    """
+    from smartsearch.models import FacetIndexVersion
+    FacetIndexVersion.objects.get_or_create(model=model.__name__)
+    FacetIndexVersion.objects.filter(model=model.__name__).update(version=F("version")+1)
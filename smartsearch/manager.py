@@ -32,6 +32,7 @@ class SearchManager(object):
         self.connection = connection
         self.template = None
         self.template_context_func = None
+        self.facet_index = False
 
     def add_option(self, *args, **kwargs):
         Option(self, *args, **kwargs)
@@ -42,6 +43,14 @@ class SearchManager(object):
     def add_filter(self, key, value):
         self.global_filters[key] = value
         
+    def use_facet_index(self):
+        # Compute facet counts for options on model fields from an in-memory
+        # smartsearch.facets.FacetIndex, when the search only filters on
+        # such options, rather than with search backend queries. Whatever
+        # loads the model's data should call smartsearch.facets.invalidate_facet_index
+        # so that the indexes reload.
+        self.facet_index = True
+        
     def set_template(self, template_data):
         self.template = Template(template_data)
     def set_template_file(self, template_file_name):
@@ -102,8 +111,13 @@ class SearchManager(object):
             # So optimizing the facet query for Haystack can pre-load only the facets
             # that have the same underlying query --- i.e. only the facets that have
             # no value set by the user.
+            #
+            # If the manager uses a facet index, and the search can be answered
+            # from it, all of the facets are loaded from the index instead.
             loaded_facets = None
-            if hasattr(qs, 'facet'):
+            if self.facet_index:
+                loaded_facets = self.load_indexed_facets(qsparams)
+            if loaded_facets is None and hasattr(qs, 'facet'):
                 faceted_qs = qs
                 loadable_facets = []
                 for option in self.options:
@@ -304,6 +318,51 @@ class SearchManager(object):
                         yield item.object
             return SR(qs)
             
+    def get_indexable_fields(self):
+        # Returns the orm_field_names of options that a FacetIndex can handle:
+        # plain fields and many-to-many fields of the model.
+        from django.db.models.fields import FieldDoesNotExist
+        ret = set()
+        for option in self.options:
+            if option.filter or option.type == "text" or "__" in option.orm_field_name: continue
+            try:
+                self.model._meta.get_field(option.orm_field_name)
+            except FieldDoesNotExist:
+                continue # e.g. fields only in the Haystack index
+            ret.add(option.orm_field_name)
+        return ret
+
+    def load_indexed_facets(self, qsparams):
+        # Returns facet counts from the FacetIndex in the format of Haystack's
+        # facet_counts()["fields"], or None if the search uses options (or
+        # global filters) that the index doesn't cover.
+        from smartsearch.facets import get_facet_counts
+
+        if self.qs is not None: return None # the index covers all objects of the model
+        fields = self.get_indexable_fields()
+
+        global_restrictions = []
+        for key, value in self.global_filters.items():
+            field_name = key[:-4] if key.endswith("__in") else key
+            if field_name not in fields: return None
+            values = value if key.endswith("__in") else [value]
+            global_restrictions.append((field_name, [(("true" if v else "false") if type(v) == bool else unicode(v)) for v in values]))
+
+        restrictions = []
+        facet_fields = { }
+        for option in self.options:
+            if option.orm_field_name in fields:
+                if not option.choices:
+                    facet_fields[option.orm_field_name] = option.field_name
+            if option.field_name not in qsparams and option.field_name+"[]" not in qsparams: continue
+            if option.orm_field_name not in fields: return None
+            values = qsparams.getlist(option.field_name)+qsparams.getlist(option.field_name+"[]")
+            if u'__ALL__' in values: continue
+            restrictions.append((option.orm_field_name, values))
+
+        counts = get_facet_counts(self.model, fields, restrictions, facet_fields.keys(), global_restrictions)
+        return dict((facet_fields[f], counts[f]) for f in counts)
+
     def build_cache_key(self, prefix, qsparams, omit=None):
         def get_value(f):
             if f in qsparams: return urllib.quote(qsparams[f])
@@ -0,0 +1,12 @@
+from django.db import models
+
+class FacetIndexVersion(models.Model):
+    """The version of a model's data as seen by the in-memory facet indexes
+    in smartsearch.facets. It is incremented (with invalidate_facet_index)
+    when the data is reloaded, e.g. by a parser, and each process reloads its
+    index when it sees a new version."""
+    model = models.CharField(max_length=64, unique=True)
+    version = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return "%s %d" % (self.model, self.version)
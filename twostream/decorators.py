@@ -35,7 +35,7 @@ def anonymous_view(view):
 			if header not in (
 					'SERVER_NAME', 'SERVER_PORT', 'HTTPS', 'wsgi.url_scheme', 'SERVER_PROTOCOL', 'HTTP_HOST',
 					'REQUEST_METHOD', 'REQUEST_URI', 'DOCUMENT_URI', 'PATH_INFO', 'QUERY_STRING', 'CONTENT_LENGTH', 'CONTENT_TYPE',
-					'REMOTE_ADDR'):
+					'REMOTE_ADDR', 'HTTP_IF_NONE_MATCH'): # conditional GETs aren't user-specific
 				del request.META[header]
 				
 		# In order for the Django debug template context processor to work, we can't
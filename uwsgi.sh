@@ -67,4 +67,6 @@ if [ -z "$DEBUG" ]; then
 	daemonize="--daemonize /tmp/uwsgi_govtrack_$NAME.log --pidfile $pidfile --processes $PROCESSES --cheaper 2"
 fi
 
-.env/bin/uwsgi $daemonize --socket /tmp/uwsgi_govtrack_$NAME.sock --chmod-socket=666 --wsgi-file wsgi.py
+# --enable-threads: the site search runs its lookups in a thread pool, and
+# without this flag uwsgi doesn't initialize the GIL so those threads never run.
+.env/bin/uwsgi $daemonize --socket /tmp/uwsgi_govtrack_$NAME.sock --chmod-socket=666 --enable-threads --wsgi-file wsgi.py
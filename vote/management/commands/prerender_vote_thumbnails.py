@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from optparse import make_option
+
+from vote.models import Vote
+
+from website.util import map_chunks_in_pool
+
+import time
+
+class Command(BaseCommand):
+	args = '[congress]'
+	help = 'Renders and caches the thumbnail and diagram images of the votes in a Congress (the current Congress by default).'
+	option_list = BaseCommand.option_list + (
+		make_option('--workers', type='int', default=4,
+			help='The number of processes to render images with.'),
+		)
+
+	def handle(self, *args, **options):
+		congress = int(args[0]) if len(args) > 0 else settings.CURRENT_CONGRESS
+		vote_ids = list(Vote.objects.filter(congress=congress).values_list("id", flat=True))
+
+		t0 = time.time()
+		rendered = sum(map_chunks_in_pool(render_votes, vote_ids, options["workers"], desc="Votes"))
+
+		print "Checked %d votes, rendered %d images in %d seconds." % (len(vote_ids), rendered, time.time()-t0)
+
+def render_votes(vote_ids):
+	from vote.views import get_vote_thumbnail, vote_thumbnail_checksum, vote_thumbnail_filename
+	import os.path
+	rendered = 0
+	for vote in Vote.objects.filter(id__in=vote_ids):
+		for image_type in ("thumbnail", "diagram"):
+			if os.path.exists(vote_thumbnail_filename(vote, image_type, vote_thumbnail_checksum(vote, image_type))):
+				continue # already up to date
+			get_vote_thumbnail(vote, image_type)
+			rendered += 1
+	return rendered
@@ -0,0 +1,405 @@
+# Compact voter matrices.
+#
+# A VoterMatrix holds how every Member of Congress voted on every roll call
+# vote in one chamber in one Congress as a (members x votes) array of int8
+# option codes. It's built from Voter/VoteOption once and saved to disk so
+# that later loads just memory-map it, and statistics over the whole chamber
+# (missed votes, party-line voting, pairwise agreement) are computed with
+# NumPy array operations rather than a Voter query per Member.
+#
+# Files are written under temporary names and renamed into place, and
+# rebuilds hold a lock on a .lock file next to them, so that processes
+# building and reading the same files at once don't see each other's
+# partly written files or overwrite each other's work.
+
+import contextlib, fcntl, glob, os, tempfile
+
+import numpy
+
+from django.db.models import Count, Max
+
+from vote.models import Vote, Voter, CongressChamber
+
+datadir = "data"
+
+# Option codes. NOT_ELIGIBLE is used where a Member was not a voter on the
+# roll call, e.g. because they were not serving yet.
+NOT_ELIGIBLE = 0
+YEA = 1
+NAY = 2
+NOT_VOTING = 3
+PRESENT = 4
+OTHER = 5
+OPTION_CODES = { "+": YEA, "-": NAY, "0": NOT_VOTING, "P": PRESENT, "present": PRESENT }
+
+class VoterMatrix(object):
+	def __init__(self, congress, chamber, person_ids, parties, vote_ids, vote_sessions, codes):
+		self.congress = congress
+		self.chamber = chamber
+		self.person_ids = person_ids # sorted int32 array, one per row
+		self.parties = parties # the party of each Member in their last vote in the matrix
+		self.vote_ids = vote_ids # int32 array, one per column, in chronological order
+		self.vote_sessions = vote_sessions # the session of each vote
+		self.codes = codes # (members x votes) int8 array of option codes
+
+	def row(self, person_id):
+		# Returns the row index of the person, or None if they are not in the matrix.
+		i = numpy.searchsorted(self.person_ids, person_id)
+		if i < len(self.person_ids) and self.person_ids[i] == person_id:
+			return i
+		return None
+
+	def session_mask(self, session):
+		# A boolean mask over the votes for those in the session.
+		return self.vote_sessions == session
+
+	def select(self, vote_mask=None):
+		if vote_mask is None:
+			return self.codes
+		return self.codes[:, vote_mask]
+
+	def missed_votes(self, vote_mask=None):
+		# Returns arrays (parallel to person_ids) of the number of votes each
+		# Member was eligible for and the number they missed.
+		codes = self.select(vote_mask)
+		eligible = (codes != NOT_ELIGIBLE).sum(axis=1)
+		missed = (codes == NOT_VOTING).sum(axis=1)
+		return eligible, missed
+
+	def missed_vote_rates(self, vote_mask=None):
+		# Returns an array of the percent of votes missed by each Member,
+		# NaN for Members who were not eligible for any votes.
+		eligible, missed = self.missed_votes(vote_mask)
+		with numpy.errstate(divide="ignore", invalid="ignore"):
+			return 100.0 * missed / eligible
+
+	def party_majorities(self, vote_mask=None):
+		# Returns a (members x votes) array holding, for each Member and vote,
+		# the option (YEA or NAY) that a majority of the Member's party voted
+		# for, or NOT_ELIGIBLE if the party was tied or didn't vote.
+		codes = self.select(vote_mask)
+		party_names, party_index = numpy.unique(self.parties, return_inverse=True)
+		majorities = numpy.zeros((len(party_names), codes.shape[1]), dtype=numpy.int8)
+		for p in xrange(len(party_names)):
+			yeas = (codes[party_index == p] == YEA).sum(axis=0)
+			nays = (codes[party_index == p] == NAY).sum(axis=0)
+			majorities[p, yeas > nays] = YEA
+			majorities[p, nays > yeas] = NAY
+		return majorities[party_index]
+
+	def party_line_votes(self, vote_mask=None):
+		# Returns arrays (parallel to person_ids) of the number of votes each
+		# Member cast yea or nay on when their party had a majority position
+		# and the number of those on which they voted with the majority.
+		codes = self.select(vote_mask)
+		majorities = self.party_majorities(vote_mask)
+		considered = ((codes == YEA) | (codes == NAY)) & (majorities != NOT_ELIGIBLE)
+		agreed = considered & (codes == majorities)
+		return considered.sum(axis=1), agreed.sum(axis=1)
+
+	def party_line_agreement(self, vote_mask=None):
+		# Returns the percent of votes on which each Member voted with the
+		# majority of their party, NaN where there were no such votes.
+		considered, agreed = self.party_line_votes(vote_mask)
+		with numpy.errstate(divide="ignore", invalid="ignore"):
+			return 100.0 * agreed / considered
+
+	def pairwise_votes(self, vote_mask=None):
+		# Returns two (members x members) arrays: the number of votes on which
+		# both Members voted yea or nay, and the number of those on which they
+		# voted the same way.
+		return count_agreement(self.select(vote_mask))
+
+	def pairwise_agreement(self, vote_mask=None):
+		# Returns a (members x members) array of the percent of votes on which
+		# each pair of Members voted the same way, out of the votes on which
+		# both voted yea or nay, NaN where there were none.
+		both, agreed = self.pairwise_votes(vote_mask)
+		with numpy.errstate(divide="ignore", invalid="ignore"):
+			return 100.0 * agreed / both
+
+def count_agreement(codes):
+	# For a (members x votes) array of option codes, returns two (members x
+	# members) int32 arrays: the number of votes on which both Members voted
+	# yea or nay, and the number of those on which they voted the same way.
+	yea = (codes == YEA).astype(numpy.float32)
+	nay = (codes == NAY).astype(numpy.float32)
+	voted = yea + nay
+	both = numpy.dot(voted, voted.T)
+	agreed = numpy.dot(yea, yea.T) + numpy.dot(nay, nay.T)
+	return both.astype(numpy.int32), agreed.astype(numpy.int32)
+
+_voter_matrices = { }
+
+@contextlib.contextmanager
+def file_lock(fn):
+	# Holds an exclusive lock on fn + ".lock" (shared by all processes).
+	if not os.path.exists(os.path.dirname(fn)): os.makedirs(os.path.dirname(fn))
+	with open(fn + ".lock", "w") as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		yield
+
+def write_temp_file(fn, suffix, write):
+	# Calls write with a file opened under a new unique name in fn's
+	# directory and returns that name.
+	fd, temp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=os.path.basename(fn) + ".", suffix=suffix)
+	with os.fdopen(fd, "wb") as f:
+		write(f)
+	os.chmod(temp_fn, 0644) # mkstemp makes it readable only by us
+	return temp_fn
+
+def voter_matrix_filename(congress, chamber):
+	return datadir + "/us/%d/stats/voter_matrix_%s" % (congress, "h" if chamber == CongressChamber.house else "s")
+
+def load_voter_matrix(congress, chamber, rebuild=False):
+	"""
+	Returns the VoterMatrix for the chamber (a CongressChamber value) in the
+	Congress. The matrix is loaded from disk (memory-mapped) if it has been
+	saved and is up to date with the votes in the database, and otherwise it
+	is built from the Voter table and saved. Matrices are also cached in the
+	process.
+
+	Whether it's up to date is judged by the number and highest id of the
+	chamber's Vote and Voter rows, which doesn't see a Voter's option being
+	changed in place. The vote parser, which does that when it re-parses a
+	corrected roll call, passes rebuild=True for the chambers it updated.
+	"""
+
+	vote_stamp = Vote.objects.filter(congress=congress, chamber=chamber)\
+		.aggregate(count=Count("id"), max_id=Max("id"))
+	voter_stamp = Voter.objects.filter(vote__congress=congress, vote__chamber=chamber)\
+		.aggregate(count=Count("id"), max_id=Max("id"))
+	stamp = (vote_stamp["count"], vote_stamp["max_id"] or 0, voter_stamp["count"], voter_stamp["max_id"] or 0)
+
+	key = (congress, chamber)
+	if key in _voter_matrices and not rebuild and _voter_matrices[key][0] == stamp:
+		return _voter_matrices[key][1]
+
+	fn = voter_matrix_filename(congress, chamber)
+	matrix = None
+	if not rebuild:
+		matrix = open_voter_matrix(congress, chamber, stamp)
+	if matrix is None:
+		with file_lock(fn):
+			# Another process may have saved it while we waited for the lock.
+			if not rebuild:
+				matrix = open_voter_matrix(congress, chamber, stamp)
+			if matrix is None:
+				matrix = build_voter_matrix(congress, chamber)
+				save_voter_matrix(matrix, stamp)
+
+	_voter_matrices[key] = (stamp, matrix)
+	return matrix
+
+def open_voter_matrix(congress, chamber, stamp):
+	# Returns the saved VoterMatrix, or None if it hasn't been saved, is out
+	# of date, or was replaced by another process while it was being opened.
+	fn = voter_matrix_filename(congress, chamber)
+	try:
+		index = numpy.load(fn + ".npz")
+	except IOError:
+		return None
+	if tuple(index["stamp"]) != stamp or "codes_file" not in index.files:
+		return None
+	try:
+		codes = numpy.load(os.path.join(os.path.dirname(fn), str(index["codes_file"])), mmap_mode="r")
+	except IOError:
+		return None
+	return VoterMatrix(congress, chamber, index["person_ids"], index["parties"],
+		index["vote_ids"], index["vote_sessions"], codes)
+
+def build_voter_matrix(congress, chamber):
+	votes = list(Vote.objects.filter(congress=congress, chamber=chamber)
+		.order_by("created", "number").values_list("id", "session"))
+	vote_ids = numpy.array([v[0] for v in votes], dtype=numpy.int32)
+	vote_col = dict((v[0], i) for i, v in enumerate(votes))
+
+	rows = list(Voter.objects.filter(vote__congress=congress, vote__chamber=chamber, person__isnull=False)
+		.order_by("created")
+		.values_list("person", "vote", "option__key", "person_role__party"))
+	person_ids = numpy.array(sorted(set(r[0] for r in rows)), dtype=numpy.int32)
+	parties = { }
+	for r in rows:
+		if r[3]: parties[r[0]] = r[3] # the most recent party wins
+
+	codes = numpy.zeros((len(person_ids), len(vote_ids)), dtype=numpy.int8)
+	if rows:
+		codes[numpy.searchsorted(person_ids, [r[0] for r in rows]), [vote_col[r[1]] for r in rows]] = \
+			[OPTION_CODES.get(r[2], OTHER) for r in rows]
+
+	return VoterMatrix(congress, chamber, person_ids,
+		numpy.array([parties.get(p, "") for p in person_ids]),
+		vote_ids, numpy.array([v[1] for v in votes]), codes)
+
+def save_voter_matrix(matrix, stamp):
+	# Write the codes as a plain .npy file so it can be memory-mapped, and the
+	# row and column labels in an index alongside. The codes file gets a new
+	# name each time and the index names it, so an index is never read with
+	# another build's codes. Call with the lock held (see file_lock).
+	fn = voter_matrix_filename(matrix.congress, matrix.chamber)
+	codes_fn = write_temp_file(fn, ".npy", lambda f : numpy.save(f, numpy.asarray(matrix.codes)))
+	index_fn = write_temp_file(fn, ".npz.tmp", lambda f : numpy.savez(f, stamp=numpy.array(stamp),
+		codes_file=numpy.array(os.path.basename(codes_fn)), person_ids=matrix.person_ids, parties=matrix.parties,
+		vote_ids=matrix.vote_ids, vote_sessions=matrix.vote_sessions))
+
+	# Replace the index in one step, then remove the codes files of earlier
+	# builds. A process that opened the old index just before this will find
+	# its codes file gone and wait for the lock to load the matrix again.
+	os.rename(index_fn, fn + ".npz")
+	for old_fn in glob.glob(fn + ".*.npy") + [fn + ".npy"]:
+		if old_fn != codes_fn and os.path.exists(old_fn):
+			os.unlink(old_fn)
+
+# Member-vs-member agreement.
+#
+# An AgreementIndex holds the pairwise agreement counts for a chamber in a
+# Congress along with, for each Member, the other Members ordered from most to
+# least similar, so that the most or least similar Members are looked up
+# without any computation. It keeps a copy of the option codes it was computed
+# from so that when roll calls are added or changed, only those votes'
+# contributions are subtracted and added back rather than recomputing it all.
+
+AGREEMENT_MIN_VOTES = 10 # pairs with fewer votes in common are not ranked
+
+class AgreementIndex(object):
+	def __init__(self, congress, chamber, person_ids, vote_ids, codes, both, agreed):
+		self.congress = congress
+		self.chamber = chamber
+		self.person_ids = person_ids
+		self.vote_ids = vote_ids
+		self.codes = codes # the option codes the counts were computed from
+		self.both = both
+		self.agreed = agreed
+		self.rank()
+
+	def rank(self):
+		# Sort each row by agreement, descending, putting the pairs with too few
+		# votes in common (and each Member's pairing with themself) at the end.
+		n = len(self.person_ids)
+		with numpy.errstate(divide="ignore", invalid="ignore"):
+			agreement = self.agreed / self.both.astype(float)
+		ranked = self.both >= AGREEMENT_MIN_VOTES
+		ranked[numpy.arange(n), numpy.arange(n)] = False
+		agreement[~ranked] = -1
+		self.order = numpy.argsort(-agreement, axis=1, kind="mergesort").astype(numpy.int32)
+		self.num_ranked = ranked.sum(axis=1)
+
+	def row(self, person_id):
+		i = numpy.searchsorted(self.person_ids, person_id)
+		if i < len(self.person_ids) and self.person_ids[i] == person_id:
+			return i
+		return None
+
+	def entry(self, i, j):
+		return {
+			"person": int(self.person_ids[j]),
+			"agreement": 100.0 * self.agreed[i, j] / self.both[i, j],
+			"votes": int(self.both[i, j]),
+		}
+
+	def agreement(self, person1, person2):
+		# Returns a dict with the percent agreement between the two Members and
+		# the number of votes it is out of, or None if they have no votes in common.
+		i, j = self.row(person1), self.row(person2)
+		if i is None or j is None or self.both[i, j] == 0:
+			return None
+		return self.entry(i, j)
+
+	def most_similar(self, person_id, k=10):
+		i = self.row(person_id)
+		if i is None: return []
+		return [self.entry(i, j) for j in self.order[i, :min(k, self.num_ranked[i])]]
+
+	def least_similar(self, person_id, k=10):
+		i = self.row(person_id)
+		if i is None: return []
+		n = self.num_ranked[i]
+		return [self.entry(i, j) for j in self.order[i, max(n-k, 0):n][::-1]]
+
+def agreement_index_filename(congress, chamber):
+	return datadir + "/us/%d/stats/vote_agreement_%s.npz" % (congress, "h" if chamber == CongressChamber.house else "s")
+
+_agreement_indexes = { }
+
+def load_agreement_index(congress, chamber):
+	"""
+	Returns the AgreementIndex for the chamber in the Congress as of its last
+	update (see update_agreement_index), building it if it has never been
+	built. The index is cached in the process and reloaded when the file
+	changes.
+	"""
+
+	fn = agreement_index_filename(congress, chamber)
+	if not os.path.exists(fn):
+		return update_agreement_index(congress, chamber)
+	mtime = os.path.getmtime(fn)
+	key = (congress, chamber)
+	if key not in _agreement_indexes or _agreement_indexes[key][0] != mtime:
+		f = numpy.load(fn)
+		_agreement_indexes[key] = (mtime, AgreementIndex(congress, chamber,
+			f["person_ids"], f["vote_ids"], f["codes"], f["both"], f["agreed"]))
+	return _agreement_indexes[key][1]
+
+def update_agreement_index(congress, chamber, rebuild_matrix=False):
+	"""
+	Brings the saved AgreementIndex for the chamber in the Congress up to date
+	with the votes in the database and returns it. Only the roll calls that
+	were added, changed, or removed since the last update are counted.
+
+	Changes are found by comparing against the voter matrix, so pass
+	rebuild_matrix=True after roll calls may have been changed in place (see
+	load_voter_matrix), otherwise those changes are not seen.
+	"""
+
+	# Hold the lock from reading the old index to saving the new one so that
+	# concurrent updates don't drop each other's changes.
+	with file_lock(agreement_index_filename(congress, chamber)):
+		return _update_agreement_index(congress, chamber, rebuild_matrix)
+
+def _update_agreement_index(congress, chamber, rebuild_matrix):
+	matrix = load_voter_matrix(congress, chamber, rebuild=rebuild_matrix)
+	codes = numpy.asarray(matrix.codes)
+	n = len(matrix.person_ids)
+
+	fn = agreement_index_filename(congress, chamber)
+	old = numpy.load(fn) if os.path.exists(fn) else None
+	if old is None or not numpy.all(numpy.in1d(old["person_ids"], matrix.person_ids)):
+		# Nothing to start from, or Members were dropped. Count everything.
+		both, agreed = count_agreement(codes)
+	else:
+		# Move the old counts and codes to the new rows, since new Members may
+		# have been added.
+		rows = numpy.searchsorted(matrix.person_ids, old["person_ids"])
+		both = numpy.zeros((n, n), dtype=numpy.int32)
+		agreed = numpy.zeros((n, n), dtype=numpy.int32)
+		both[numpy.ix_(rows, rows)] = old["both"]
+		agreed[numpy.ix_(rows, rows)] = old["agreed"]
+		old_codes = numpy.zeros((n, len(old["vote_ids"])), dtype=numpy.int8)
+		old_codes[rows] = old["codes"]
+
+		# Find the votes whose counts are out of date: new votes, removed
+		# votes, and votes with any changed Voter.
+		old_col = dict((vid, c) for c, vid in enumerate(old["vote_ids"]))
+		removed = numpy.ones(len(old["vote_ids"]), dtype=bool)
+		added = numpy.zeros(len(matrix.vote_ids), dtype=bool)
+		for c, vid in enumerate(matrix.vote_ids):
+			if vid in old_col and numpy.array_equal(old_codes[:, old_col[vid]], codes[:, c]):
+				removed[old_col[vid]] = False
+			else:
+				added[c] = True
+
+		b, a = count_agreement(old_codes[:, removed])
+		both -= b
+		agreed -= a
+		b, a = count_agreement(codes[:, added])
+		both += b
+		agreed += a
+
+	index = AgreementIndex(congress, chamber, matrix.person_ids, matrix.vote_ids, codes, both, agreed)
+
+	temp_fn = write_temp_file(fn, ".tmp", lambda f : numpy.savez(f, person_ids=index.person_ids,
+		vote_ids=index.vote_ids, codes=codes, both=both, agreed=agreed))
+	os.rename(temp_fn, fn)
+	_agreement_indexes[(congress, chamber)] = (os.path.getmtime(fn), index)
+
+	return index
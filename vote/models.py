@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import math
+from collections import Counter
 
 from django.db import models
 from django.db.models import Q
@@ -7,6 +8,7 @@ from django.core.urlresolvers import reverse
 from django.conf import settings
 
 from common import enum
+from jsonfield import JSONField
 
 from person.util import load_roles_at_date
 
@@ -68,6 +70,7 @@ class Vote(models.Model):
     related_amendment = models.ForeignKey('bill.Amendment', related_name='votes', blank=True, null=True, help_text="A related amendment.", on_delete=models.PROTECT)
     missing_data = models.BooleanField(default=False, help_text="If something in the source could be parsed and we should revisit the file.")
     question_details = models.TextField(help_text="Additional descriptive text for what the vote was about.", blank=True, null=True)
+    party_totals = JSONField(blank=True, null=True, help_text="The count of voters by option key and then by party, computed when the vote is loaded.")
     
     class Meta:
         # The ordering makes sure votes are in the right order on bill pages.
@@ -86,12 +89,28 @@ class Vote(models.Model):
         return self.question
 
     def calculate_totals(self):
-        self.total_plus = self.voters.filter(option__key='+').count()
-        self.total_minus = self.voters.filter(option__key='-').count()
-        self.total_other = self.voters.count() - (self.total_plus + self.total_minus)
+        self.party_totals = self.count_voters_by_party()
+        self.total_plus = sum(self.party_totals.get('+', {}).values())
+        self.total_minus = sum(self.party_totals.get('-', {}).values())
+        self.total_other = sum(sum(c.values()) for c in self.party_totals.values()) - (self.total_plus + self.total_minus)
         self.percent_yes = self.total_plus/float(self.total_plus + self.total_minus + self.total_other)
         self.save()
 
+    def count_voters_by_party(self):
+        # Returns { option key: { party: count } } using the role each voter had at the
+        # time of the vote, which the parser stores on the Voter record.
+        counts = Counter()
+        for option_key, voter_type, party in self.voters.values_list('option__key', 'voter_type', 'person_role__party'):
+            if voter_type == VoterType.vice_president:
+                party = "Vice President"
+            elif not party:
+                party = "Unknown"
+            counts[(option_key, party)] += 1
+        ret = { }
+        for (option_key, party), count in counts.items():
+            ret.setdefault(option_key, { })[party] = count
+        return ret
+
     def get_absolute_url(self):
         if self.chamber == CongressChamber.house:
             chamber_code = 'h'
@@ -125,65 +144,44 @@ class Vote(models.Model):
         # If cached value exists then return it
         if hasattr(self, '_cached_totals'):
             return self._cached_totals
-        # else do all these things:
-
-        items = []
 
-        # Extract all voters, find their role at the time
-        # the vote was
-        all_voters = list(self.voters.all().select_related('person', 'option'))
-        voters_by_option = {}
-        for option in self.options.all():
-            voters_by_option[option] = [x for x in all_voters if x.option == option]
-        total_count = len(all_voters)
-
-        persons = [x.person for x in all_voters if x.person != None]
-        load_roles_at_date(persons, self.created)
+        # Use the breakdown by option and party computed when the vote was loaded,
+        # falling back to computing it for votes loaded before we stored it.
+        by_option = self.party_totals
+        if by_option is None:
+            by_option = self.count_voters_by_party()
+        options = list(self.options.all())
 
         # Find all parties which participated in vote
-        # and sort them in order which they should be displayed
-
-        def cmp_party(x):
-            """
-            Sort the parties by the number of voters in that party.
-            """
-            return -len([p for p in all_voters if p.person and p.person.role and p.person.role.party == x])
-        
-        def get_party(voter):
-            if voter.voter_type != VoterType.vice_president:
-                if voter.person and voter.person.role:
-                    return voter.person.role.party
-                else:
-                    return "Unknown"
-            else:
-                return "Vice President"
-        
-        all_parties = list(set(get_party(x) for x in all_voters))
-        all_parties.sort(key=cmp_party)
+        # and sort them in order which they should be displayed,
+        # by the number of voters in that party.
+        party_sizes = Counter()
+        for counts in by_option.values():
+            party_sizes.update(counts)
+        total_count = sum(party_sizes.values())
+        all_parties = sorted(party_sizes, key = lambda p : (-party_sizes[p] if p not in ("Vice President", "Unknown") else 0, p))
         total_party_stats = dict((x, {'yes': 0, 'no': 0, 'other': 0, 'total': 0})\
                                  for x in all_parties)
 
         # For each option find party break down,
         # total vote count and percentage in total count
         details = []
-        for option in self.options.all():
-            voters = voters_by_option.get(option, [])
-            percent = round(len(voters) / float(total_count) * 100.0)
-            party_stats = dict((x, 0) for x in all_parties)
-            for voter in voters:
-                party = get_party(voter)
-                party_stats[party] += 1
-                total_party_stats[party]['total'] += 1
+        for option in options:
+            party_stats = by_option.get(option.key, { })
+            count = sum(party_stats.values())
+            percent = round(count / float(total_count) * 100.0)
+            for party, c in party_stats.items():
+                total_party_stats[party]['total'] += c
                 if option.key == '+':
-                    total_party_stats[party]['yes'] += 1
+                    total_party_stats[party]['yes'] += c
                 elif option.key == '-':
-                    total_party_stats[party]['no'] += 1
+                    total_party_stats[party]['no'] += c
                 else:
-                    total_party_stats[party]['other'] += 1
+                    total_party_stats[party]['other'] += c
             party_counts = [party_stats.get(x, 0) for x in all_parties]
             party_counts = [{"party": all_parties[i], "count": c, 'chart_width': 190 * c / total_count} for i, c in enumerate(party_counts)]
                 
-            detail = {'option': option, 'count': len(voters),
+            detail = {'option': option, 'count': count,
                 'percent': int(percent), 'party_counts': party_counts,
                 'chart_width': 190 * int(percent) / 100}
             if option.key == '+':
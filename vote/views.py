@@ -7,7 +7,6 @@ from django.http import HttpResponse, Http404, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
-from django.views.decorators.cache import cache_page
 
 from common.decorators import render_to
 
@@ -77,12 +76,8 @@ def vote_details(request, congress, session, chamber_code, number):
                 pass # wahtever
     
     # Test if we have a diagram for this vote. The only
-    # way to test is to try to make it.
-    try:
-        vote_thumbnail_image(request, congress, session, chamber_code, number, "diagram")
-        has_diagram = True
-    except Http404:
-        has_diagram = False
+    # way to test is to try to make it (it's cached after that).
+    has_diagram = get_vote_thumbnail(vote, "diagram")[1] is not None
     
     # sorting by party actually sorts by party first and by ideology score
     # second.
@@ -235,11 +230,79 @@ def vote_get_json(request, congress, session, chamber_code, number):
     vote = load_vote(congress, session, chamber_code, number)
     return HttpResponseRedirect("/api/v2/vote/%d" % vote.id)
     
+# Rendered thumbnails are cached on disk, keyed by the vote id and a checksum of the
+# data that goes into the image, so they are only drawn once (or ahead of time by the
+# prerender_vote_thumbnails management command). Bump the version when the drawing code
+# changes.
+VOTE_THUMBNAIL_VERSION = 1
+VOTE_THUMBNAIL_CACHE_DIR = "data/cache/vote-thumbnails"
+
 @anonymous_view
-@cache_page(60 * 60 * 6)
 def vote_thumbnail_image(request, congress, session, chamber_code, number, image_type):
 	vote = load_vote(congress, session, chamber_code, number)
-	
+	checksum, png = get_vote_thumbnail(vote, image_type)
+	if png is None: raise Http404() # no thumbnail for other sorts of votes
+
+	# Crawlers re-fetch these a lot. Let them revalidate for free.
+	from django.http import HttpResponseNotModified
+	from django.utils.cache import patch_cache_control
+	etag = '"%s"' % checksum
+	if etag in [t.strip() for t in request.META.get("HTTP_IF_NONE_MATCH", "").split(",")]:
+		r = HttpResponseNotModified()
+	else:
+		r = HttpResponse(png, content_type='image/png')
+		r["Content-Length"] = len(png)
+	r["ETag"] = etag
+	patch_cache_control(r, max_age=60*60*6)
+	return r
+
+def vote_thumbnail_checksum(vote, image_type):
+	# Hash everything the image depends on: the vote, how each person voted (via the
+	# roll call file), and the ideology scores used to seat voters.
+	import hashlib, json, os
+	h = hashlib.sha1()
+	h.update(json.dumps([VOTE_THUMBNAIL_VERSION, image_type, vote.question, vote.result,
+		vote.created.isoformat(), vote.chamber, vote.number, vote.party_totals], sort_keys=True))
+	for fn in ['data/us/%d/rolls/%s%s-%d.xml' % (vote.congress, "h" if vote.chamber == CongressChamber.house else "s", vote.session, vote.number),
+		"data/us/%d/stats/sponsorshipanalysis_h.txt" % vote.congress,
+		"data/us/%d/stats/sponsorshipanalysis_s.txt" % vote.congress]:
+		try:
+			st = os.stat(fn)
+			h.update("%s %d %d" % (fn, st.st_size, int(st.st_mtime)))
+		except OSError:
+			h.update("%s missing" % fn)
+	return h.hexdigest()[0:16]
+
+def vote_thumbnail_filename(vote, image_type, checksum):
+	import os.path
+	return os.path.join(VOTE_THUMBNAIL_CACHE_DIR, str(vote.congress), "%d-%s-%s.png" % (vote.id, image_type, checksum))
+
+def get_vote_thumbnail(vote, image_type):
+	# Returns (checksum, PNG bytes), with None in place of the bytes if this vote has no
+	# image. Renders and caches the image if it isn't already cached.
+	import os, glob
+	checksum = vote_thumbnail_checksum(vote, image_type)
+	fn = vote_thumbnail_filename(vote, image_type, checksum)
+	if os.path.exists(fn):
+		with open(fn, "rb") as f:
+			png = f.read()
+		return checksum, (png if png else None) # an empty file records that there is no image
+
+	try:
+		png = render_vote_thumbnail(vote, image_type)
+	except Http404:
+		png = None
+
+	if not os.path.exists(os.path.dirname(fn)): os.makedirs(os.path.dirname(fn))
+	for old_fn in glob.glob(vote_thumbnail_filename(vote, image_type, "*")):
+		os.unlink(old_fn) # older data
+	with open(fn + ".tmp%d" % os.getpid(), "wb") as f:
+		f.write(png if png else "")
+	os.rename(fn + ".tmp%d" % os.getpid(), fn) # atomically, since other processes may read it
+
+	return checksum, png
+
+def render_vote_thumbnail(vote, image_type):
 	import cairo, re, math
 	from StringIO import StringIO
 	
@@ -501,12 +564,7 @@ def vote_thumbnail_image(request, congress, session, chamber_code, number, image
 	# Convert the image buffer to raw PNG bytes.
 	buf = StringIO()
 	im.write_to_png(buf)
-	v = buf.getvalue()
-	
-	# Form the response.
-	r = HttpResponse(v, content_type='image/png')
-	r["Content-Length"] = len(v)
-	return r
+	return buf.getvalue()
 
 @anonymous_view
 def vote_check_thumbnails(request):
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from optparse import make_option
+
+import sys, time
+
+class Command(BaseCommand):
+	args = 'connection [app_label.model ...]'
+	help = 'Rebuilds the search index of a Xapian haystack connection (e.g. bill) in bulk, optionally for just some models, and reports the indexing rate.'
+	option_list = BaseCommand.option_list + (
+		make_option('--batch-size', type='int', default=None,
+			help='Commit to the index after this many documents (default is the connection\'s BATCH_SIZE).'),
+		make_option('--workers', type='int', default=4,
+			help='The number of processes to prepare documents in.'),
+		make_option('--clear', action='store_true', default=False,
+			help='Remove the existing documents of each model before indexing.'),
+		)
+
+	def handle(self, *args, **options):
+		from haystack import connections
+
+		if len(args) == 0:
+			raise CommandError("Specify a haystack connection.")
+		using = args[0]
+		backend = connections[using].get_backend()
+		if not hasattr(backend, "bulk_update"):
+			raise CommandError("The %s connection does not use the Xapian backend." % using)
+
+		indexes = connections[using].get_unified_index().get_indexes()
+		models = sorted(indexes.keys(), key = lambda m : (m._meta.app_label, m._meta.module_name))
+		if len(args) > 1:
+			models = [m for m in models if "%s.%s" % (m._meta.app_label, m._meta.module_name) in args[1:]]
+			if len(models) == 0:
+				raise CommandError("None of those models are indexed in the %s connection." % using)
+
+		total = 0
+		t0 = time.time()
+		for model in models:
+			index = indexes[model]
+			name = "%s.%s" % (model._meta.app_label, model._meta.module_name)
+
+			if options["clear"]:
+				backend.clear(models=[model])
+
+			t1 = time.time()
+			def progress(n):
+				if sys.stdout.isatty():
+					print "%s: %d documents, %.1f docs/sec" % (name, n, n/max(time.time()-t1, .001))
+			n = backend.bulk_update(index, index.index_queryset(using=using),
+				batch_size=options["batch_size"], workers=options["workers"], callback=progress)
+			total += n
+
+			print "%s: indexed %d documents in %d seconds (%.1f docs/sec)." % (name, n, time.time()-t1, n/max(time.time()-t1, .001))
+
+		print "Indexed %d documents in %d seconds (%.1f docs/sec)." % (total, time.time()-t0, total/max(time.time()-t0, .001))
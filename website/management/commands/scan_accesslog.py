@@ -2,6 +2,15 @@
 # a list of links by bill, and for search term keywords. You'll
 # probably run in a cron job using:
 #
+# ./manage.py scan_accesslog 5 ../logs/access_log ../logs/access_log.1.gz
+#
+# Each run reads only the part of the log files that it hasn't seen yet and
+# adds to referral counts kept from earlier runs. What has been read is tracked
+# by each log's content (its first line) rather than its file name, so when
+# access_log is rotated to access_log.1.gz, and that to access_log.2.gz, only
+# what was written after the last run is read. Recent access log entries can
+# also still be piped into standard input, in which case nothing is kept:
+#
 # tail -200000 ../logs/access_log|./manage.py scan_accesslog 5
 
 from django.core.management.base import BaseCommand, CommandError
@@ -9,13 +18,23 @@ from django.conf import settings
 
 from optparse import make_option
 
-import sys, re, urlparse, urllib, lxml, apachelog
+import sys, os, re, urlparse, urllib, lxml, gzip, json, hashlib, time
 
 from bill.models import Bill, BillType, BillLink
 
-re_bill = re.compile(r"^/congress/bills/(\d\d\d)/([a-z]+)([0-9]+)")
+# A fast path for our log format,
+#   %h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\"
+# that only matches requests for bill pages and extracts the bill and the
+# referrer. Lines that aren't requests for bill pages are skipped before
+# the regex with a substring test.
+re_line = re.compile(r'^\S+ \S+ \S+ \[[^\]]*\] "[A-Z]+ /congress/bills/(\d\d\d)/([a-z]+)([0-9]+)\S* [^"]*" \d+ \S+ "([^"]*)"')
+
+IGNORE_HOSTNAMES = set(("t.co", "longurl.org", "ow.ly", "bit.ly", "www.facebook.com", "www.weblinkvalidator.com", "static.ak.facebook.com", "info.com", "altavista.com", "tumblr.com", "www.freerepublic.com", "www.reddit.com"))
 
-logformat = r'%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\"'
+STATE_FILE = "data/cache/scan_accesslog.json"
+CHUNK_SIZE = 8 << 20 # bytes of log read at a time and handed to a worker
+MAX_PENDING_REFERRERS = 100000 # most frequent below-threshold referrers kept between runs
+LOG_STATE_MAX_AGE = 60*60*24*90 # forget logs not seen for this long (seconds)
 
 class AppURLopener(urllib.FancyURLopener):
 	version = "GovTrack.us scraper" # else Wikipedia gives 403s
@@ -23,75 +42,64 @@ urllib._urlopener = AppURLopener()
 
 
 class Command(BaseCommand):
-	args = 'minhits'
-	help = 'Scans the Apache access log for referrer information to create BillLink instances. Send recent access log entries to this script by piping it into standard input.'
+	args = 'minhits [logfile ...]'
+	help = 'Scans the Apache access log for referrer information to create BillLink instances. Pass the log files to scan (which may be gzipped), or send recent access log entries to this script by piping it into standard input.'
+	option_list = BaseCommand.option_list + (
+		make_option('--workers', type='int', default=4,
+			help='The number of processes to parse the log with.'),
+		)
 	
 	def handle(self, *args, **options):
-		if len(args) != 1:
+		if len(args) < 1:
 			print "Missing argument."
 			return
 
 		min_count = int(args[0])
+		log_files = args[1:]
 
-		p = apachelog.parser(logformat)
-		
-		spider = { }
+		if log_files:
+			# Pick up where the last run left off.
+			state = load_state()
+			spider = state["counts"]
+			chunks = read_new_log_chunks(log_files, state)
+		else:
+			state = None
+			spider = { }
+			chunks = read_log_chunks(sys.stdin)
+
+		# Parse the chunks in parallel and add up the referrals.
+		import multiprocessing
+		from django.db import connection
+		connection.close()
+		pool = multiprocessing.Pool(options["workers"], worker_init)
+		try:
+			for counts in pool.imap(count_referrals, chunks):
+				for key, count in counts.items():
+					spider[key] = spider.get(key, 0) + count
+			pool.close()
+		except:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
 		
-		for line in sys.stdin:
-			# Parse the acess log line.
-			try:
-				data = p.parse(line)
-			except:
-				continue
-			
-			# Is it a request to a bill page?
-			path = data["%r"].split(" ")[1]
-			m = re_bill.match(path)
-			if not m: continue
-			
-			# Who is the referrer?
-			ref = data["%{Referer}i"]
-			if ref in ("", "-") or "govtrack.us" in ref:
-				continue
-			
-			url = urlparse.urlparse(ref)
-			hostname = url.hostname
-			qs = urlparse.parse_qs(url.query)
-			
-			if not hostname: continue
-			
-			# Filter out known useless domains.
-			if hostname in ("t.co", "longurl.org", "ow.ly", "bit.ly", "www.facebook.com", "www.weblinkvalidator.com", "static.ak.facebook.com", "info.com", "altavista.com", "tumblr.com", "www.freerepublic.com", "www.reddit.com"): continue
-			if hostname.endswith(".ru"): continue
-			
-			# For referrals from Google, look at the 'q' argument to see how
-			# people are searching for this page.
-			if hostname.replace("www.", "").replace("search.", "") in ("google.com", "bing.com", "aol.com", "yahoo.com"):
-				# todo, some use q= some use query=
-				#print qs.get("q", [""])[0]
-				continue
-				
-			# Filter out other domains if the link has a 'q' argument since it's probs
-			# a search engine.
-			if "q" in qs or "pid" in qs: continue
-			
-			# Filter out common paths for message boards.
-			if "/threads/" in ref or "/forum/" in ref or "viewtopic.php" in ref: continue
-				
-			key = (m.groups(), url)
-			spider[key] = spider.get(key, 0) + 1
-			
 		###
 		
 		first_print = True
 		
-		spider = spider.items()
-		spider.sort(key = lambda kv : kv[1])
-		for (bill_info, referral_url), count in spider:
+		spider_items = spider.items()
+		spider_items.sort(key = lambda kv : kv[1])
+		for key, count in spider_items:
 			if count < min_count: continue # filter out referrers that occurred too infrequently
+			del spider[key] # we're done counting this referrer once it is processed
+			bill_info = key[0:3]
+			referral_url = urlparse.urlparse(key[3])
 			
 			bill_type = BillType.by_slug(bill_info[1])
-			bill = Bill.objects.get(congress=bill_info[0], bill_type=bill_type, number=bill_info[2])
+			try:
+				bill = Bill.objects.get(congress=bill_info[0], bill_type=bill_type, number=bill_info[2])
+			except Bill.DoesNotExist:
+				continue
 			
 			lnk, is_new = BillLink.objects.get_or_create(
 				bill=bill,
@@ -133,3 +141,132 @@ class Command(BaseCommand):
 			
 			lnk.save()
 
+		# Save the counts of referrers that haven't reached min_count yet, along
+		# with how far we've read in each file, for the next run.
+		if state is not None:
+			save_state(state)
+
+def load_state():
+	if not os.path.exists(STATE_FILE):
+		return { "logs": { }, "counts": { } }
+	with open(STATE_FILE) as f:
+		state = json.load(f)
+	state["counts"] = dict((tuple(key), count) for key, count in state["counts"])
+	state.setdefault("logs", { })
+	return state
+
+def save_state(state):
+	if not os.path.exists(os.path.dirname(STATE_FILE)): os.makedirs(os.path.dirname(STATE_FILE))
+	with open(STATE_FILE + ".tmp", "w") as f:
+		counts = sorted(state["counts"].items(), key = lambda kv : -kv[1])[:MAX_PENDING_REFERRERS]
+		logs = dict((k, v) for k, v in state["logs"].items() if v["seen"] > time.time() - LOG_STATE_MAX_AGE)
+		json.dump({ "logs": logs, "counts": counts }, f)
+	os.rename(STATE_FILE + ".tmp", STATE_FILE)
+
+def read_log_chunks(f, on_progress=None):
+	# Yields strings of whole lines of about CHUNK_SIZE bytes from the file.
+	# Calls on_progress with the number of bytes consumed after each chunk is
+	# *taken*, so a trailing partial line (a line still being written) is left
+	# for next time.
+	remainder = ""
+	while True:
+		block = f.read(CHUNK_SIZE)
+		if not block: break
+		block = remainder + block
+		end = block.rfind("\n") + 1
+		remainder = block[end:]
+		if end == 0: continue
+		yield block[:end]
+		if on_progress: on_progress(end)
+
+def read_new_log_chunks(log_files, state):
+	# Yields chunks of the lines in the log files that weren't read in an earlier
+	# run, updating state["logs"] as it goes. That's a dict keyed by a hash of
+	# the first line of each log, which stays the same when the log is renamed
+	# or compressed, holding how many (uncompressed) bytes of it have been read
+	# and, once a compressed log has been read to the end, its size and mtime.
+	# Logs from before this was tracked by content are looked up in
+	# state["files"], which was keyed by file name.
+	old_files = state.get("files", { })
+	for fn in log_files:
+		st = os.stat(fn)
+		is_gz = fn.endswith(".gz")
+		with (gzip.open(fn) if is_gz else open(fn, "rb")) as f:
+			first_line = f.readline()
+			if not first_line.endswith("\n"): continue # nothing complete to read yet
+			key = hashlib.sha1(first_line).hexdigest()
+
+			rec = state["logs"].get(key)
+			if rec is None:
+				rec = { "offset": 0 }
+				prev = old_files.get(fn, { })
+				if is_gz and prev.get("size") == st.st_size and prev.get("mtime") == st.st_mtime:
+					rec["gz"] = [st.st_size, st.st_mtime]
+				elif not is_gz and prev.get("inode") == st.st_ino and prev.get("offset", 0) <= st.st_size:
+					rec["offset"] = prev["offset"]
+			state["logs"][key] = rec
+			rec["seen"] = time.time()
+
+			if is_gz and rec.get("gz") == [st.st_size, st.st_mtime]:
+				continue # already read to the end
+			if not is_gz and st.st_size < rec["offset"]:
+				rec["offset"] = 0 # truncated
+
+			def on_progress(n):
+				rec["offset"] += n
+			f.seek(rec["offset"])
+			for chunk in read_log_chunks(f, on_progress):
+				yield chunk
+			if is_gz:
+				# Rotated logs aren't written to anymore, so next time this
+				# one can be skipped without decompressing it again.
+				rec["gz"] = [st.st_size, st.st_mtime]
+
+def worker_init():
+	from django.db import connection
+	connection.close()
+
+def count_referrals(chunk):
+	# Returns a dict from (congress, bill type slug, number, referrer URL) to
+	# the number of times the referrer linked to the bill in the chunk of lines.
+	counts = { }
+	for line in chunk.split("\n"):
+		if "/congress/bills/" not in line: continue
+		key = get_referral(line)
+		if key:
+			counts[key] = counts.get(key, 0) + 1
+	return counts
+
+def get_referral(line):
+	# Parse the access log line. Is it a request to a bill page?
+	m = re_line.match(line)
+	if not m: return None
+	
+	# Who is the referrer?
+	ref = m.group(4)
+	if ref in ("", "-") or "govtrack.us" in ref:
+		return None
+	
+	url = urlparse.urlparse(ref)
+	hostname = url.hostname
+	if not hostname: return None
+	
+	# Filter out known useless domains.
+	if hostname in IGNORE_HOSTNAMES: return None
+	if hostname.endswith(".ru"): return None
+	
+	# For referrals from Google, look at the 'q' argument to see how
+	# people are searching for this page.
+	if hostname.replace("www.", "").replace("search.", "") in ("google.com", "bing.com", "aol.com", "yahoo.com"):
+		# todo, some use q= some use query=
+		return None
+		
+	# Filter out other domains if the link has a 'q' argument since it's probs
+	# a search engine.
+	qs = urlparse.parse_qs(url.query)
+	if "q" in qs or "pid" in qs: return None
+	
+	# Filter out common paths for message boards.
+	if "/threads/" in ref or "/forum/" in ref or "viewtopic.php" in ref: return None
+	
+	return (m.group(1), m.group(2), m.group(3), url.geturl())
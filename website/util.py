@@ -0,0 +1,80 @@
+import time
+
+SUBSTRING_INDEX_MAX_AGE = 60*60 # seconds
+
+class SubstringIndex(object):
+    """
+    Case-insensitive substring matching over the names of a small set of
+    objects, like an __icontains filter but in memory. Each name is indexed
+    by its trigrams, so a query only tests the names that contain all of the
+    query's trigrams.
+    """
+
+    def __init__(self, objects, name_func):
+        self.objects = list(objects)
+        self.names = [name_func(obj).lower() for obj in self.objects]
+        self.trigrams = { } # trigram => [object index]
+        for i, name in enumerate(self.names):
+            for t in set(name[j:j+3] for j in xrange(len(name)-2)):
+                self.trigrams.setdefault(t, []).append(i)
+
+    def search(self, q):
+        """Returns the objects whose names contain q, in their original order."""
+        q = q.lower()
+        if len(q) < 3:
+            candidates = xrange(len(self.objects))
+        else:
+            postings = sorted((self.trigrams.get(q[j:j+3], []) for j in xrange(len(q)-2)), key=len)
+            candidates = set(postings[0])
+            for p in postings[1:]:
+                if not candidates: break
+                candidates &= set(p)
+            candidates = sorted(candidates)
+        return [self.objects[i] for i in candidates if q in self.names[i]]
+
+_substring_indexes = { }
+
+def get_substring_index(key, queryset, name_func):
+    """
+    Returns a SubstringIndex over the objects in the queryset, which is
+    cached in this process under key and reloaded once it is
+    SUBSTRING_INDEX_MAX_AGE seconds old.
+    """
+    entry = _substring_indexes.get(key)
+    if entry is None or time.time() - entry[0] > SUBSTRING_INDEX_MAX_AGE:
+        entry = (time.time(), SubstringIndex(queryset, name_func))
+        _substring_indexes[key] = entry
+    return entry[1]
+
+def close_db_connection():
+    # Pool initializer, so that each forked worker opens its own database connection.
+    from django.db import connection
+    connection.close()
+
+def map_chunks_in_pool(func, items, workers, chunk_size=50, desc=None):
+    """
+    Calls func on chunks of chunk_size items in a pool of worker processes
+    and returns the list of its return values, in no particular order.
+    func must be a module-level function so that it can be pickled. A
+    progress bar labeled desc is shown when running in a terminal.
+    """
+    import multiprocessing, sys
+    from django.db import connection
+
+    # Each forked worker opens its own database connection.
+    connection.close()
+    pool = multiprocessing.Pool(workers, close_db_connection)
+    try:
+        chunks = [items[i:i+chunk_size] for i in xrange(0, len(items), chunk_size)]
+        results = pool.imap_unordered(func, chunks)
+        if sys.stdout.isatty():
+            import tqdm
+            results = tqdm.tqdm(results, total=len(chunks), desc=desc)
+        ret = list(results)
+        pool.close()
+        return ret
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
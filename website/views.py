@@ -19,7 +19,7 @@ from registration.helpers import json_response
 from events.models import Feed
 import us
 
-import re, json
+import re, json, threading
 from datetime import datetime, timedelta, time
 
 @anonymous_view
@@ -73,10 +73,18 @@ def get_blog_items():
 def congress_home(request):
     return HttpResponseRedirect("/start")
 
+SITE_SEARCH_TIMEOUT = 5 # seconds to wait for all of the search backends
+SITE_SEARCH_THREADS = 10
+
 def do_site_search(q, allow_redirect=False):
     if q.strip() == "":
         return []
     
+    from bill.search import parse_bill_citation
+    bill = parse_bill_citation(q)
+    if bill and allow_redirect:
+        return HttpResponseRedirect(bill.get_absolute_url())
+
     results = []
     
     from bill.models import Bill
@@ -98,23 +106,6 @@ def do_site_search(q, allow_redirect=False):
                 ]
             })
     
-    from haystack.query import SearchQuerySet
-    from events.models import Feed
-    
-    results.append({
-        "title": "Members of Congress, Presidents, and Vice Presidents",
-        "href": "/congress/members/all",
-        "qsarg": "name",
-        "noun": "Members of Congress, Presidents, or Vice Presidents",
-        "results": [
-            {"href": p.object.get_absolute_url(),
-             "label": p.object.name,
-             "obj": p.object,
-             "feed": p.object.get_feed(),
-             "secondary": p.object.get_current_role() == None }
-            for p in SearchQuerySet().using("person").filter(indexed_model_name__in=["Person"], content=q).order_by('-is_currently_serving', '-score')[0:9]]
-        })
-       
     # Skipping states for now because we might want to go to the district maps or to
     # the state's main page for state legislative information.
     #import us
@@ -123,9 +114,110 @@ def do_site_search(q, allow_redirect=False):
     #        for s in us.statenames
     #        if us.statenames[s].lower().startswith(q.lower())
     #        ], key=lambda p : p["label"])))
+
+    # The lookups are independent, so run them concurrently, giving up on any
+    # that take longer than SITE_SEARCH_TIMEOUT.
+    tasks = [site_search_people, site_search_committees, site_search_bills]
+    if "states" in settings.HAYSTACK_CONNECTIONS:
+        tasks.append(site_search_states)
+    tasks.append(site_search_subject_terms)
+    results.extend(run_site_search_tasks(tasks, q))
+
+    # in each group, make sure the secondary results are placed last, but otherwise preserve order
+    for grp in results:
+        for i, obj in enumerate(grp["results"]):
+           obj["index"] = i
+        grp["results"].sort(key = lambda o : (o.get("secondary", False), o["index"]))
     
+    # sort categories first by whether all results are secondary results, then by number of matches (fewest first, if greater than zero)
+    results.sort(key = lambda c : (
+        len([d for d in c["results"] if d.get("secondary", False) == False]) == 0,
+        len(c["results"]) == 0,
+        len(c["results"])))
+        
+    return results
+
+_site_search_pool = None
+_site_search_pool_lock = threading.Lock()
+_site_search_slots = threading.BoundedSemaphore(SITE_SEARCH_THREADS) # tasks queued or running in the pool, including timed-out ones
+
+def run_site_search_tasks(tasks, q):
+    # Runs each task function on q in a thread pool and returns the result
+    # groups of the tasks that finished in time, in the order of tasks. A task
+    # that times out keeps its pool thread until it finishes, so when all of
+    # the pool's threads are taken, tasks are run in this thread instead
+    # rather than queued behind them.
+    global _site_search_pool
+    import time as _time
+    from multiprocessing import TimeoutError
+    from multiprocessing.pool import ThreadPool
+    import logging
+    with _site_search_pool_lock:
+        if _site_search_pool is None:
+            _site_search_pool = ThreadPool(SITE_SEARCH_THREADS)
+
+    pending = []
+    for task in tasks:
+        if _site_search_slots.acquire(False):
+            pending.append((task, _site_search_pool.apply_async(run_site_search_task, (task, q))))
+        else:
+            logging.getLogger("website.views").warning("Site search pool is full, running %s for %r in the request thread." % (task.__name__, q))
+            pending.append((task, None))
+
+    deadline = _time.time() + SITE_SEARCH_TIMEOUT
+    results = []
+    for task, r in pending:
+        if r is None:
+            results.append(task(q))
+            continue
+        try:
+            results.append(r.get(max(deadline - _time.time(), 0)))
+        except TimeoutError:
+            logging.getLogger("website.views").warning("Site search timed out in %s for %r." % (task.__name__, q))
+    return results
+
+def run_site_search_task(task, q):
+    try:
+        return task(q)
+    finally:
+        # Each thread gets its own database connection. Don't leave it open
+        # between searches.
+        from django.db import connection
+        connection.close()
+        _site_search_slots.release() # see run_site_search_tasks
+
+def load_search_result_objects(model, search_results):
+    # Get the objects for Haystack search results in one query rather than
+    # one per result (which is what SearchResult.object does), skipping any
+    # that are no longer in the database.
+    pks = [int(r.pk) for r in search_results]
+    objs = model.objects.in_bulk(pks)
+    return [objs[pk] for pk in pks if pk in objs]
+
+def site_search_people(q):
+    from haystack.query import SearchQuerySet
+    from person.models import Person
+    return {
+        "title": "Members of Congress, Presidents, and Vice Presidents",
+        "href": "/congress/members/all",
+        "qsarg": "name",
+        "noun": "Members of Congress, Presidents, or Vice Presidents",
+        "results": [
+            {"href": p.get_absolute_url(),
+             "label": p.name,
+             "obj": p,
+             "feed": p.get_feed(),
+             "secondary": p.get_current_role() == None }
+            for p in load_search_result_objects(Person, SearchQuerySet().using("person").filter(indexed_model_name__in=["Person"], content=q).order_by('-is_currently_serving', '-score')[0:9])]
+        }
+
+def site_search_committees(q):
     from committee.models import Committee
-    results.append({
+    from website.util import get_substring_index
+    committees = get_substring_index("committees",
+        Committee.objects.filter(obsolete=False).select_related("committee"),
+        lambda c : c.name)
+    return {
         "title": "Congressional Committees",
         "href": "/congress/committees",
         "noun": "committees in Congress",
@@ -134,52 +226,56 @@ def do_site_search(q, allow_redirect=False):
              "label": c.fullname,
              "feed": c.get_feed(),
              "obj": c,
-             "secondary": c.committee != None}
-            for c in Committee.objects.filter(name__icontains=q, obsolete=False)
+             "secondary": c.committee_id != None}
+            for c in committees.search(q)
             ], key=lambda c : c["label"])
-        })
-       
+        }
+
+def site_search_bills(q):
+    from haystack.query import SearchQuerySet
+    from haystack.inputs import AutoQuery
+    from bill.models import Bill
     from settings import CURRENT_CONGRESS
-    from bill.search import parse_bill_citation
-    bill = parse_bill_citation(q)
-    if not bill or not allow_redirect:
-        from haystack.inputs import AutoQuery
-        bills = [\
-            {"href": b.object.get_absolute_url(),
-             "label": b.object.title,
-             "obj": b.object,
-             "feed": b.object.get_feed() if b.object.is_alive else None,
-             "secondary": b.object.congress != CURRENT_CONGRESS }
-            for b in SearchQuerySet().using("bill").filter(indexed_model_name__in=["Bill"], content=AutoQuery(q)).order_by('-current_status_date')[0:9]]
-    else:
-        #bills = [{"href": bill.get_absolute_url(), "label": bill.title, "obj": bill, "secondary": bill.congress != CURRENT_CONGRESS }]
-        return HttpResponseRedirect(bill.get_absolute_url())
-    results.append({
+    return {
         "title": "Bills and Resolutions (Federal)",
         "href": "/congress/bills/browse",
         "qsarg": "congress=__ALL__&text",
         "noun": "federal bills or resolutions",
-        "results": bills})
+        "results": [
+            {"href": b.get_absolute_url(),
+             "label": b.title,
+             "obj": b,
+             "feed": b.get_feed() if b.is_alive else None,
+             "secondary": b.congress != CURRENT_CONGRESS }
+            for b in load_search_result_objects(Bill, SearchQuerySet().using("bill").filter(indexed_model_name__in=["Bill"], content=AutoQuery(q)).order_by('-current_status_date')[0:9])]
+        }
 
-    if "states" in settings.HAYSTACK_CONNECTIONS:
-        results.append({
-            "title": "State Legislation",
-            "href": "/states/bills/browse",
-            "qsarg": "text",
-            "noun": "state legislation",
-            "results": [
-                {"href": p.object.get_absolute_url(),
-                 "label": p.object.short_display_title,
-                 "obj": p.object,
-                 "feed": Feed(feedname="states_bill:%d" % p.object.id),
-                 "secondary": True }
-                for p in SearchQuerySet().using('states').filter(indexed_model_name__in=["StateBill"], content=q)[0:9]]
-                })
+def site_search_states(q):
+    from haystack.query import SearchQuerySet
+    from states.models import StateBill
+    return {
+        "title": "State Legislation",
+        "href": "/states/bills/browse",
+        "qsarg": "text",
+        "noun": "state legislation",
+        "results": [
+            {"href": p.get_absolute_url(),
+             "label": p.short_display_title,
+             "obj": p,
+             "feed": Feed(feedname="states_bill:%d" % p.id),
+             "secondary": True }
+            for p in load_search_result_objects(StateBill, SearchQuerySet().using('states').filter(indexed_model_name__in=["StateBill"], content=q)[0:9])]
+        }
 
+def site_search_subject_terms(q):
     # subject terms, but exclude subject terms that look like committee names because
     # that is confusing to also see with committee results
     from bill.models import BillTerm, TermType
-    results.append({
+    from website.util import get_substring_index
+    terms = get_substring_index("billterms",
+        BillTerm.objects.filter(term_type=TermType.new).exclude(name__contains=" Committee on ").order_by("id"),
+        lambda t : t.name)
+    return {
         "title": "Subject Areas (Federal Legislation)",
         "href": "/congress/bills",
         "noun": "subject areas",
@@ -189,22 +285,8 @@ def do_site_search(q, allow_redirect=False):
              "obj": p,
              "feed": p.get_feed(),
              "secondary": not p.is_top_term() }
-            for p in BillTerm.objects.filter(name__icontains=q, term_type=TermType.new).exclude(name__contains=" Committee on ")[0:9]]
-        })
-    
-    # in each group, make sure the secondary results are placed last, but otherwise preserve order
-    for grp in results:
-        for i, obj in enumerate(grp["results"]):
-           obj["index"] = i
-        grp["results"].sort(key = lambda o : (o.get("secondary", False), o["index"]))
-    
-    # sort categories first by whether all results are secondary results, then by number of matches (fewest first, if greater than zero)
-    results.sort(key = lambda c : (
-        len([d for d in c["results"] if d.get("secondary", False) == False]) == 0,
-        len(c["results"]) == 0,
-        len(c["results"])))
-        
-    return results
+            for p in terms.search(q)[0:9]]
+        }
 
 @render_to('website/search.html')
 def search(request):